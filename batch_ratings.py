@@ -0,0 +1,298 @@
+"""
+Batch ratings for a whole archive:
+Reads every game of a directory or glob of PGN files, groups the games by
+their Event tag and computes, for every player of every event, the TPR and
+PRE (performance_rating_equilibrium), the EPR, CPR and FPR (looked up in
+rating_tables) and, for perfect scores, the perfect score PR (calculate_cpr).
+Results are streamed to a CSV, Parquet or JSON Lines file (result_export),
+one event after another, or ranked by one column with --sort-by.
+
+A CSV of per-player results, with columns Event, Name, Rating, Points,
+Games and Opponent_Average (Event and Rating optional), can be rated
+instead. Without pairings it has no PRE or perfect score PR, and its TPR is
+pr_calculator.calculate_TPR.
+
+Memory is bounded by the largest event rather than the archive: a first
+pass spills compact game records to disk, bucketed by a hash of the event
+name, and a second pass rates one bucket at a time. Both passes run on a
+pool of --jobs processes.
+
+Usage:
+    python batch_ratings.py ARCHIVE_DIR -o ratings.csv --jobs 4
+    python batch_ratings.py "archive/**/*.pgn" -o ratings.parquet
+    python batch_ratings.py players.csv -o ratings.csv
+    python batch_ratings.py ARCHIVE_DIR -o best.jsonl --sort-by PRE --top 100
+"""
+
+import argparse
+import glob
+import os
+import pickle
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+import instrumentation
+from pgn_scanner import iter_game_records, shard_pgn_files
+from pgn_cache import RECORD_DTYPE
+from performance_rating_equilibrium import find_pgn_files, process_player_data, DEFAULT_CHUNK_SIZE
+from player_store import PlayerStore
+from pre_solvers import SOLVERS
+from calculate_cpr import perfect_score_prs
+from rating_tables import epr_lookup, cpr_lookup, fpr_lookup
+from result_export import FORMATS, open_writer
+
+OUTPUT_COLUMNS = ['Event', 'Rank', 'Name', 'Rating', 'Points', 'Games', 'Opponent_Average',
+                  'TPR', 'PRE', 'EPR', 'CPR', 'FPR', 'PSPR']
+RATING_COLUMNS = ['Opponent_Average', 'TPR', 'PRE', 'EPR', 'CPR', 'FPR', 'PSPR']
+EVENT_RECORD_DTYPE = np.dtype([('event', '<i4')] + RECORD_DTYPE.descr)
+GAME_FIELDS = list(RECORD_DTYPE.names)
+# PGN bytes per spill bucket; each bucket is rated in memory at once
+DEFAULT_BUCKET_BYTES = 256 * 1024 * 1024
+DEFAULT_CSV_CHUNK_ROWS = 100000
+# Events without an equilibrium get no PRE after this many iterations
+DEFAULT_MAX_ITERATIONS = 1000
+
+
+def find_input_files(pgn_input):
+    """PGN files of a directory (as find_pgn_files) or of a glob pattern."""
+    if os.path.isdir(pgn_input):
+        return find_pgn_files(pgn_input)
+    return sorted(glob.glob(pgn_input, recursive=True))
+
+
+def _bucket(event, buckets):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(event.encode('utf-8')) % buckets
+
+
+def spill_shard(task):
+    """
+    Pass 1, for one (index, shard, spill_dir, buckets) task: read the games
+    of a (pgn_file_path, byte_range, exact) shard and write those of each
+    bucket to `<bucket>-<index>.pkl`, with only the names they use.
+    Returns the number of games read.
+    """
+    index, (pgn_file_path, byte_range, exact), spill_dir, buckets = task
+    player_ids = {}
+    event_ids = {}
+    games = np.fromiter(iter_game_records(pgn_file_path, player_ids, exact, byte_range, event_ids),
+                        dtype=EVENT_RECORD_DTYPE)
+    if not len(games):
+        return 0
+    player_names = np.array(list(player_ids), dtype=object)
+    event_names = list(event_ids)
+    game_buckets = np.array([_bucket(event, buckets) for event in event_names])[games['event']]
+
+    for bucket in np.unique(game_buckets):
+        part = games[game_buckets == bucket]
+        # Renumber the players this bucket uses; order does not matter
+        used, inverse = np.unique(np.concatenate((part['white'], part['black'])), return_inverse=True)
+        part['white'], part['black'] = inverse[:len(part)], inverse[len(part):]
+        # Renumber events in order of first appearance
+        _, first = np.unique(part['event'], return_index=True)
+        events = part['event'][np.sort(first)]
+        event_index = np.empty(len(event_names), dtype=np.int32)
+        event_index[events] = np.arange(len(events))
+        part['event'] = event_index[part['event']]
+
+        spill_path = os.path.join(spill_dir, '%d-%d.pkl' % (bucket, index))
+        with open(spill_path, 'wb') as f:
+            pickle.dump(([event_names[event] for event in events], player_names[used].tolist(), part), f,
+                        pickle.HIGHEST_PROTOCOL)
+    return len(games)
+
+
+def _read_bucket(spill_paths):
+    # Merge the spilled parts of one bucket, in shard order
+    player_ids = {}
+    event_ids = {}
+    parts = []
+    for spill_path in spill_paths:
+        with open(spill_path, 'rb') as f:
+            event_names, player_names, part = pickle.load(f)
+        player_index = np.array([player_ids.setdefault(name, len(player_ids)) for name in player_names],
+                                dtype=np.int32)
+        event_index = np.array([event_ids.setdefault(event, len(event_ids)) for event in event_names],
+                               dtype=np.int32)
+        part['white'] = player_index[part['white']]
+        part['black'] = player_index[part['black']]
+        part['event'] = event_index[part['event']]
+        parts.append(part)
+    return list(event_ids), list(player_ids), np.concatenate(parts)
+
+
+def rate_event(event, names, games, performance_rating_type='standard', threshold=0.75,
+               max_iterations=DEFAULT_MAX_ITERATIONS, solver='plain'):
+    """
+    Ratings of every player of one event, given its games as an array with
+    the RECORD_DTYPE fields and ids indexing `names`, with the PRE from one
+    of pre_solvers.SOLVERS. Returns a DataFrame with OUTPUT_COLUMNS sorted
+    by Points, or None if the event has no finished game.
+    """
+    store = PlayerStore.from_records(names, games)
+    if not len(store):
+        return None
+    store = process_player_data(store, store.average_rating, performance_rating_type,
+                                max_iterations=max_iterations, solver=solver)
+
+    points, games = store.points, store.counts
+    opponent_average = store.opponent_average()
+
+    # Perfect score PR only where the score is perfect
+    perfect = np.flatnonzero(points == games)
+    pspr = np.full(len(store), np.nan)
+    if len(perfect):
+        pspr[perfect] = perfect_score_prs([store.opponent_ratings(i) for i in perfect])
+
+    frame = pd.DataFrame({
+        'Event': event,
+        'Rank': np.arange(1, len(store) + 1),
+        'Name': store.names,
+        'Rating': store.ratings.astype(np.int64),
+        'Points': points,
+        'Games': games,
+        'Opponent_Average': opponent_average,
+        'TPR': store.tpr,
+        'PRE': store.pre,
+        'EPR': epr_lookup(points, games, opponent_average, threshold),
+        'CPR': cpr_lookup(points, games, opponent_average),
+        'FPR': fpr_lookup(points, games, opponent_average),
+        'PSPR': pspr,
+    })
+    frame[RATING_COLUMNS] = frame[RATING_COLUMNS].astype(np.float64).round(1)
+    return frame.sort_values(by='Points', ascending=False, kind='stable')
+
+
+def rate_bucket(task):
+    """
+    Pass 2, for one (spill_paths, performance_rating_type, threshold,
+    max_iterations, solver) task: rate every event of a bucket. Returns a
+    DataFrame, or None.
+    """
+    spill_paths, performance_rating_type, threshold, max_iterations, solver = task
+    event_names, names, games = _read_bucket(spill_paths)
+
+    # Split the games by event, keeping their order within each event
+    order = np.argsort(games['event'], kind='stable')
+    games = games[order]
+    bounds = np.flatnonzero(np.diff(games['event'])) + 1
+    frames = []
+    for part in np.split(games, bounds):
+        frame = rate_event(event_names[part['event'][0]], names, part,
+                           performance_rating_type, threshold, max_iterations, solver)
+        if frame is not None:
+            frames.append(frame)
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+def rate_pgn_archive(pgn_input, output_path, performance_rating_type='standard', threshold=0.75, jobs=1,
+                     exact=False, output_format=None, bucket_bytes=DEFAULT_BUCKET_BYTES,
+                     chunk_size=DEFAULT_CHUNK_SIZE, max_iterations=DEFAULT_MAX_ITERATIONS, solver='plain',
+                     sort_by=None, top=None):
+    """
+    Rate every event of the PGN files in a directory or glob `pgn_input`
+    and write the results to output_path, event by event, or ranked by
+    column sort_by (best top rows only, with top). jobs=None uses one
+    process per CPU. Returns the number of rows written.
+    """
+    jobs = jobs or os.cpu_count()
+    pgn_files = find_input_files(pgn_input)
+    total_bytes = sum(os.path.getsize(pgn_file_path) for pgn_file_path in pgn_files)
+    buckets = max(1, -(-total_bytes // max(1, bucket_bytes)))
+    shards = shard_pgn_files(pgn_files, exact, chunk_size)
+
+    with tempfile.TemporaryDirectory(prefix='batch_ratings_') as spill_dir, \
+            open_writer(output_path, output_format, OUTPUT_COLUMNS, sort_by, top=top) as writer:
+        tasks = [(index, shard, spill_dir, buckets) for index, shard in enumerate(shards)]
+        for _ in instrumentation.pool_map(spill_shard, tasks, jobs, bounded=True):
+            pass
+
+        # Spill files of each bucket, in shard order
+        spilled = {}
+        for spill_name in os.listdir(spill_dir):
+            bucket, index = map(int, spill_name[:-len('.pkl')].split('-'))
+            spilled.setdefault(bucket, []).append((index, os.path.join(spill_dir, spill_name)))
+        tasks = [([spill_path for _, spill_path in sorted(spilled[bucket])], performance_rating_type, threshold,
+                  max_iterations, solver) for bucket in sorted(spilled)]
+        for frame in instrumentation.pool_map(rate_bucket, tasks, jobs, bounded=True):
+            if frame is not None:
+                writer.write(frame)
+    return writer.rows
+
+
+def rate_player_csv(csv_path, output_path, threshold=0.75, output_format=None,
+                    chunk_rows=DEFAULT_CSV_CHUNK_ROWS, sort_by=None, top=None):
+    """
+    Rate a CSV of per-player results (see module docstring) in chunks of
+    chunk_rows and write the results to output_path, ranked as by
+    rate_pgn_archive with sort_by. Returns the number of rows written.
+    """
+    rated = 0
+    with open_writer(output_path, output_format, OUTPUT_COLUMNS, sort_by, top=top) as writer:
+        for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+            points = chunk['Points'].to_numpy(dtype=np.float64)
+            games = chunk['Games'].to_numpy(dtype=np.float64)
+            opponent_average = chunk['Opponent_Average'].to_numpy(dtype=np.float64)
+            # calculate_TPR, which is undefined for zero and perfect scores
+            interior = (points > 0) & (points < games)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                tpr = np.where(interior, opponent_average - 400 * np.log10((games - points) / points), np.nan)
+
+            frame = pd.DataFrame({
+                'Event': chunk['Event'] if 'Event' in chunk else '?',
+                'Rank': chunk['Rank'] if 'Rank' in chunk else np.arange(rated, rated + len(chunk)) + 1,
+                'Name': chunk['Name'],
+                'Rating': chunk['Rating'] if 'Rating' in chunk else np.nan,
+                'Points': points,
+                'Games': games.astype(np.int64),
+                'Opponent_Average': opponent_average,
+                'TPR': tpr,
+                'PRE': np.nan,
+                'EPR': epr_lookup(points, games, opponent_average, threshold),
+                'CPR': cpr_lookup(points, games, opponent_average),
+                'FPR': fpr_lookup(points, games, opponent_average),
+                'PSPR': np.nan,
+            })
+            frame[RATING_COLUMNS] = frame[RATING_COLUMNS].astype(np.float64).round(1)
+            writer.write(frame)
+            rated += len(frame)
+    return writer.rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute TPR, PRE, EPR, CPR and FPR for every player of every "
+                                                 "event in a PGN archive or a CSV of per-player results.")
+    parser.add_argument('input', help="directory or glob of PGN files, or a .csv of per-player results")
+    parser.add_argument('-o', '--output', default='ratings.csv', help="output .csv, .parquet or .jsonl file")
+    parser.add_argument('--format', choices=FORMATS, help="output format; default from the extension")
+    parser.add_argument('--sort-by', choices=OUTPUT_COLUMNS[4:],
+                        help="rank every row of the output by this column, best first, in bounded memory")
+    parser.add_argument('--top', type=int, help="with --sort-by, write only this many rows")
+    parser.add_argument('--performance-rating-type', choices=['standard', 'linear'], default='standard',
+                        help="PR used by the PRE; linear is much faster")
+    parser.add_argument('--threshold', type=float, default=0.75, help="probability threshold t of the EPR")
+    parser.add_argument('--max-iterations', type=int, default=DEFAULT_MAX_ITERATIONS,
+                        help="PRE iterations before giving up on an event without equilibrium")
+    parser.add_argument('--solver', choices=list(SOLVERS), default='plain',
+                        help="PRE solver; on slowly converging Swisses anderson and newton can save up to "
+                             "half of the plain iterations (two thirds for linear PRs)")
+    parser.add_argument('--jobs', type=int, default=1, help="worker processes; 0 for one per CPU")
+    parser.add_argument('--exact', action='store_true', help="read headers with python-chess")
+    parser.add_argument('--bucket-mb', type=int, default=DEFAULT_BUCKET_BYTES // (1024 * 1024),
+                        help="PGN megabytes rated in memory at once")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if args.top is not None and args.sort_by is None:
+        parser.error("--top needs --sort-by")
+
+    with instrumentation.profile_from_args(args):
+        if args.input.endswith('.csv'):
+            rows = rate_player_csv(args.input, args.output, args.threshold, args.format,
+                                   sort_by=args.sort_by, top=args.top)
+        else:
+            rows = rate_pgn_archive(args.input, args.output, args.performance_rating_type, args.threshold,
+                                    args.jobs or None, args.exact, args.format, args.bucket_mb * 1024 * 1024,
+                                    max_iterations=args.max_iterations, solver=args.solver,
+                                    sort_by=args.sort_by, top=args.top)
+    print(f"Wrote {rows} rows to {args.output}")
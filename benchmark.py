@@ -0,0 +1,378 @@
+"""
+Benchmarks for the rating calculators:
+Generates synthetic round-robins, Swisses, randomly paired events and
+multi-event archives, as game records in memory or as PGN files, and times
+process_pgn_files, process_player_data (standard and linear, with every
+PRE solver), optimize_w, perfect_score_pr, calculate_FPR and the
+rating_tables lookups over a sweep of sizes. The bundled GrandSwissPalma2017.pgn is timed as a
+fixed reference point. Results are written as JSON, and a compare mode
+flags regressions against a stored baseline.
+
+The cold start benchmarks time fresh interpreters that import the closed-form
+calculators, the w* optimizer, PRE or main.py, less the startup of a bare
+interpreter. The closed-form imports must stay within COLD_START_BUDGET and
+must not load NumPy, SciPy, pandas or python-chess; both are checked by run,
+compare and the cold-start command.
+
+Usage:
+    python benchmark.py run -o baseline.json [--quick]
+    python benchmark.py run -o current.json
+    python benchmark.py compare baseline.json current.json [--tolerance 0.25]
+    python benchmark.py cold-start
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from performance_rating_equilibrium import build_player_data, process_player_data, process_pgn_files
+from pre_solvers import SOLVERS
+from pr_calculator import calculate_FPR, optimize_w
+from calculate_cpr import perfect_score_pr
+from rating_tables import epr_lookup, cpr_lookup, fpr_lookup
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+PALMA_PGN = os.path.join(REPO_DIR, 'GrandSwissPalma2017.pgn')
+RESULT_STRINGS = {2: '1-0', 1: '1/2-1/2', 0: '0-1'}
+
+# Size sweeps: (players, rounds) per Swiss, players per round-robin,
+# (events, players, rounds) per archive
+SWISS_SIZES = [(16, 7), (64, 9), (256, 9), (1024, 11)]
+ROUND_ROBIN_SIZES = [10, 20, 40]
+ARCHIVE_SIZES = [(10, 64, 9), (100, 64, 9)]
+OPTIMIZE_W_GAMES = [10, 50, 200]
+PERFECT_SCORE_GAMES = [10, 100, 1000, 10000]
+QUICK_SWISS_SIZES = [(16, 7), (64, 9)]
+QUICK_ROUND_ROBIN_SIZES = [10]
+QUICK_ARCHIVE_SIZES = [(10, 64, 9)]
+# Synthetic events are not guaranteed an equilibrium; cap the PRE iterations
+MAX_ITERATIONS = 1000
+
+# Seconds the closed-form calculators may add to interpreter startup
+COLD_START_BUDGET = 0.05
+# Statements timed in a fresh interpreter, each against a bare one
+COLD_START_STATEMENTS = {
+    'closed_form': (
+        "import sys\n"
+        "from pr_calculator import calculate_win_probability, calculate_TPR, calculate_FPR, calculate_EPR\n"
+        "from calculate_cpr import calculate_cpr\n"
+        "calculate_win_probability(2800, 2700), calculate_TPR(5.5, 9, 2700), calculate_FPR(5.5, 9, 2700)\n"
+        "calculate_EPR(0.6, 2700), calculate_cpr(5.5, 9, 2700)\n"
+        "heavy = {'numpy', 'scipy', 'pandas', 'chess'} & set(sys.modules)\n"
+        "assert not heavy, 'closed-form calculators imported %s' % sorted(heavy)\n"),
+    'optimizer': "from pr_calculator import optimize_w\noptimize_w(11, 11, 0.75)\n",
+    'pre': "import performance_rating_equilibrium\n",
+    'main': "import main\n",
+}
+
+
+def _play(white_rating, black_rating, rng):
+    # Result in White's half points, drawn from the Elo expected score
+    expected = 1 / (1 + 10 ** ((black_rating - white_rating) / 400))
+    draw = min(0.3, 2 * min(expected, 1 - expected))
+    u = rng.random()
+    if u < expected - draw / 2:
+        return 2
+    return 1 if u < expected + draw / 2 else 0
+
+
+def _ratings(players, rng, rating_range):
+    return [rng.randint(*rating_range) for _ in range(players)]
+
+
+def round_robin_records(players, seed=0, rating_range=(2400, 2800)):
+    """
+    Names and (white_id, black_id, result, white_elo, black_elo) records of
+    a single round-robin between `players` synthetic players.
+    """
+    rng = random.Random(seed)
+    ratings = _ratings(players, rng, rating_range)
+    records = []
+    for a in range(players):
+        for b in range(a + 1, players):
+            white, black = (a, b) if rng.random() < 0.5 else (b, a)
+            records.append((white, black, _play(ratings[white], ratings[black], rng),
+                            ratings[white], ratings[black]))
+    return ['Player %d' % i for i in range(players)], records
+
+
+def swiss_records(players, rounds, seed=0, rating_range=(1800, 2700), first_id=0):
+    """
+    Names and records of a Swiss: every round pairs players with equal or
+    close scores, stronger first, without rematches where possible. With an
+    odd number of players the last one has a bye. Player ids start at first_id.
+    """
+    rng = random.Random(seed)
+    ratings = _ratings(players, rng, rating_range)
+    scores = [0] * players
+    played = [set() for _ in range(players)]
+    records = []
+    for _ in range(rounds):
+        order = sorted(range(players), key=lambda i: (-scores[i], -ratings[i]))
+        while len(order) > 1:
+            player = order.pop(0)
+            opponent = next((i for i in order if i not in played[player]), order[0])
+            order.remove(opponent)
+            played[player].add(opponent)
+            played[opponent].add(player)
+            white, black = (player, opponent) if rng.random() < 0.5 else (opponent, player)
+            result = _play(ratings[white], ratings[black], rng)
+            scores[white] += result
+            scores[black] += 2 - result
+            records.append((first_id + white, first_id + black, result, ratings[white], ratings[black]))
+    return ['Player %d' % (first_id + i) for i in range(players)], records
+
+
+def random_records(players, games, seed=0, rating_range=(1800, 2700)):
+    """
+    Names and records of `games` games between random pairs of `players`
+    synthetic players, a large event with no pairing rules at all.
+    """
+    rng = random.Random(seed)
+    ratings = _ratings(players, rng, rating_range)
+    records = []
+    for _ in range(games):
+        white, black = rng.sample(range(players), 2)
+        records.append((white, black, _play(ratings[white], ratings[black], rng), ratings[white], ratings[black]))
+    return ['Player %d' % i for i in range(players)], records
+
+
+def archive_games(events, players, rounds, seed=0):
+    """
+    Games of a multi-event archive of Swisses as (event, white, black,
+    result, white_elo, black_elo) with names and PGN result strings. Events
+    share part of their players, as in a real archive.
+    """
+    games = []
+    for event in range(events):
+        # Consecutive events overlap by half of their players
+        first_id = event * players // 2
+        names, records = swiss_records(players, rounds, seed + event, first_id=first_id)
+        for white_id, black_id, result, white_elo, black_elo in records:
+            games.append(('Event %d' % event, names[white_id - first_id], names[black_id - first_id],
+                          RESULT_STRINGS[result], white_elo, black_elo))
+    return games
+
+
+def write_pgn(pgn_file_path, games):
+    """Write (event, white, black, result, white_elo, black_elo) games as PGN."""
+    with open(pgn_file_path, 'w') as f:
+        for event, white, black, result, white_elo, black_elo in games:
+            f.write('[Event "%s"]\n[Site "?"]\n[Date "????.??.??"]\n[Round "?"]\n'
+                    '[White "%s"]\n[Black "%s"]\n[Result "%s"]\n[WhiteElo "%d"]\n[BlackElo "%d"]\n\n'
+                    '1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 %s\n\n'
+                    % (event, white, black, result, white_elo, black_elo, result))
+
+
+def _best_time(function, repeat):
+    # Best of `repeat` runs, the least noisy estimate of the cost
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _process_seconds(statement, repeat):
+    # Best wall time of a fresh interpreter running statement in the repo
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=REPO_DIR, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_cold_start(repeat=5):
+    """
+    Time a fresh interpreter per COLD_START_STATEMENTS entry, as
+    {'cold_start/<name>': {'seconds': ..., 'total_seconds': ...}}, where
+    seconds excludes the startup of a bare interpreter. The closed-form
+    entry carries the COLD_START_BUDGET.
+    """
+    bare = _process_seconds('pass', repeat)
+    results = {}
+    for name, statement in COLD_START_STATEMENTS.items():
+        total = _process_seconds(statement, repeat)
+        results['cold_start/%s' % name] = {'seconds': max(total - bare, 0.0), 'total_seconds': total,
+                                           'interpreter_seconds': bare}
+    results['cold_start/closed_form']['budget'] = COLD_START_BUDGET
+    return results
+
+
+def over_budget(results):
+    """Names of the results that exceed their own 'budget'."""
+    return [name for name, result in results.items() if result['seconds'] > result.get('budget', float('inf'))]
+
+
+def _time_player_data(results, name, player_data, average_rating, repeat):
+    for performance_rating_type in ('standard', 'linear'):
+        for solver in SOLVERS:
+            solved, diagnostics = process_player_data(player_data, average_rating, performance_rating_type,
+                                                      max_iterations=MAX_ITERATIONS, solver=solver,
+                                                      return_diagnostics=True)
+            # The plain solver keeps the names of earlier baselines
+            key = ('process_player_data/%s/%s' % (performance_rating_type, name) if solver == 'plain'
+                   else 'pre_solver/%s/%s/%s' % (solver, performance_rating_type, name))
+            results[key] = {
+                'seconds': _best_time(lambda: process_player_data(player_data, average_rating,
+                                                                  performance_rating_type,
+                                                                  max_iterations=MAX_ITERATIONS, solver=solver),
+                                      repeat),
+                'players': len(solved),
+                'iterations': diagnostics.iterations,
+                'status': diagnostics.status,
+            }
+
+
+def run_benchmarks(quick=False, repeat=3):
+    """Run every benchmark and return {name: {'seconds': ..., ...}}."""
+    results = run_cold_start(max(repeat, 5))
+
+    # Fixed reference point
+    with tempfile.TemporaryDirectory() as pgn_dir:
+        shutil.copy(PALMA_PGN, pgn_dir)
+        results['process_pgn_files/palma'] = {'seconds': _best_time(lambda: process_pgn_files(pgn_dir), repeat)}
+        player_data, average_rating = process_pgn_files(pgn_dir)
+    _time_player_data(results, 'palma', player_data, average_rating, repeat)
+
+    for players in (QUICK_ROUND_ROBIN_SIZES if quick else ROUND_ROBIN_SIZES):
+        names, records = round_robin_records(players)
+        player_data, average_rating = build_player_data(records, {name: i for i, name in enumerate(names)})
+        _time_player_data(results, 'round-robin-%d' % players, player_data, average_rating, repeat)
+    for players, rounds in (QUICK_SWISS_SIZES if quick else SWISS_SIZES):
+        names, records = swiss_records(players, rounds)
+        player_data, average_rating = build_player_data(records, {name: i for i, name in enumerate(names)})
+        _time_player_data(results, 'swiss-%dx%d' % (players, rounds), player_data, average_rating, repeat)
+
+    for events, players, rounds in (QUICK_ARCHIVE_SIZES if quick else ARCHIVE_SIZES):
+        games = archive_games(events, players, rounds)
+        with tempfile.TemporaryDirectory() as pgn_dir:
+            # One file per event
+            for event in range(events):
+                write_pgn(os.path.join(pgn_dir, 'event%d.pgn' % event),
+                          [game for game in games if game[0] == 'Event %d' % event])
+            results['process_pgn_files/archive-%dx%dx%d' % (events, players, rounds)] = {
+                'seconds': _best_time(lambda: process_pgn_files(pgn_dir), repeat),
+                'games': len(games),
+            }
+
+    for games in OPTIMIZE_W_GAMES:
+        # Every score of n games, half points included, as from adjust_mn
+        scores = [(m, 2 * games) for m in range(2 * games + 1)]
+        results['optimize_w/n=%d' % games] = {
+            'seconds': _best_time(lambda: [optimize_w(m, n, 0.75) for m, n in scores], repeat),
+            'calls': len(scores),
+        }
+
+    rng = random.Random(0)
+    for n in (PERFECT_SCORE_GAMES[:2] if quick else PERFECT_SCORE_GAMES):
+        ratings = _ratings(n, rng, (2200, 2800))
+        results['perfect_score_pr/n=%d' % n] = {'seconds': _best_time(lambda: perfect_score_pr(ratings), repeat)}
+
+    fpr_queries = [(rng.randint(0, 18) / 2, 9, rng.randint(2200, 2800)) for _ in range(10000)]
+    results['calculate_FPR/10000'] = {
+        'seconds': _best_time(lambda: [calculate_FPR(m, n, b) for m, n, b in fpr_queries], repeat)}
+
+    # Table lookups of the batch ratings, over as many players
+    m, n, b = (np.array(column, dtype=np.float64) for column in zip(*fpr_queries))
+    for name, lookup in (('epr', epr_lookup), ('cpr', cpr_lookup), ('fpr', fpr_lookup)):
+        lookup(m, n, b)
+        results['%s_lookup/10000' % name] = {'seconds': _best_time(lambda: lookup(m, n, b), repeat)}
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(baseline, current, tolerance=0.25, min_seconds=0.001):
+    """
+    Compare two benchmark result dicts. Returns (lines, regressions): a
+    report line per benchmark and the names more than `tolerance` slower.
+    Slowdowns under min_seconds are timer noise and never flagged. Current
+    results over their budget are flagged as regressions as well.
+    """
+    lines = []
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        if name not in current or name not in baseline:
+            lines.append('%-50s %s' % (name, 'only in baseline' if name in baseline else 'new'))
+            continue
+        before, after = baseline[name]['seconds'], current[name]['seconds']
+        ratio = after / before if before else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance and after - before > min_seconds:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            flag = 'faster'
+        lines.append('%-50s %10.4fs %10.4fs %6.2fx %s' % (name, before, after, ratio, flag))
+    for name in over_budget(current):
+        lines.append('%-50s %10.4fs over the %.4fs budget' % (name, current[name]['seconds'], current[name]['budget']))
+        if name not in regressions:
+            regressions.append(name)
+    return lines, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the rating calculators.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="run the benchmarks and write JSON")
+    run_parser.add_argument('-o', '--output', default='benchmark.json')
+    run_parser.add_argument('--quick', action='store_true', help="smaller size sweeps")
+    run_parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark; the best is kept")
+    compare_parser = subparsers.add_parser('compare', help="flag regressions against a baseline")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.25,
+                                help="allowed slowdown, as a fraction of the baseline time")
+    compare_parser.add_argument('--min-seconds', type=float, default=0.001,
+                                help="slowdowns shorter than this are never flagged")
+    cold_start_parser = subparsers.add_parser('cold-start', help="time the imports only and check the budget")
+    cold_start_parser.add_argument('--repeat', type=int, default=10, help="runs per statement; the best is kept")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(args.quick, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+        for name, result in results.items():
+            print('%-50s %10.4fs' % (name, result['seconds']))
+        if over_budget(results):
+            print('over budget: %s' % ', '.join(over_budget(results)))
+            sys.exit(1)
+    elif args.command == 'cold-start':
+        results = run_cold_start(args.repeat)
+        print('%-50s %10.4fs' % ('interpreter startup', results['cold_start/closed_form']['interpreter_seconds']))
+        for name, result in results.items():
+            budget = ' (budget %.4fs)' % result['budget'] if 'budget' in result else ''
+            print('%-50s %10.4fs%s' % (name, result['seconds'], budget))
+        if over_budget(results):
+            print('over budget: %s' % ', '.join(over_budget(results)))
+            sys.exit(1)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        with open(args.current) as f:
+            current = json.load(f)['results']
+        lines, regressions = compare(baseline, current, args.tolerance, args.min_seconds)
+        print('\n'.join(lines))
+        if regressions:
+            print('%d regression(s)' % len(regressions))
+            sys.exit(1)
@@ -7,9 +7,21 @@ Calculate the Complete Performance Rating (CPR) and evaluate the best CPR for pe
 Functions:
     - calculate_cpr(m, n, e):
         Compute the CPR value given score m, games n, and average opponent rating e.
+    - calculate_cpr_batch(m, n, e):
+        calculate_cpr over NumPy arrays, broadcast together.
     - perfect_score_pr(ratings):
         For every non-empty subset of opponent ratings, assume a perfect score
         (m = size of subset, n = size of subset), compute CPR, and return the maximum CPR.
+        For a given subset size the best subset is always the highest rated
+        opponents, so only the n prefixes of the sorted ratings are checked: O(n log n).
+        Results are identical to the brute force for integer ratings; fractional
+        ratings may differ in the last bit, as the subset sums are added in another order.
+    - perfect_score_prs(ratings_lists):
+        perfect_score_pr for many players at once, vectorized with NumPy.
+        NumPy is only imported by the vectorized functions, so calculate_cpr
+        and perfect_score_pr need the standard library alone.
+    - perfect_score_pr_brute_force(ratings):
+        The original enumeration of all 2^n subsets, kept as a reference.
 """
 
 def calculate_cpr(m, n, e):
@@ -34,7 +46,23 @@ def calculate_cpr(m, n, e):
     return e - ((n+1)/n) * 400 * math.log10((n + 0.5 - m) / (m + 0.5))
 
 
-def perfect_score_pr(ratings):
+def calculate_cpr_batch(m, n, e):
+    """
+    Vectorized calculate_cpr for arrays of scores m, games n and average
+    opponent ratings e. Raises ValueError like calculate_cpr if any m is not
+    within [0, n] or any n is not positive.
+    """
+    import numpy as np
+    m, n, e = np.asarray(m, dtype=np.float64), np.asarray(n, dtype=np.float64), np.asarray(e, dtype=np.float64)
+    if np.any((m < 0) | (m > n)):
+        raise ValueError("Score m must be between 0 and n.")
+    if np.any(n <= 0):
+        raise ValueError("Number of games n must be positive.")
+
+    return e - ((n + 1) / n) * 400 * np.log10((n + 0.5 - m) / (m + 0.5))
+
+
+def perfect_score_pr_brute_force(ratings):
     if not ratings:
         raise ValueError("ratings list must contain at least one element")
 
@@ -52,6 +80,61 @@ def perfect_score_pr(ratings):
     return max_cpr
 
 
+def perfect_score_pr(ratings):
+    if len(ratings) == 0:
+        raise ValueError("ratings list must contain at least one element")
+
+    max_cpr = float('-inf')
+    subset_sum = 0
+
+    # The best subset of each size is the highest rated opponents
+    for size, rating in enumerate(sorted(ratings, reverse=True), 1):
+        subset_sum += rating
+        # Perfect score: m = n = size of subset
+        cpr = calculate_cpr(size, size, subset_sum / size)
+        max_cpr = max(max_cpr, cpr)
+
+    return max_cpr
+
+
+def _perfect_score_offsets(max_size):
+    # calculate_cpr(k, k, e) = e - offset[k - 1], computed with math.log10 so
+    # results are bit-for-bit those of perfect_score_pr
+    import numpy as np
+    return np.array([((k + 1) / k) * 400 * math.log10(0.5 / (k + 0.5)) for k in range(1, max_size + 1)])
+
+
+def perfect_score_prs(ratings_lists):
+    """
+    Vectorized perfect_score_pr over many players.
+
+    Parameters:
+        ratings_lists: A sequence of opponent rating lists (lengths may
+            differ), or a 2D array with one player per row.
+    Returns:
+        numpy.ndarray: The best perfect score CPR of each player.
+    """
+    import numpy as np
+    lengths = np.array([len(ratings) for ratings in ratings_lists], dtype=np.int64)
+    if len(lengths) == 0:
+        return np.empty(0)
+    if lengths.min() == 0:
+        raise ValueError("ratings list must contain at least one element")
+
+    # Pad to a rectangle and sort each row in descending order, padding last
+    width = int(lengths.max())
+    valid = np.arange(width) < lengths[:, None]
+    padded = np.full(valid.shape, -np.inf)
+    padded[valid] = np.concatenate([np.asarray(ratings, dtype=np.float64).ravel() for ratings in ratings_lists])
+    ordered = -np.sort(-padded, axis=1)
+    ordered[~valid] = 0
+
+    # Average of the top k opponents for every k, then the CPR of k out of k
+    averages = np.cumsum(ordered, axis=1) / np.arange(1, width + 1)
+    cprs = np.where(valid, averages - _perfect_score_offsets(width), -np.inf)
+    return cprs.max(axis=1)
+
+
 if __name__ == "__main__":
     # Example usage
     m, n, e = 9, 9, 2585
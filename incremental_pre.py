@@ -0,0 +1,146 @@
+"""
+Incremental Performance Rating Equilibrium (PRE):
+During a live event the PRE is recomputed after every round. IncrementalPRE
+keeps the player tables of the games seen so far, so an update only reads
+the new games, and then solves the PRE with the iteration of a cold
+recompute, from the initial ratings. Its results are those of
+process_player_data on every game so far.
+
+An equilibrium is only defined up to a common shift per connected component
+of the pairing graph, and the standard iteration settles on a shift that
+depends on its whole path, so a warm start from the last PRE ends up tens of
+points away from a cold recompute. A cold recompute also iterates every
+component until all of them have settled, so the components the new games
+do not touch are solved again with the rest.
+
+Example:
+    pre = IncrementalPRE('standard')
+    for round_file in round_files:
+        stats = pre.add_pgn(round_file)
+        print(stats['iterations'], stats['time'])
+    results = pre.results()
+"""
+
+import time
+import numpy as np
+from pgn_scanner import iter_game_records, UNFINISHED
+from performance_rating_equilibrium import solve_pre
+
+
+class IncrementalPRE:
+    def __init__(self, performance_rating_type='standard'):
+        self.performance_rating_type = performance_rating_type
+        # Name -> id, shared with pgn_scanner.iter_game_records
+        self.player_ids = {}
+        # Player id -> raw table as in collect_player_tables, in rank order
+        self._tables = {}
+        self._ratings_sum = 0
+        self._ratings_count = 0
+        self._tpr = {}
+        self._pre = {}
+
+    @property
+    def average_rating(self):
+        return int(self._ratings_sum / self._ratings_count) if self._ratings_count else 0
+
+    def _add_player(self, player_id, rating):
+        self._tables[player_id] = {'Rating': rating, 'Points': 0.0, 'opponents': [], 'results': []}
+
+    def add_records(self, records):
+        """
+        Add (white_id, black_id, result, white_elo, black_elo) game records,
+        with ids from `self.player_ids` (see pgn_scanner.iter_game_records),
+        and update the PRE.
+
+        Returns a dict with the number of finished 'games' added, 'players'
+        solved, solver 'iterations' and wall 'time' in seconds.
+        """
+        start_time = time.perf_counter()
+        average_rating = self.average_rating
+        games = 0
+
+        for white_id, black_id, result, white_rating, black_rating in records:
+            # Collect valid ratings
+            if white_rating > 0:
+                self._ratings_sum += white_rating
+                self._ratings_count += 1
+            if black_rating > 0:
+                self._ratings_sum += black_rating
+                self._ratings_count += 1
+
+            if result == UNFINISHED:
+                continue
+            white_result = result / 2
+            black_result = 1.0 - white_result
+
+            if white_id not in self._tables:
+                self._add_player(white_id, white_rating)
+            if black_id not in self._tables:
+                self._add_player(black_id, black_rating)
+            for player_id, opponent_id, points in ((white_id, black_id, white_result),
+                                                   (black_id, white_id, black_result)):
+                table = self._tables[player_id]
+                table['Points'] += points
+                table['opponents'].append(opponent_id)
+                table['results'].append(points)
+            games += 1
+
+        # Unrated players take the average rating, so a new average moves them
+        changed = games or (self.average_rating != average_rating and
+                            any(not table['Rating'] for table in self._tables.values()))
+        player_ids = list(self._tables) if changed else []
+        iterations = self._solve(player_ids) if player_ids else 0
+
+        return {'games': games, 'players': len(player_ids), 'iterations': iterations,
+                'time': time.perf_counter() - start_time}
+
+    def add_pgn(self, pgn_file_path, exact=False):
+        """Add every game of a PGN file, see `add_records`."""
+        return self.add_records(iter_game_records(pgn_file_path, self.player_ids, exact))
+
+    def _pairings(self, player_ids):
+        # CSR pairings in the form of build_pairings
+        local_ids = {player_id: i for i, player_id in enumerate(player_ids)}
+        tables = [self._tables[player_id] for player_id in player_ids]
+        counts = np.array([len(table['opponents']) for table in tables], dtype=np.int64)
+        cols = np.fromiter((local_ids[opponent_id] for table in tables for opponent_id in table['opponents']),
+                           dtype=np.int64, count=int(counts.sum()))
+        average_rating = self.average_rating
+        return {
+            'rows': np.repeat(np.arange(len(player_ids), dtype=np.int64), counts),
+            'cols': cols,
+            'indptr': np.concatenate(([0], np.cumsum(counts))),
+            'scores': np.array([sum(table['results']) for table in tables], dtype=np.float64),
+            'counts': counts,
+            'ratings': np.array([table['Rating'] or average_rating for table in tables], dtype=np.float64),
+        }
+
+    def _solve(self, player_ids):
+        # The iteration of a cold recompute, from the initial ratings
+        pairings = self._pairings(player_ids)
+        history = []
+        tpr, pre = solve_pre(pairings, self.performance_rating_type, history)
+        for i, player_id in enumerate(player_ids):
+            self._tpr[player_id] = tpr[i]
+            self._pre[player_id] = pre[i]
+        return len(history)
+
+    def results(self):
+        """
+        Player results keyed by name in rank order, with 'Rank', 'Name',
+        'Rating', 'Points', 'TPR' and 'PRE' (None where no PR exists).
+        """
+        names = list(self.player_ids)
+        average_rating = self.average_rating
+        results = {}
+        for rank, (player_id, table) in enumerate(self._tables.items(), 1):
+            tpr, pre = self._tpr[player_id], self._pre[player_id]
+            results[names[player_id]] = {
+                'Rank': rank,
+                'Name': names[player_id],
+                'Rating': table['Rating'] or average_rating,
+                'Points': table['Points'],
+                'TPR': None if np.isnan(tpr) else float(tpr),
+                'PRE': None if np.isnan(pre) else float(pre),
+            }
+        return results
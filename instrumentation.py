@@ -0,0 +1,290 @@
+"""
+Instrumentation hooks for ingestion, the PR calculations and the PRE solvers:
+Instrumented code reports timers (a name and seconds) and counters (a name
+and an amount) to every registered hook, a callable hook(event, name,
+value) with event 'time' or 'count'. Profiler is a hook that totals them
+and writes a JSON report, optionally alongside a cProfile dump.
+
+While no hook is registered ENABLED is False, timer() returns a shared
+no-op context manager and count() returns at once; hot loops test
+instrumentation.ENABLED before reading the clock, so instrumentation costs one
+attribute lookup per event and can stay in production code.
+
+Reported names:
+    pgn/games, pgn/bytes        games and PGN bytes read (scanner or python-chess)
+    pgn/read_game               every chess.pgn.read_game call (exact parsing)
+    pgn/ingest                  process_pgn_files
+    cache/hits, cache/misses    pgn_cache.RecordCache lookups
+    pre/pairings                building the pairing arrays
+    pr/root_scalar              scipy root_scalar calls of performance_rating
+    pr/performance_ratings      vectorized PR calls (a counter), and the
+    pr/newton_steps             Newton steps they took
+    solver/<name>               every PRE solve, its setup and each of its
+    solver/<name>/setup         iterations (calls are iterations)
+    solver/<name>/iteration
+    export/<format>             CSV or Parquet output
+    uncertainty/chunk           rating_uncertainty chunks, with their
+    uncertainty/replicates      replicates
+
+Worker processes report through pool_map, which every pool of the scripts
+goes through (see profiled_call); cProfile only covers the main process.
+
+Example:
+    with Profiler('pre.prof') as profiler:
+        main_pre(pgn_input_dir, 'standard')
+    profiler.write_report('pre_profile.json')
+
+Usage (any script, e.g. main.py):
+    python instrumentation.py -o report.json [--cprofile run.prof] main.py [ARGS ...]
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+ENABLED = False
+_hooks = []
+
+
+def add_hook(hook):
+    """Register hook(event, name, value), called for every timer and counter."""
+    global ENABLED
+    _hooks.append(hook)
+    ENABLED = True
+
+
+def remove_hook(hook):
+    global ENABLED
+    _hooks.remove(hook)
+    ENABLED = bool(_hooks)
+
+
+def count(name, amount=1):
+    if ENABLED:
+        for hook in _hooks:
+            hook('count', name, amount)
+
+
+def record_time(name, seconds):
+    if ENABLED:
+        for hook in _hooks:
+            hook('time', name, seconds)
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_time(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """Context manager reporting its duration as `name` (a no-op while disabled)."""
+    return _Timer(name) if ENABLED else NULL_TIMER
+
+
+class Profiler:
+    """
+    Hook that totals every timer (calls, total and largest seconds) and
+    counter while it is started, e.g. as a context manager. With
+    cprofile_path, the main process also runs under cProfile and the stats
+    are dumped there (pstats format; snakeviz or flameprof draw it as a
+    flame graph).
+    """
+
+    def __init__(self, cprofile_path=None):
+        self.cprofile_path = cprofile_path
+        self.counters = {}
+        self.timers = {}
+        self.wall_time = 0.0
+        self._started = None
+        self._cprofile = None
+
+    def __call__(self, event, name, value):
+        if event == 'count':
+            self.counters[name] = self.counters.get(name, 0) + value
+            return
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, value, value]
+        else:
+            timer[0] += 1
+            timer[1] += value
+            if value > timer[2]:
+                timer[2] = value
+
+    def start(self):
+        add_hook(self)
+        self._started = time.perf_counter()
+        if self.cprofile_path:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return self
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        self.wall_time += time.perf_counter() - self._started
+        remove_hook(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def state(self):
+        """Raw totals, to be merged into another Profiler."""
+        return {'counters': dict(self.counters), 'timers': {name: list(t) for name, t in self.timers.items()}}
+
+    def merge(self, state):
+        for name, amount in state['counters'].items():
+            self('count', name, amount)
+        for name, (calls, total, largest) in state['timers'].items():
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += total
+            timer[2] = max(timer[2], largest)
+
+    def report(self):
+        """Timers (slowest total first) and counters, as a JSON-ready dict."""
+        timers = {}
+        for name, (calls, total, largest) in sorted(self.timers.items(), key=lambda item: -item[1][1]):
+            timers[name] = {'calls': calls, 'total_seconds': total, 'mean_seconds': total / calls,
+                            'max_seconds': largest}
+        return {'wall_time': self.wall_time, 'timers': timers, 'counters': dict(sorted(self.counters.items())),
+                'cprofile': self.cprofile_path}
+
+    def write_report(self, report_path):
+        with open(report_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def profiled_call(function, task):
+    """
+    Run function(task) in a worker process under a fresh Profiler and
+    return (result, its state) for `collect` in the parent. Hooks inherited
+    from a forked parent are dropped, as they would report nowhere.
+    """
+    global ENABLED
+    del _hooks[:]
+    ENABLED = False
+    sys.setprofile(None)
+    with Profiler() as profiler:
+        result = function(task)
+    return result, profiler.state()
+
+
+def collect(result_state):
+    """Merge a worker's state from profiled_call into the hooks here and return its result."""
+    result, state = result_state
+    for hook in list(_hooks):
+        if isinstance(hook, Profiler):
+            hook.merge(state)
+        else:
+            for name, amount in state['counters'].items():
+                hook('count', name, amount)
+            for name, (_, total, _) in state['timers'].items():
+                hook('time', name, total)
+    return result
+
+
+def pool_map(function, tasks, jobs=None, bounded=False):
+    """
+    Like map over the list tasks, in order, but on a pool of jobs processes
+    (one per CPU for None) when there is more than one task. Workers send
+    their timers and counters back with every result. Small tasks are sent
+    in batches, about four per process; with bounded, tasks are sent one at
+    a time and at most 2 * jobs results are held.
+    """
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or len(tasks) <= 1:
+        yield from map(function, tasks)
+        return
+    result = lambda value: value
+    if ENABLED:
+        function, result = partial(profiled_call, function), collect
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        if not bounded:
+            # Batching small tasks keeps inter-process overhead down
+            batch = max(1, len(tasks) // (4 * jobs))
+            yield from map(result, executor.map(function, tasks, chunksize=batch))
+            return
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(function, task))
+            if len(pending) >= 2 * jobs:
+                yield result(pending.popleft().result())
+        while pending:
+            yield result(pending.popleft().result())
+
+
+def add_arguments(parser):
+    """The --profile and --cprofile options of the command line tools."""
+    parser.add_argument('--profile', metavar='REPORT.json', help="write a JSON report of timers and counters")
+    parser.add_argument('--cprofile', metavar='FILE.prof', help="also write a cProfile dump of the main process")
+
+
+@contextlib.contextmanager
+def profile_from_args(args):
+    """Profile the block if --profile or --cprofile was given."""
+    if not (args.profile or args.cprofile):
+        yield None
+        return
+    profiler = Profiler(args.cprofile).start()
+    try:
+        yield profiler
+    finally:
+        # Also on errors and sys.exit, where a profile is often wanted most
+        profiler.stop()
+        if args.profile:
+            profiler.write_report(args.profile)
+
+
+if __name__ == "__main__":
+    import argparse
+    import runpy
+    # Hooks must go on the module the script imports, not on this __main__
+    import instrumentation
+
+    parser = argparse.ArgumentParser(description="Run a script with the profiling hooks enabled.")
+    parser.add_argument('-o', '--profile', default='profile.json', metavar='REPORT.json',
+                        help="JSON report of timers and counters")
+    parser.add_argument('--cprofile', metavar='FILE.prof', help="also write a cProfile dump of the main process")
+    parser.add_argument('script')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    # Run the script as `python script ...` would
+    sys.argv = [args.script] + args.script_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    with instrumentation.profile_from_args(args):
+        runpy.run_path(args.script, run_name='__main__')
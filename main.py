@@ -1,8 +1,7 @@
-from pr_calculator import (calculate_win_probability, adjust_mn, optimize_w, calculate_EPR, 
-                            calculate_score_probability, calculate_TPR, 
-                            calculate_score_plus_probability, optimize_w_plus, calculate_FPR)
+# The closed-form calculators need only the standard library. The w* optimizer
+# (NumPy, SciPy) and PRE (also python-chess and pandas) are imported where used.
+from pr_calculator import calculate_win_probability, adjust_mn, calculate_EPR, calculate_TPR, calculate_FPR
 from calculate_cpr import calculate_cpr, perfect_score_pr
-from performance_rating_equilibrium import main_pre
 
 def main():
     B = 2705 # Average rating of the opponents
@@ -13,6 +12,7 @@ def main():
     # Calculate the win probability
     # print("Expected score:", calculate_win_probability(A, B))
 
+    from pr_calculator import optimize_w, calculate_score_probability
     m, n = adjust_mn(m, n)
     w_star = optimize_w(m, n, t)
     score_optimized_probability = calculate_score_probability(w_star, m, n)
@@ -27,8 +27,11 @@ def main():
     # performance_rating_type: input 'linear' or 'standard'. If it takes more than several minutes switch to linear as it's much faster.
     # performance_rating_type = 'standard'
     # pgn_input_dir = ''
-    # main_pre(csv_file_path, num_rounds)
+    # from performance_rating_equilibrium import main_pre
+    # main_pre(pgn_input_dir, performance_rating_type)
+    # To rate every player of every event in an archive, run batch_ratings.py instead
 
+    # from pr_calculator import optimize_w_plus, calculate_score_plus_probability
     # w_star_plus = optimize_w_plus(m, n, t)
     # EPR_plus = calculate_EPR(w_star_plus, B)
     # score_plus_optimized_probability = calculate_score_plus_probability(w_star_plus, m, n)
@@ -5,13 +5,30 @@ such that after scoring m_i points in n rounds, every player's initial rating
 r_i remains unchanged. PRE is the fixed point of the 'ratings' mapping. Numerically,
 the PRE can be calculated iteratively starting from the initial ratings and 
 updating initial ratings after each iteration.
+
+Usage:
+    python performance_rating_equilibrium.py PGN_DIR -o pre.csv --solver anderson --profile pre_profile.json
 """
 
-import pandas as pd
+import math
 import numpy as np
-from scipy.optimize import root_scalar
 import os
-import chess.pgn
+import instrumentation
+from pgn_scanner import iter_game_records, shard_pgn_files, UNFINISHED
+from pgn_cache import RecordCache, records_to_array
+from player_store import PlayerStore
+
+# Files larger than this many bytes are split into several shards
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+# Shard size cap for a PlayerStore, whose peak memory holds one shard's
+# records beside the columns
+COMPACT_CHUNK_SIZE = 1024 * 1024
+# Results of main_pre; players per exported chunk; rows printed at the end
+DEFAULT_OUTPUT_PATH = 'performance_rating_equilibrium.csv'
+DEFAULT_EXPORT_CHUNK_ROWS = 100000
+PRINT_ROWS = 60
+# Iterations after which the PRE solvers give up on PRs still moving
+DEFAULT_MAX_ITERATIONS = 1000
 
 def expected_score(opponent_ratings, own_rating):
     # Filter out None values from opponent_ratings
@@ -33,12 +50,14 @@ def performance_rating(opponent_ratings, score):
     if score == 0 or score == len(opponent_ratings):
         return round(complete_performance_rating(opponent_ratings, score), 1)
     else:
+        from scipy.optimize import root_scalar
         try:
-            result = root_scalar(
-                lambda r: expected_score(opponent_ratings, r) - score,
-                bracket=[1000, 4000],
-                method='brentq'
-            )
+            with instrumentation.timer('pr/root_scalar'):
+                result = root_scalar(
+                    lambda r: expected_score(opponent_ratings, r) - score,
+                    bracket=[1000, 4000],
+                    method='brentq'
+                )
             return round(result.root, 1) if result.converged else None
         except (ValueError, TypeError) as e:
             # Handle cases where the root-finding algorithm fails
@@ -57,210 +76,493 @@ def complete_performance_rating(opponent_ratings, score):
     average_opponent_rating = sum_term / k
     return average_opponent_rating - ((k+1)/k) * 400 * math.log10((k + 0.5 - score) / (score + 0.5))
 
-def process_pgn_files(pgn_input_dir):
-    player_data = {}
-    player_indices = {}
-    player_counter = 1  # To assign unique numbers to players
-    all_ratings = []
-
+def find_pgn_files(pgn_input_dir):
+    # All .pgn files under pgn_input_dir, in os.walk order
+    pgn_files = []
     for dirpath, dirnames, filenames in os.walk(pgn_input_dir):
         for filename in filenames:
             if filename.endswith('.pgn'):
-                pgn_file_path = os.path.join(dirpath, filename)
-                with open(pgn_file_path) as pgn:
-                    while True:
-                        game = chess.pgn.read_game(pgn)
-                        if game is None:
-                            break
-                        # Get the headers of the game
-                        white_player = game.headers.get('White', 'Unknown')
-                        black_player = game.headers.get('Black', 'Unknown')
-                        result_str = game.headers.get('Result', '*')
-                        white_rating = game.headers.get('WhiteElo', '0')
-                        black_rating = game.headers.get('BlackElo', '0')
-                        
-                        # Convert ratings to int
-                        try:
-                            white_rating = int(white_rating)
-                        except:
-                            white_rating = 0
-                        try:
-                            black_rating = int(black_rating)
-                        except:
-                            black_rating = 0
-
-                        # Collect valid ratings
-                        if white_rating > 0:
-                            all_ratings.append(white_rating)
-                        if black_rating > 0:
-                            all_ratings.append(black_rating)
-
-                        # Convert result string to numeric results
-                        if result_str == '1-0':
-                            white_result = 1.0
-                            black_result = 0.0
-                        elif result_str == '0-1':
-                            white_result = 0.0
-                            black_result = 1.0
-                        elif result_str == '1/2-1/2' or result_str == '½-½':
-                            white_result = 0.5
-                            black_result = 0.5
-                        else:
-                            # In case of unknown result
-                            continue
-
-                        # Assign unique numbers to players if not already assigned
-                        if white_player not in player_indices:
-                            player_indices[white_player] = player_counter
-                            player_counter += 1
-                        if black_player not in player_indices:
-                            player_indices[black_player] = player_counter
-                            player_counter += 1
-
-                        # Update white player's data
-                        if white_player not in player_data:
-                            player_data[white_player] = {
-                                'Rank': player_indices[white_player],
-                                'Name': white_player,
-                                'Rating': white_rating,
-                                'Points': 0.0,
-                                'opponents': [],
-                                'results': [],
-                                'opponent_ratings': [],
-                                'opponent_nums': [],
-                                'PRs': []  # For storing PRs in iterations
-                            }
-                        player_data[white_player]['Points'] += white_result
-                        player_data[white_player]['opponents'].append(black_player)
-                        player_data[white_player]['results'].append(white_result)
-                        player_data[white_player]['opponent_ratings'].append(black_rating)
-                        player_data[white_player]['opponent_nums'].append(player_indices[black_player])
-
-                        # Update black player's data
-                        if black_player not in player_data:
-                            player_data[black_player] = {
-                                'Rank': player_indices[black_player],
-                                'Name': black_player,
-                                'Rating': black_rating,
-                                'Points': 0.0,
-                                'opponents': [],
-                                'results': [],
-                                'opponent_ratings': [],
-                                'opponent_nums': [],
-                                'PRs': []
-                            }
-                        player_data[black_player]['Points'] += black_result
-                        player_data[black_player]['opponents'].append(white_player)
-                        player_data[black_player]['results'].append(black_result)
-                        player_data[black_player]['opponent_ratings'].append(white_rating)
-                        player_data[black_player]['opponent_nums'].append(player_indices[white_player])
-
+                pgn_files.append(os.path.join(dirpath, filename))
+    return pgn_files
+
+def _new_player(rating):
+    return {
+        'Rating': rating,
+        'Points': 0.0,
+        'opponents': [],
+        'results': [],
+        'opponent_ratings': []
+    }
+
+def collect_player_tables(records):
+    """
+    Collect raw per-player tables from (white_id, black_id, result, white_elo,
+    black_elo) game records (see pgn_scanner.iter_game_records).
+
+    Returns (tables, ratings_sum, ratings_count): tables maps player id to
+    their games, in order of each player's first finished game, with
+    opponents as ids and ratings as read. The sum and count of valid ratings
+    cover every game, finished or not.
+    """
+    tables = {}
+    ratings_sum = 0
+    ratings_count = 0
+
+    for white_id, black_id, result, white_rating, black_rating in records:
+        # Collect valid ratings
+        if white_rating > 0:
+            ratings_sum += white_rating
+            ratings_count += 1
+        if black_rating > 0:
+            ratings_sum += black_rating
+            ratings_count += 1
+
+        if result == UNFINISHED:
+            # In case of unknown result
+            continue
+        white_result = result / 2
+        black_result = 1.0 - white_result
+
+        if white_id not in tables:
+            tables[white_id] = _new_player(white_rating)
+        if black_id not in tables:
+            tables[black_id] = _new_player(black_rating)
+        white_data = tables[white_id]
+        black_data = tables[black_id]
+
+        white_data['Points'] += white_result
+        white_data['opponents'].append(black_id)
+        white_data['results'].append(white_result)
+        white_data['opponent_ratings'].append(black_rating)
+
+        black_data['Points'] += black_result
+        black_data['opponents'].append(white_id)
+        black_data['results'].append(black_result)
+        black_data['opponent_ratings'].append(white_rating)
+
+    return tables, ratings_sum, ratings_count
+
+def merge_player_tables(partials):
+    """
+    Merge partial player tables, each (names, tables, ratings_sum,
+    ratings_count) with tables keyed by index into names, into one of the
+    same form. Partials are merged in order, so players and games keep the
+    order they would have if every game had been read in one pass.
+    """
+    player_ids = {}
+    merged = {}
+    ratings_sum = 0
+    ratings_count = 0
+
+    for names, tables, partial_sum, partial_count in partials:
+        ids = [player_ids.setdefault(name, len(player_ids)) for name in names]
+        for local_id, table in tables.items():
+            player_id = ids[local_id]
+            if player_id not in merged:
+                merged[player_id] = _new_player(table['Rating'])
+            data = merged[player_id]
+            data['Points'] += table['Points']
+            data['opponents'].extend([ids[opponent_id] for opponent_id in table['opponents']])
+            data['results'].extend(table['results'])
+            data['opponent_ratings'].extend(table['opponent_ratings'])
+        ratings_sum += partial_sum
+        ratings_count += partial_count
+
+    return list(player_ids), merged, ratings_sum, ratings_count
+
+def finish_player_data(names, tables, ratings_sum, ratings_count):
+    """
+    Turn raw player tables into the name-keyed player_data used by
+    process_player_data, numbering players by first appearance and filling
+    missing ratings with the average rating.
+    """
     # After processing all games, compute average rating
-    average_rating = int(sum(all_ratings) / len(all_ratings)) if all_ratings else 0
+    average_rating = int(ratings_sum / ratings_count) if ratings_count else 0
+
+    # Assign unique numbers to players in order of appearance
+    ranks = {player_id: rank for rank, player_id in enumerate(tables, 1)}
 
-    # Now, set missing or None ratings to average_rating
-    for player in player_data:
-        if not player_data[player]['Rating'] or player_data[player]['Rating'] == 0:
-            player_data[player]['Rating'] = average_rating
-        # Update opponent ratings where ratings are zero or None
-        player_data[player]['opponent_ratings'] = [
-            rating if rating else average_rating for rating in player_data[player]['opponent_ratings']
-        ]
+    player_data = {}
+    for player_id, data in tables.items():
+        name = names[player_id]
+        player_data[name] = {
+            'Rank': ranks[player_id],
+            'Name': name,
+            # Set missing or None ratings to average_rating
+            'Rating': data['Rating'] or average_rating,
+            'Points': data['Points'],
+            'opponents': [names[opponent_id] for opponent_id in data['opponents']],
+            'results': data['results'],
+            # Update opponent ratings where ratings are zero or None
+            'opponent_ratings': [rating or average_rating for rating in data['opponent_ratings']],
+            'opponent_nums': [ranks[opponent_id] for opponent_id in data['opponents']]
+        }
 
     return player_data, average_rating
 
-def process_player_data(player_data, average_rating, performance_rating_type):
-    # Remove players with no games
-    player_data = {player: data for player, data in player_data.items() if len(data['opponents']) > 0}
+def build_player_data(records, player_ids):
+    """
+    Build player_data from game records in a single pass. `player_ids` maps
+    names to the ids used in the records and may still be growing while
+    `records` is consumed.
+    """
+    tables, ratings_sum, ratings_count = collect_player_tables(records)
+    return finish_player_data(list(player_ids), tables, ratings_sum, ratings_count)
+
+def read_player_tables(shard):
+    """
+    Partial player tables (see merge_player_tables) for one
+    (pgn_file_path, byte_range, exact) shard. Runs in the worker processes.
+    """
+    pgn_file_path, byte_range, exact = shard
+    player_ids = {}
+    tables, ratings_sum, ratings_count = collect_player_tables(
+        iter_game_records(pgn_file_path, player_ids, exact, byte_range))
+    return list(player_ids), tables, ratings_sum, ratings_count
+
+def read_shard_records(shard):
+    """Player names and RECORD_DTYPE game array for one shard."""
+    pgn_file_path, byte_range, exact = shard
+    player_ids = {}
+    games = records_to_array(iter_game_records(pgn_file_path, player_ids, exact, byte_range))
+    return list(player_ids), games
+
+def _cached_records(pgn_files, exact, workers, chunk_size, cache):
+    # Names and games per file, parsing only files the cache lacks
+    cached = {pgn_file_path: cache.load(pgn_file_path, exact) for pgn_file_path in pgn_files}
+    shards = shard_pgn_files([path for path in pgn_files if cached[path] is None], exact, chunk_size)
+
+    # Join each file's shards back into one set of file-level records
+    parsed = {}
+    for shard, (names, games) in zip(shards, instrumentation.pool_map(read_shard_records, shards, workers)):
+        player_ids, parts = parsed.setdefault(shard[0], ({}, []))
+        ids = np.array([player_ids.setdefault(name, len(player_ids)) for name in names], dtype=np.int32)
+        games['white'] = ids[games['white']]
+        games['black'] = ids[games['black']]
+        parts.append(games)
+    for pgn_file_path, (player_ids, parts) in parsed.items():
+        cached[pgn_file_path] = list(player_ids), np.concatenate(parts)
+        cache.store(pgn_file_path, *cached[pgn_file_path], exact=exact)
+    cache.save()
+
+    for pgn_file_path in pgn_files:
+        yield cached[pgn_file_path]
+
+def _cached_partials(pgn_files, exact, workers, chunk_size, cache):
+    # Partial player tables per file, parsing only files the cache lacks
+    for names, games in _cached_records(pgn_files, exact, workers, chunk_size, cache):
+        yield (names, *collect_player_tables(games.tolist()))
+
+def _player_store(pgn_files, exact, workers, chunk_size, cache):
+    if cache is not None:
+        parts = _cached_records(pgn_files, exact, workers, chunk_size, cache)
+    else:
+        shards = shard_pgn_files(pgn_files, exact, min(chunk_size, COMPACT_CHUNK_SIZE))
+        parts = instrumentation.pool_map(read_shard_records, shards, workers)
+    store = PlayerStore.from_parts(parts)
+    return store, store.average_rating
+
+def process_pgn_files(pgn_input_dir, exact=False, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, cache=None,
+                      compact=False):
+    """
+    Read the headers of every game under pgn_input_dir and build the player
+    tables. Move text is skipped by the byte-level scanner in pgn_scanner;
+    exact=True reads the headers through python-chess instead.
+
+    Files are sharded, and files larger than chunk_size bytes are split into
+    byte ranges at [Event tags. With workers > 1 (or None for one per CPU)
+    the shards are read by a process pool; the partial tables are merged in
+    shard order, so the result is identical to the serial one.
+
+    With a pgn_cache.RecordCache, files whose records are cached are not
+    read at all, and the records of every other file are added to the cache.
+
+    With compact=True the players come back as a player_store.PlayerStore
+    instead of name-keyed dicts, a tenth of the memory or less. Uncached
+    files are then read in shards of at most COMPACT_CHUNK_SIZE bytes.
+    """
+    pgn_files = find_pgn_files(pgn_input_dir)
+    with instrumentation.timer('pgn/ingest'):
+        if compact:
+            return _player_store(pgn_files, exact, workers, chunk_size, cache)
+        if cache is not None:
+            partials = _cached_partials(pgn_files, exact, workers, chunk_size, cache)
+        else:
+            shards = shard_pgn_files(pgn_files, exact, chunk_size)
+            partials = instrumentation.pool_map(read_player_tables, shards, workers)
+        return finish_player_data(*merge_player_tables(partials))
+
+# Bracket used by the standard performance rating, as in `performance_rating`
+PR_BRACKET = (1000.0, 4000.0)
+LOG10_OVER_400 = math.log(10) / 400
+
+def build_pairings(player_data):
+    """
+    Map players to integer ids once and flatten their games into arrays.
+
+    Returns the player names in id order and a dict of NumPy arrays:
+    'rows' and 'cols' hold (player id, opponent id) for every game a player
+    played, sorted by player id, with 'indptr' marking where each player's
+    games start (CSR form of the pairing matrix), and 'scores', 'counts' and
+    'ratings' are indexed by player id. Every player must have a game.
+
+    Pairings may also hold 'weights', one per game like 'cols', to count
+    games unequally (see season_ratings); 'scores' and 'counts' are then
+    the weighted sums of each player's points and games.
+    """
+    names = list(player_data)
+    ids = {name: i for i, name in enumerate(names)}
+    counts = np.fromiter((len(data['opponents']) for data in player_data.values()),
+                         dtype=np.int64, count=len(names))
+    rows = np.repeat(np.arange(len(names), dtype=np.int64), counts)
+    cols = np.fromiter((ids[opp_name] for data in player_data.values() for opp_name in data['opponents']),
+                       dtype=np.int64, count=int(counts.sum()))
+    scores = np.fromiter((sum(data['results']) for data in player_data.values()),
+                         dtype=np.float64, count=len(names))
+    ratings = np.fromiter((data['Rating'] for data in player_data.values()),
+                          dtype=np.float64, count=len(names))
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    pairings = {'rows': rows, 'cols': cols, 'indptr': indptr,
+                'scores': scores, 'counts': counts, 'ratings': ratings}
+    return names, pairings
+
+def _segment_sum(values, indptr):
+    # Sum of each player's games; segments are never empty
+    return np.add.reduceat(values, indptr[:-1])
+
+def _round(values, decimals):
+    return values if decimals is None else np.round(values, decimals)
+
+def performance_ratings(indptr, rows, opponent_ratings, scores, counts, start=None, tol=1e-9, max_steps=100,
+                        decimals=1, weights=None):
+    """
+    Vectorized `performance_rating` for every player at once.
+
+    Solves expected score == actual score for all players together with a
+    Newton step safeguarded by bisection inside PR_BRACKET. Zero and perfect
+    scores use the CPR formula. Players whose root lies outside the bracket
+    get NaN, where `performance_rating` would return None. PRs are rounded
+    to `decimals` places, as by `performance_rating`; None leaves them as is.
+    With per-game `weights`, expected scores are weighted sums like the
+    weighted scores and counts.
+    """
+    num_players = len(scores)
+    lo = np.full(num_players, PR_BRACKET[0])
+    hi = np.full(num_players, PR_BRACKET[1])
+
+    def expected(x):
+        with np.errstate(over='ignore'):
+            p = 1 / (1 + np.exp((opponent_ratings - x[rows]) * LOG10_OVER_400))
+        if weights is not None:
+            return _segment_sum(weights * p, indptr), _segment_sum(weights * p * (1 - p), indptr)
+        return _segment_sum(p, indptr), _segment_sum(p * (1 - p), indptr)
+
+    # Mirror brentq: no sign change over the bracket means no root
+    f_lo, _ = expected(lo)
+    f_hi, _ = expected(hi)
+    solvable = (f_lo - scores <= 0) & (f_hi - scores >= 0)
+    extreme = (scores == 0) | (scores == counts)
+    active = solvable & ~extreme
+
+    x = np.clip(lo if start is None else start, lo, hi)
+    step = -1
+    for step in range(max_steps):
+        e, de = expected(x)
+        f = e - scores
+        lo = np.where(f < 0, x, lo)
+        hi = np.where(f > 0, x, hi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_new = x - f / (de * LOG10_OVER_400)
+        # Fall back to bisection when Newton leaves the bracket
+        outside = ~((x_new >= lo) & (x_new <= hi))
+        x_new[outside] = (lo[outside] + hi[outside]) / 2
+        x_new[~active] = x[~active]
+        done = np.all(np.abs(x_new - x) < tol)
+        x = x_new
+        if done:
+            break
+    if instrumentation.ENABLED:
+        instrumentation.count('pr/performance_ratings')
+        instrumentation.count('pr/newton_steps', step + 1)
+
+    new_pr = np.where(solvable, _round(x, decimals), np.nan)
 
-    converged = False
-    iteration = 1
+    # if score is 0 or perfect score, then ask CPR
+    if extreme.any():
+        if weights is not None:
+            opponent_ratings = weights * opponent_ratings
+        average_opponent_rating = _segment_sum(opponent_ratings, indptr) / counts
+        k, m = counts[extreme], scores[extreme]
+        cpr = average_opponent_rating[extreme] - ((k + 1) / k) * 400 * np.log10((k + 0.5 - m) / (m + 0.5))
+        new_pr[extreme] = _round(cpr, decimals)
+    return new_pr
+
+def linear_performance_ratings(indptr, opponent_ratings, scores, counts, weights=None):
+    """Vectorized `linear_performance_rating` for every player at once, optionally with per-game weights."""
+    sum_term = _segment_sum(opponent_ratings if weights is None else weights * opponent_ratings, indptr)
+    return sum_term / counts + 800 * (scores / counts) - 400
+
+def pr_step(pairings, performance_rating_type, current, decimals=1):
+    """
+    One application of the ratings mapping: every player's PR on `pairings`
+    when opponents are rated `current`. Standard PRs are rounded to
+    `decimals` places (None for no rounding); linear PRs never are.
+    """
+    indptr, rows, cols = pairings['indptr'], pairings['rows'], pairings['cols']
+    scores, counts = pairings['scores'], pairings['counts']
+    opponent_ratings = current[cols]
+    weights = pairings.get('weights')
+    if performance_rating_type == 'linear':
+        return linear_performance_ratings(indptr, opponent_ratings, scores, counts, weights)
+    return performance_ratings(indptr, rows, opponent_ratings, scores, counts, start=current, decimals=decimals,
+                               weights=weights)
+
+def solve_pre(pairings, performance_rating_type, history=None, start=None, max_iterations=DEFAULT_MAX_ITERATIONS):
+    """
+    Iterate the ratings mapping on `pairings` (see `build_pairings`) until
+    every rounded PR stops changing. Returns the first-iteration PRs (TPR) and
+    the equilibrium PRs (PRE) as arrays; NaN marks a PR that could not be
+    computed. If `history` is a list, every iteration's PRs are appended to it.
+    With `start`, iteration begins from those ratings instead of the initial
+    ones, and the first returned array is no longer the TPR.
+
+    Some events have no equilibrium (e.g. when every score is zero or
+    perfect, the CPRs drift apart forever). Iteration stops after
+    max_iterations (None for no limit) and PRs still changing are NaN.
+    """
+    # The iteration itself lives with the other solvers, which build on this module
+    from pre_solvers import plain_iteration
+    first_pr, final_pr, _ = plain_iteration(pairings, performance_rating_type, max_iterations=max_iterations,
+                                            start=start, history=history)
+    return first_pr, final_pr
+
+def process_player_data(player_data, average_rating, performance_rating_type, keep_history=False,
+                        max_iterations=DEFAULT_MAX_ITERATIONS, solver='plain', tol=None, return_diagnostics=False):
+    """
+    Compute every player's TPR and PRE (and with keep_history, the PRs of
+    every iteration) with one of the pre_solvers.SOLVERS. With
+    return_diagnostics, returns (player_data, SolverDiagnostics).
+
+    player_data may also be a PlayerStore, which gets the PRs as arrays
+    (`tpr`, `pre` and `history`) and is returned.
+    """
+    from pre_solvers import solve, SolverDiagnostics
+
+    if isinstance(player_data, PlayerStore):
+        history = [] if keep_history else None
+        diagnostics = SolverDiagnostics(solver)
+        if len(player_data):
+            with instrumentation.timer('pre/pairings'):
+                pairings = player_data.pairings()
+            player_data.tpr, player_data.pre, diagnostics = solve(pairings, performance_rating_type, solver, tol,
+                                                                  max_iterations, history=history)
+        player_data.history = history
+        return (player_data, diagnostics) if return_diagnostics else player_data
 
-    while not converged:
-        # Create a mapping from player names to their PRs
-        if iteration == 1:
-            # First iteration uses initial ratings
-            pr_map = {player: data['Rating'] for player, data in player_data.items()}
-        else:
-            # Subsequent iterations use the previous iteration's PRs
-            pr_map = {player: data['PRs'][-1] if data['PRs'][-1] is not None else data['Rating']
-                      for player, data in player_data.items()}
-
-        converged = True  # Assume convergence, check if any PR changes
-
-        # Recalculate PRs for each player
-        for player, data in player_data.items():
-            opponent_ratings = []
-            for opp_name in data['opponents']:
-                # Get opponent's PR or fallback to their initial rating
-                opponent_pr = pr_map.get(opp_name, player_data[opp_name]['Rating'])
-                if opponent_pr is None:
-                    # If still None, use average_rating
-                    opponent_pr = average_rating
-                opponent_ratings.append(opponent_pr)
-
-            m = sum(data['results'])  # Total score
-
-            # Calculate new PR
-            if performance_rating_type == 'linear':
-                new_pr = linear_performance_rating(opponent_ratings, m)
-            else:
-                new_pr = performance_rating(opponent_ratings, m)
-
-            # Check for convergence
-            if iteration == 1:
-                # No previous PR to compare
-                data['PRs'].append(new_pr)
-                converged = False  # Need at least two iterations
-            else:
-                previous_pr = data['PRs'][-1]
-                data['PRs'].append(new_pr)
-                if new_pr is None or previous_pr is None:
-                    converged = False
-                elif round(new_pr) != round(previous_pr):
-                    converged = False  # PR changed, so not yet converged
-
-        if not converged:
-            iteration += 1
-
-    return player_data
+    # Remove players with no games
+    player_data = {player: data for player, data in player_data.items() if len(data['opponents']) > 0}
+    if not player_data:
+        return (player_data, SolverDiagnostics(solver)) if return_diagnostics else player_data
+
+    with instrumentation.timer('pre/pairings'):
+        names, pairings = build_pairings(player_data)
+    history = [] if keep_history else None
+    first_pr, final_pr, diagnostics = solve(pairings, performance_rating_type, solver, tol, max_iterations,
+                                            history=history)
+
+    # Store TPR (first iteration) and PRE (fixed point); None where no PR exists
+    for i, player in enumerate(names):
+        data = player_data[player]
+        data['TPR'] = None if np.isnan(first_pr[i]) else float(first_pr[i])
+        data['PRE'] = None if np.isnan(final_pr[i]) else float(final_pr[i])
+        if keep_history:
+            data['PRs'] = [None if np.isnan(prs[i]) else float(prs[i]) for prs in history]
+
+    return (player_data, diagnostics) if return_diagnostics else player_data
+
+def export_frames(store, chunk_rows=DEFAULT_EXPORT_CHUNK_ROWS, history=False):
+    """
+    The Rank, Name, Rating, Points, TPR and PRE (rounded, blank where
+    missing) of the players of a processed PlayerStore, as DataFrames of
+    chunk_rows players. With history, also the PRs of every iteration as
+    PR_1, PR_2, ... (process_player_data with keep_history).
+    """
+    import pandas as pd
+
+    for start in range(0, len(store), chunk_rows):
+        names = store.names[start:start + chunk_rows]
+        players = slice(start, start + len(names))
+        frame = pd.DataFrame({
+            'Rank': np.arange(players.start, players.stop) + 1,
+            'Name': names,
+            'Rating': store.ratings[players].astype(np.int64),
+            'Points': store.points[players],
+            'TPR': pd.array(np.round(store.tpr[players])).astype('Int64'),
+            'PRE': pd.array(np.round(store.pre[players])).astype('Int64'),
+        }, index=pd.RangeIndex(players.start, players.stop))
+        if history:
+            for iteration, prs in enumerate(store.history or [], 1):
+                frame['PR_%d' % iteration] = prs[players]
+        yield frame
 
 # Main function to read PGN, process data, and export
-def main_pre(pgn_input_dir, performance_rating_type):
-    # Process PGN files
-    player_data, average_rating = process_pgn_files(pgn_input_dir)
+def main_pre(pgn_input_dir, performance_rating_type, cache_dir=None, output_path=DEFAULT_OUTPUT_PATH,
+             output_format=None, sort_by='Points', top=None, history=False, chunk_rows=DEFAULT_EXPORT_CHUNK_ROWS,
+             solver='plain', max_iterations=DEFAULT_MAX_ITERATIONS):
+    """
+    Rate the PGN files of pgn_input_dir and export every player's TPR and
+    PRE to output_path (CSV, Parquet or JSON Lines, see result_export),
+    ranked by sort_by (None keeps player order; top keeps the best rows).
+    With history, the PRs of every iteration are exported too. The PRE is
+    solved with one of the pre_solvers.SOLVERS; PRs still moving after
+    max_iterations are left empty. Prints the first rows and returns the
+    number of rows written.
+    """
+    from result_export import open_writer
+
+    # Process PGN files, reusing the records cached in cache_dir if given
+    cache = RecordCache(cache_dir) if cache_dir else None
+    store, average_rating = process_pgn_files(pgn_input_dir, cache=cache, compact=True)
 
     # Process player data with iterative PR calculations until convergence
-    player_data = process_player_data(player_data, average_rating, performance_rating_type)
-
-    # Prepare data for CSV export
-    export_data = []
-    for player, data in player_data.items():
-        row = {
-            'Rank': data['Rank'],
-            'Name': player,
-            'Rating': data['Rating'],
-            'Points': data['Points'],
-            'TPR': round(data['PRs'][0]),
-            'PRE': round(data['PRs'][-1]),
-        }
-        export_data.append(row)
-
-    # Convert to DataFrame
-    export_df = pd.DataFrame(export_data)
-
-    # Sort by Points
-    export_df = export_df.sort_values(by='Points', ascending=False)
+    store = process_player_data(store, average_rating, performance_rating_type, keep_history=history,
+                                max_iterations=max_iterations, solver=solver)
 
-    # Export to CSV
-    output_csv_path = 'performance_rating_equilibrium.csv'
-    export_df.to_csv(output_csv_path, index=False)
+    # Export the rows in chunks, ranked with bounded memory
+    with open_writer(output_path, output_format, sort_by=sort_by, top=top, preview_rows=PRINT_ROWS) as writer:
+        for frame in export_frames(store, chunk_rows, history):
+            writer.write(frame)
 
-    # Print the DataFrame
-    print(export_df)
+    # Print the first rows
+    print(writer.preview)
+    return writer.rows
 
 if __name__ == "__main__":
-    # performance_rating_type: input 'linear' or 'standard'. If it takes more than several minutes switch to linear as it's much faster.
-    performance_rating_type = 'standard'
-    pgn_input_dir = ''
-    main_pre(pgn_input_dir, performance_rating_type)
+    import argparse
+    from pre_solvers import SOLVERS
+    from result_export import FORMATS
+
+    parser = argparse.ArgumentParser(description="TPR and PRE of every player in a directory of PGN files.")
+    parser.add_argument('pgn_input_dir')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT_PATH,
+                        help="output .csv, .parquet (needs pyarrow) or .jsonl file")
+    parser.add_argument('--format', choices=FORMATS, help="output format; default from the extension")
+    parser.add_argument('--performance-rating-type', choices=['standard', 'linear'], default='standard',
+                        help="if standard takes more than several minutes switch to linear, it is much faster")
+    parser.add_argument('--cache-dir', help="reuse the game records cached here (see pgn_cache)")
+    parser.add_argument('--sort-by', choices=['Rating', 'Points', 'TPR', 'PRE'], default='Points',
+                        help="rank the rows by this column, best first")
+    parser.add_argument('--top', type=int, help="write only this many rows")
+    parser.add_argument('--history', action='store_true', help="also export the PRs of every iteration")
+    parser.add_argument('--max-iterations', type=int, default=DEFAULT_MAX_ITERATIONS,
+                        help="PRs still moving after this many iterations are left empty")
+    parser.add_argument('--solver', choices=list(SOLVERS), default='plain',
+                        help="PRE solver; on slowly converging Swisses anderson and newton can save up to "
+                             "half of the plain iterations (two thirds for linear PRs)")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.profile_from_args(args):
+        main_pre(args.pgn_input_dir, args.performance_rating_type, cache_dir=args.cache_dir, output_path=args.output,
+                 output_format=args.format, sort_by=args.sort_by, top=args.top, history=args.history,
+                 solver=args.solver, max_iterations=args.max_iterations)
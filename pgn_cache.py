@@ -0,0 +1,186 @@
+"""
+Persistent cache of the game records extracted from PGN files:
+Each file's (white_id, black_id, result, white_elo, black_elo) records are
+stored in one entry file: the player names as JSON followed by a raw
+RECORD_DTYPE array, which is read straight from a memory map without being
+copied or parsed. Entries are keyed by the file's path, size and
+modification time, backed by a hash of its content, so unchanged files are
+never parsed again and a touched but identical file is recognised by its hash.
+
+Classes:
+    - RecordCache(cache_dir, max_bytes):
+        load/store records per PGN file, LRU eviction above max_bytes, and
+        invalidate for explicit removal.
+
+Run `python pgn_cache.py invalidate [--cache-dir DIR] [PGN ...]` to drop the
+entries of the given files, or of every file when none are given.
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import time
+import numpy as np
+import instrumentation
+
+RECORD_DTYPE = np.dtype([('white', '<i4'), ('black', '<i4'), ('result', 'i1'),
+                         ('white_elo', '<i4'), ('black_elo', '<i4')])
+# Entry layout: names length (8 bytes), names JSON, padding to 8 bytes, games
+NAMES_LENGTH_BYTES = 8
+DEFAULT_CACHE_DIR = '.pre_cache'
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def records_to_array(records):
+    """Pack game records into a RECORD_DTYPE array."""
+    return np.fromiter(records, dtype=RECORD_DTYPE)
+
+
+def file_digest(pgn_file_path):
+    """Hash of the file's content."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(pgn_file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RecordCache:
+    """
+    On-disk cache of game records, one entry per distinct file content and
+    reader mode. The index maps each PGN path to its last seen size, mtime
+    and entry; entries carry their size and last use for LRU eviction.
+    Call `save()` after a run to persist the index and apply the size cap.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        self.files = index.get('files', {})
+        self.entries = index.get('entries', {})
+        self._digests = {}  # Content hashes computed on a miss, reused by store
+
+    def _entry_path(self, entry):
+        return os.path.join(self.cache_dir, entry + '.rec')
+
+    def _lookup(self, pgn_file_path, exact):
+        path = os.path.abspath(pgn_file_path)
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns \
+                and known['exact'] == exact and known['entry'] in self.entries:
+            return known['entry']
+
+        # Size or mtime changed: the content decides
+        digest = self._digests[path] = file_digest(path)
+        entry = digest + ('-exact' if exact else '')
+        self.files[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'exact': exact, 'entry': entry}
+        return entry if entry in self.entries else None
+
+    def load(self, pgn_file_path, exact=False):
+        """
+        Return (names, games) for the file, games memory-mapped, or None if
+        the file has no valid entry.
+        """
+        entry = self._lookup(pgn_file_path, exact)
+        if entry is None:
+            instrumentation.count('cache/misses')
+            return None
+        try:
+            with open(self._entry_path(entry), 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            names_length = int.from_bytes(buf[:NAMES_LENGTH_BYTES], 'little')
+            names_end = NAMES_LENGTH_BYTES + names_length
+            names = json.loads(buf[NAMES_LENGTH_BYTES:names_end].decode('utf-8'))
+            games = np.frombuffer(buf, dtype=RECORD_DTYPE, offset=-(-names_end // 8) * 8)
+        except (OSError, ValueError):
+            # Entry removed or damaged behind our back
+            del self.entries[entry]
+            instrumentation.count('cache/misses')
+            return None
+        self.entries[entry]['last_used'] = time.time()
+        instrumentation.count('cache/hits')
+        return names, games
+
+    def store(self, pgn_file_path, names, games, exact=False):
+        """Store the file's names and RECORD_DTYPE games array."""
+        path = os.path.abspath(pgn_file_path)
+        if path not in self._digests:
+            self._lookup(path, exact)
+        entry = self._digests[path] + ('-exact' if exact else '')
+        entry_path = self._entry_path(entry)
+
+        names_json = json.dumps(names, ensure_ascii=False).encode('utf-8')
+        header = len(names_json).to_bytes(NAMES_LENGTH_BYTES, 'little') + names_json
+        header += b'\0' * (-len(header) % 8)
+        games = np.ascontiguousarray(games, dtype=RECORD_DTYPE)
+
+        # Write to a temporary file and rename, so readers never see a
+        # half-written entry
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = entry_path + '.tmp%d' % os.getpid()
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            f.write(games.tobytes())
+        os.replace(tmp_path, entry_path)
+        self.entries[entry] = {'nbytes': len(header) + games.nbytes, 'last_used': time.time()}
+
+    def _remove_entry(self, entry):
+        self.entries.pop(entry, None)
+        try:
+            os.remove(self._entry_path(entry))
+        except OSError:
+            pass
+        self.files = {path: known for path, known in self.files.items() if known['entry'] != entry}
+
+    def invalidate(self, pgn_file_paths=None):
+        """Drop the entries of the given files, or the whole cache."""
+        if pgn_file_paths is None:
+            for entry in list(self.entries):
+                self._remove_entry(entry)
+            self.files = {}
+        else:
+            for pgn_file_path in pgn_file_paths:
+                known = self.files.get(os.path.abspath(pgn_file_path))
+                if known:
+                    # Both reader modes of the same content
+                    digest = known['entry'].split('-')[0]
+                    self._remove_entry(digest)
+                    self._remove_entry(digest + '-exact')
+        self.save()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_bytes."""
+        total = sum(info['nbytes'] for info in self.entries.values())
+        for entry in sorted(self.entries, key=lambda entry: self.entries[entry]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries[entry]['nbytes']
+            self._remove_entry(entry)
+
+    def save(self):
+        """Apply the size cap and write the index."""
+        self.evict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp%d' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps({'files': self.files, 'entries': self.entries}))
+        os.replace(tmp_path, self.index_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the PGN record cache.")
+    parser.add_argument('command', choices=['invalidate'])
+    parser.add_argument('pgn_files', nargs='*', help="files to drop; all entries when omitted")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    # Options may come between the command and the files
+    args = parser.parse_intermixed_args()
+    RecordCache(args.cache_dir).invalidate(args.pgn_files or None)
@@ -0,0 +1,330 @@
+"""
+Header-only PGN scanning:
+Performance ratings only need the White, Black, Result, WhiteElo and BlackElo
+tags of each game, so parsing and validating the moves with chess.pgn.read_game
+is wasted work. This module finds the tag pairs with a byte-level scanner over
+a memory-mapped file and skips the move text entirely.
+
+Functions:
+    - scan_game_headers(pgn_file_path, byte_range=None):
+        Yield (white, black, result, white_elo, black_elo) tag values per game.
+    - read_game_headers(pgn_file_path):
+        Same values via chess.pgn.read_game, used as the exact fallback.
+    - needs_exact_reader(pgn_file_path):
+        Whether the file has layouts on which the scanner and read_game could
+        disagree about where games start, so only the exact reader is safe.
+    - split_pgn_file(pgn_file_path, chunk_size):
+        Split a file into byte ranges that start at an [Event tag.
+    - shard_pgn_files(pgn_files, exact, chunk_size):
+        The (pgn_file_path, byte_range, exact) shards to read a set of files in.
+    - iter_game_records(pgn_file_path, player_ids, exact=False, byte_range=None, event_ids=None):
+        Yield compact (white_id, black_id, result, white_elo, black_elo) records,
+        prefixed with an event id when event_ids is given.
+    - iter_season_records(pgn_file_path, player_ids, event_ids, exact=False, byte_range=None):
+        Yield (event_id, date, white_id, black_id, result, white_elo, black_elo)
+        records with players keyed by (FIDE id, name).
+"""
+
+import io
+import locale
+import mmap
+import os
+import re
+import time
+import instrumentation
+
+# Result codes: White's score in half points, UNFINISHED for anything else
+RESULT_POINTS = {'1-0': 2, '0-1': 0, '1/2-1/2': 1, '½-½': 1}
+UNFINISHED = -1
+
+# Same tag grammar as chess.pgn.TAG_REGEX, applied per line of the raw bytes.
+# Values are kept verbatim, so escaped quotes come through exactly as today,
+# and a UTF-8 BOM in front of a game is skipped like read_game does.
+TAG_REGEX = re.compile(rb'^(?:\xef\xbb\xbf)?\[([A-Za-z0-9][A-Za-z0-9_+#=:-]*)[ \t]+"([^\r\n]*)"\][ \t\r]*$',
+                       re.MULTILINE)
+# A run of lines starting with '[', found by a literal search for '\n['
+HEADER_BLOCK_REGEX = re.compile(rb'\n(?:\xef\xbb\xbf)?(\[[^\n]*(?:\n\[[^\n]*)*)')
+FIRST_HEADER_BLOCK_REGEX = re.compile(rb'(?:\xef\xbb\xbf)?(\[[^\n]*(?:\n\[[^\n]*)*)')
+NON_SPACE_REGEX = re.compile(rb'\S')
+RESULT_TOKEN_REGEX = re.compile(rb'1-0|0-1|1/2-1/2')
+BOM = b'\xef\xbb\xbf'
+# Old Mac line endings, which only the python-chess reader splits correctly
+LONE_CR_REGEX = re.compile(rb'\r(?!\n)')
+# A % or ; comment line, which read_game skips, or a blank line, which ends
+# the move text of a game
+SKIPPED_OR_BLANK_LINE_REGEX = re.compile(rb'\n(?:[%;]|[ \t\r\f\v]*\n)')
+EVENT_TAG = b'\n[Event '
+
+WANTED_TAGS = (b'White', b'Black', b'Result', b'WhiteElo', b'BlackElo')
+EVENT_TAGS = (b'Event',) + WANTED_TAGS
+SEASON_TAGS = (b'Event', b'Date') + WANTED_TAGS + (b'WhiteFideId', b'BlackFideId')
+# Defaults match what game.headers.get(...) returned in process_pgn_files
+DEFAULT_TAGS = {b'Event': '?', b'White': '?', b'Black': '?', b'Result': '*', b'WhiteElo': '0', b'BlackElo': '0',
+                b'Date': '????.??.??', b'WhiteFideId': '', b'BlackFideId': ''}
+
+
+def _text_end(buf, start, end):
+    # End of the text in buf[start:end] without trailing whitespace
+    while end > start and buf[end - 1:end].isspace():
+        end -= 1
+    return end
+
+
+def _irregular_move_text(buf, start, end, next_block):
+    # Whether read_game would split the text between two header blocks (or
+    # after the last one) into games differently: it skips % and ; lines,
+    # ends the headers at the second blank line and a game at the first
+    # blank line of its move text, carries on over tag lines that follow
+    # the move text without a blank line, and takes tag lines inside an
+    # unclosed { comment as comment text
+    text = NON_SPACE_REGEX.search(buf, start, end)
+    if text is None:
+        # Tags of the same game, at most one blank line apart
+        return next_block and buf[start:end].count(b'\n') > 1
+    text_start = text.start()
+    text_end = _text_end(buf, text_start, end)
+    return (buf[start:text_start].count(b'\n') > 2
+            or SKIPPED_OR_BLANK_LINE_REGEX.search(buf, text_start - 1, text_end) is not None
+            or (next_block and b'\n' not in buf[text_end:end])
+            or (next_block and buf.rfind(b'{', text_start, text_end) > buf.rfind(b'}', text_start, text_end)))
+
+
+def needs_exact_reader(pgn_file_path):
+    """
+    Whether the file needs chess.pgn.read_game to find its games: old Mac
+    line endings, % or ; comment lines, text before the first tag, more
+    than one blank line between tags, blank lines inside move text, move
+    text running straight into the next tags, or tag lines inside a
+    { comment. Normal PGN has none of these; they are checked in one pass
+    over the file.
+    """
+    with open(pgn_file_path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return False
+        with buf:
+            if LONE_CR_REGEX.search(buf):
+                return True
+            previous_end = None
+            for block in _header_blocks(buf, 0, len(buf)):
+                if previous_end is None:
+                    if NON_SPACE_REGEX.search(buf, 0, block.start()):
+                        return True
+                elif _irregular_move_text(buf, previous_end, block.start(), True):
+                    return True
+                previous_end = block.end()
+            if previous_end is None:
+                return NON_SPACE_REGEX.search(buf) is not None
+            return _irregular_move_text(buf, previous_end, len(buf), False)
+
+
+def _move_text_result(game_text, encoding):
+    # The Result read_game gives a game: that of its move text when the tag
+    # is missing or '*'
+    import chess.pgn
+    game = chess.pgn.read_game(io.StringIO(game_text.decode(encoding), newline=None))
+    return game.headers['Result'].encode(encoding)
+
+
+def _game_tags(tags, encoding, wanted_tags):
+    return tuple(tags[tag].decode(encoding) if tag in tags else DEFAULT_TAGS[tag] for tag in wanted_tags)
+
+
+def _header_blocks(buf, start, end):
+    first = FIRST_HEADER_BLOCK_REGEX.match(buf, start, end)
+    if first:
+        yield first
+    yield from HEADER_BLOCK_REGEX.finditer(buf, first.end() if first else start, end)
+
+
+def _finished_game(buf, tags, game_start, move_text_start, game_end, encoding, wanted_tags):
+    if tags.get(b'Result', b'*') == b'*' and RESULT_TOKEN_REGEX.search(buf, move_text_start, game_end):
+        tags[b'Result'] = _move_text_result(buf[game_start:game_end], encoding)
+    return _game_tags(tags, encoding, wanted_tags)
+
+
+def scan_game_headers(pgn_file_path, byte_range=None, wanted_tags=WANTED_TAGS):
+    """
+    Yield (white, black, result, white_elo, black_elo) tag values for every
+    game in the file, or in the (start, end) byte_range of it, without
+    touching the move text. Pass wanted_tags=EVENT_TAGS to get the Event tag
+    in front.
+
+    A game's header block is a run of tag lines; any non-blank text between
+    two blocks (the move text) starts a new game. Only games whose Result
+    tag is missing or '*' while their move text has a result are parsed, to
+    take that result as read_game does. Values are decoded with the same
+    default encoding `open()` uses. Files for which `needs_exact_reader` is
+    true may be split into games differently from read_game.
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(pgn_file_path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return
+        with buf:
+            start, end = byte_range or (0, len(buf))
+            tags = None
+            game_start = previous_end = start
+            games = 0
+            for block in _header_blocks(buf, start, end):
+                if tags is None or NON_SPACE_REGEX.search(buf, previous_end, block.start(1)):
+                    if tags is not None:
+                        games += 1
+                        yield _finished_game(buf, tags, game_start, previous_end, block.start(), encoding, wanted_tags)
+                    tags = {}
+                    game_start = block.start(1)
+                # Later tags overwrite earlier ones, as in chess.pgn.Headers
+                tags.update(TAG_REGEX.findall(block.group(1)))
+                previous_end = block.end()
+            if tags is not None:
+                games += 1
+                yield _finished_game(buf, tags, game_start, previous_end, end, encoding, wanted_tags)
+            if instrumentation.ENABLED:
+                instrumentation.count('pgn/games', games)
+                instrumentation.count('pgn/bytes', end - start)
+
+
+def read_game_headers(pgn_file_path, wanted_tags=WANTED_TAGS):
+    """
+    Yield the same tag values as `scan_game_headers` by fully parsing every
+    game with chess.pgn.read_game, exactly as process_pgn_files always did.
+    """
+    import chess.pgn
+    defaults = {tag.decode(): DEFAULT_TAGS[tag] for tag in wanted_tags}
+    defaults.update(White='Unknown', Black='Unknown')
+    with open(pgn_file_path) as pgn:
+        while True:
+            if instrumentation.ENABLED:
+                started = time.perf_counter()
+                game = chess.pgn.read_game(pgn)
+                instrumentation.record_time('pgn/read_game', time.perf_counter() - started)
+            else:
+                game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            instrumentation.count('pgn/games')
+            headers = game.headers
+            yield tuple(headers.get(tag, default) for tag, default in defaults.items())
+    instrumentation.count('pgn/bytes', os.path.getsize(pgn_file_path))
+
+
+def _starts_game(buf, pos):
+    # A tag line at pos starts a new game unless the last non-blank line
+    # before it is another tag line of the same header block
+    text_end = _text_end(buf, 0, pos)
+    line_start = buf.rfind(b'\n', 0, text_end) + 1
+    return text_end == 0 or not buf[line_start:text_end].lstrip(BOM).startswith(b'[')
+
+
+def split_pgn_file(pgn_file_path, chunk_size):
+    """
+    Split a file into consecutive (start, end) byte ranges of roughly
+    chunk_size bytes, each starting at an [Event tag that opens a game, so
+    every game falls entirely inside one range. Only for files the scanner
+    can read (see `needs_exact_reader`).
+    """
+    size = os.path.getsize(pgn_file_path)
+    if size <= chunk_size:
+        return [(0, size)]
+
+    bounds = [0]
+    with open(pgn_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        pos = buf.find(EVENT_TAG, chunk_size)
+        while pos != -1:
+            if _starts_game(buf, pos + 1):
+                bounds.append(pos + 1)
+                pos = buf.find(EVENT_TAG, pos + 1 + chunk_size)
+            else:
+                pos = buf.find(EVENT_TAG, pos + 1)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def shard_pgn_files(pgn_files, exact, chunk_size):
+    """
+    The (pgn_file_path, byte_range, exact) shards that iter_game_records and
+    iter_season_records read pgn_files in: byte ranges from `split_pgn_file`,
+    or the whole file read with python-chess when exact or when the file
+    needs the exact reader. Each file is checked once, here.
+    """
+    shards = []
+    for pgn_file_path in pgn_files:
+        if exact or needs_exact_reader(pgn_file_path):
+            shards.append((pgn_file_path, None, True))
+        else:
+            shards.extend((pgn_file_path, byte_range, False) for byte_range in split_pgn_file(pgn_file_path, chunk_size))
+    return shards
+
+
+def _rating(value):
+    # Convert ratings to int
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _game_headers(pgn_file_path, wanted_tags, exact, byte_range):
+    # The byte-level scanner unless the file could be split into games
+    # differently by read_game; byte ranges come from files already checked
+    if exact or (byte_range is None and needs_exact_reader(pgn_file_path)):
+        return read_game_headers(pgn_file_path, wanted_tags)
+    return scan_game_headers(pgn_file_path, byte_range, wanted_tags)
+
+
+def _fide_id(value):
+    # FIDE ids are positive integers; anything else counts as missing
+    value = value.strip()
+    return value if value.isdigit() and int(value) else ''
+
+
+def iter_game_records(pgn_file_path, player_ids, exact=False, byte_range=None, event_ids=None):
+    """
+    Yield a compact (white_id, black_id, result, white_elo, black_elo) record
+    for every game in the file, or in a byte_range from `split_pgn_file`
+    (of a file `needs_exact_reader` is false for).
+
+    Player names are interned in `player_ids` (name -> id, ids assigned in
+    order of first appearance). `result` is White's score in half points, or
+    UNFINISHED. Missing or invalid ratings are 0. With exact=False the
+    byte-level scanner is used unless `needs_exact_reader`; exact=True
+    always uses python-chess and reads the whole file.
+
+    With `event_ids`, Event tags are interned there as well and every record
+    starts with the game's event id.
+    """
+    headers = _game_headers(pgn_file_path, WANTED_TAGS if event_ids is None else EVENT_TAGS, exact, byte_range)
+    if event_ids is not None:
+        for event, white, black, result, white_elo, black_elo in headers:
+            white_id = player_ids.setdefault(white, len(player_ids))
+            black_id = player_ids.setdefault(black, len(player_ids))
+            yield (event_ids.setdefault(event, len(event_ids)), white_id, black_id,
+                   RESULT_POINTS.get(result, UNFINISHED), _rating(white_elo), _rating(black_elo))
+        return
+
+    for white, black, result, white_elo, black_elo in headers:
+        white_id = player_ids.setdefault(white, len(player_ids))
+        black_id = player_ids.setdefault(black, len(player_ids))
+        yield (white_id, black_id, RESULT_POINTS.get(result, UNFINISHED),
+               _rating(white_elo), _rating(black_elo))
+
+
+def iter_season_records(pgn_file_path, player_ids, event_ids, exact=False, byte_range=None):
+    """
+    Like iter_game_records with event_ids, for rating many events jointly:
+    yield (event_id, date, white_id, black_id, result, white_elo, black_elo)
+    with the raw Date tag of every game. Players are interned in player_ids
+    by (FIDE id, name), the FIDE id being '' where the WhiteFideId or
+    BlackFideId tag is missing or invalid.
+    """
+    headers = _game_headers(pgn_file_path, SEASON_TAGS, exact, byte_range)
+    for event, date, white, black, result, white_elo, black_elo, white_fide_id, black_fide_id in headers:
+        white_id = player_ids.setdefault((_fide_id(white_fide_id), white), len(player_ids))
+        black_id = player_ids.setdefault((_fide_id(black_fide_id), black), len(player_ids))
+        yield (event_ids.setdefault(event, len(event_ids)), date, white_id, black_id,
+               RESULT_POINTS.get(result, UNFINISHED), _rating(white_elo), _rating(black_elo))
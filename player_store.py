@@ -0,0 +1,280 @@
+"""
+Compact player and game store:
+The name-keyed player_data of finish_player_data keeps, for every game and
+both of its players, the opponent's name, number and rating and the result
+as boxed Python objects, over 250 bytes per game. PlayerStore keeps one
+interned name per player and the finished games as structure-of-arrays
+columns (int32 player ids, int8 result in half points, int16 Elo), 13
+bytes per game. The index of every player's games (another 8 bytes per
+game) is only built when per-player access needs it.
+
+Players are numbered as by finish_player_data, in order of their first
+finished game, with missing ratings set to the average rating. Per-player
+access goes through PlayerView, a two-slot view that computes its fields
+from the columns on demand and can be read like a player_data entry
+(view['Points']). process_player_data accepts a PlayerStore and stores the
+TPRs and PREs as arrays on it.
+
+Example:
+    store, average_rating = process_pgn_files(pgn_input_dir, compact=True)
+    store = process_player_data(store, average_rating, 'standard')
+    for player in store:
+        print(player.name, player.points, player.pre)
+"""
+
+import numpy as np
+from pgn_scanner import UNFINISHED
+
+INT16_RANGE = (np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+# Games per chunk when compacting records and summing per player, which
+# would otherwise make int64 and float64 copies of whole columns
+CHUNK_GAMES = 1 << 12
+
+
+class PlayerView:
+    """One player of a PlayerStore; fields are computed on access."""
+
+    __slots__ = ('store', 'id')
+
+    # player_data keys and the attributes that hold them
+    FIELDS = {'Rank': 'rank', 'Name': 'name', 'Rating': 'rating', 'Points': 'points',
+              'opponents': 'opponent_names', 'results': 'results', 'opponent_ratings': 'opponent_ratings',
+              'opponent_nums': 'opponent_nums', 'TPR': 'tpr', 'PRE': 'pre'}
+
+    def __init__(self, store, player_id):
+        self.store = store
+        self.id = player_id
+
+    def __getitem__(self, key):
+        return getattr(self, self.FIELDS[key])
+
+    def __repr__(self):
+        return 'PlayerView(%r, rank=%d)' % (self.name, self.rank)
+
+    @property
+    def rank(self):
+        return self.id + 1
+
+    @property
+    def name(self):
+        return self.store.names[self.id]
+
+    @property
+    def rating(self):
+        return int(self.store.ratings[self.id])
+
+    @property
+    def points(self):
+        return float(self.store.points[self.id])
+
+    @property
+    def games(self):
+        return int(self.store.counts[self.id])
+
+    @property
+    def opponents(self):
+        return self.store.opponents(self.id)
+
+    @property
+    def opponent_names(self):
+        names = self.store.names
+        return [names[opponent_id] for opponent_id in self.opponents]
+
+    @property
+    def opponent_nums(self):
+        return self.opponents + 1
+
+    @property
+    def results(self):
+        return self.store.results(self.id)
+
+    @property
+    def opponent_ratings(self):
+        return self.store.opponent_ratings(self.id)
+
+    @property
+    def tpr(self):
+        return self.store.rating_or_none(self.store.tpr, self.id)
+
+    @property
+    def pre(self):
+        return self.store.rating_or_none(self.store.pre, self.id)
+
+
+def _compact_games(games):
+    # Finished games of a RECORD_DTYPE array as (sides, result, elos)
+    # columns, and the sum and count of valid ratings over every game
+    elos = np.stack((games['white_elo'], games['black_elo']), axis=1)
+    valid = elos > 0
+    ratings_sum, ratings_count = int(elos[valid].sum(dtype=np.int64)), int(valid.sum())
+    finished = games['result'] != UNFINISHED
+    sides = np.stack((games['white'][finished], games['black'][finished]), axis=1).astype(np.int32)
+    return (sides, games['result'][finished].astype(np.int8),
+            elos[finished].clip(*INT16_RANGE).astype(np.int16), ratings_sum, ratings_count)
+
+
+class PlayerStore:
+    """
+    Players and finished games of one or more events. Game columns are
+    `sides` (White's and Black's player id per game), `result` (White's
+    half points) and `elos` (as sides, missing ratings already set to
+    average_rating). Per-player columns are `ratings`, `counts` and
+    `points`. `entries` lists every player's games as 2 * game + side (0
+    for White), grouped by player in game order, with `indptr` marking
+    where each player's games start.
+    """
+
+    def __init__(self, names, sides, result, elos, ratings, average_rating):
+        self.names = names
+        self.sides, self.result, self.elos = sides, result, elos
+        self.ratings = ratings
+        self.average_rating = average_rating
+        self.tpr = self.pre = self.history = None
+        self._ids = self._entries = None
+
+        self.counts = self._player_sums(lambda games: None).astype(np.int64)
+        self.indptr = np.concatenate(([0], np.cumsum(self.counts)))
+        self.points = self._player_sums(lambda games: np.stack((result[games], 2 - result[games]), axis=1)) / 2
+
+    @classmethod
+    def from_parts(cls, parts):
+        """
+        Build a store from (names, games) parts, each a RECORD_DTYPE array
+        (or any array with its fields) whose player ids index the part's
+        names, as from pgn_cache or read_shard_records. Names are interned
+        across parts, and each part is compacted as it arrives, so the
+        records of only one part are held at a time. Unfinished games only
+        count towards the average rating, as in collect_player_tables.
+        """
+        player_ids = {}
+        sides = np.empty((0, 2), dtype=np.int32)
+        result = np.empty(0, dtype=np.int8)
+        elos = np.empty((0, 2), dtype=np.int16)
+        ratings_sum = ratings_count = 0
+        for names, games in parts:
+            ids = np.array([player_ids.setdefault(name, len(player_ids)) for name in names], dtype=np.int32)
+            for chunk_start in range(0, len(games), CHUNK_GAMES):
+                chunk_sides, chunk_result, chunk_elos, chunk_sum, chunk_count = _compact_games(
+                    games[chunk_start:chunk_start + CHUNK_GAMES])
+                # Grow the columns in place (realloc) rather than concatenating
+                # them at the end, which would hold every column twice
+                start = len(result)
+                for column, chunk in ((sides, ids[chunk_sides]), (result, chunk_result), (elos, chunk_elos)):
+                    column.resize((start + len(chunk),) + column.shape[1:], refcheck=False)
+                    column[start:] = chunk
+                ratings_sum += chunk_sum
+                ratings_count += chunk_count
+        average_rating = int(ratings_sum / ratings_count) if ratings_count else 0
+        names = list(player_ids)
+        del player_ids
+
+        # Number players in order of their first finished game
+        unseen = np.iinfo(np.int32).max
+        first = np.full(len(names), unseen, dtype=np.int32)
+        for start in range(0, len(sides), CHUNK_GAMES):
+            chunk = sides[start:start + CHUNK_GAMES].ravel()
+            np.minimum.at(first, chunk, np.arange(2 * start, 2 * start + len(chunk), dtype=np.int32))
+        order = np.argsort(first, kind='stable')[:np.count_nonzero(first != unseen)]
+        numbers = np.empty(len(names), dtype=np.int32)
+        numbers[order] = np.arange(len(order), dtype=np.int32)
+        for start in range(0, len(sides), CHUNK_GAMES):
+            sides[start:start + CHUNK_GAMES] = numbers[sides[start:start + CHUNK_GAMES]]
+        del numbers
+
+        # Set missing ratings to the average rating
+        for start in range(0, len(elos), CHUNK_GAMES):
+            chunk = elos[start:start + CHUNK_GAMES]
+            chunk[chunk == 0] = average_rating
+        ratings = elos.ravel()[first[order]]
+        del first
+        names = [names[player_id] for player_id in order]
+        return cls(names, sides, result, elos, ratings, average_rating)
+
+    @classmethod
+    def from_records(cls, names, games):
+        """Build a store from one (names, games) part, see from_parts."""
+        return cls.from_parts([(names, games)])
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return (PlayerView(self, player_id) for player_id in range(len(self.names)))
+
+    def _name_ids(self):
+        # Name -> id, built on first lookup by name
+        if self._ids is None:
+            self._ids = {name: player_id for player_id, name in enumerate(self.names)}
+        return self._ids
+
+    def __getitem__(self, name):
+        return PlayerView(self, self._name_ids()[name])
+
+    def __contains__(self, name):
+        return name in self._name_ids()
+
+    @property
+    def num_games(self):
+        return len(self.result)
+
+    def _player_sums(self, weights):
+        # Sum over every player's games of weights(games), an (n, 2) array
+        # by side, or of ones for None; in chunks of CHUNK_GAMES games
+        sums = np.zeros(len(self.names))
+        for start in range(0, len(self.sides), CHUNK_GAMES):
+            games = slice(start, start + CHUNK_GAMES)
+            chunk_weights = weights(games)
+            sums += np.bincount(self.sides[games].ravel(),
+                                None if chunk_weights is None else chunk_weights.ravel(), len(self.names))
+        return sums
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = np.argsort(self.sides.ravel(), kind='stable').astype(np.int32)
+        return self._entries
+
+    @property
+    def nbytes(self):
+        """Bytes held by the game and player columns."""
+        columns = [self.sides, self.result, self.elos, self.ratings, self.counts, self.indptr, self.points]
+        return sum(column.nbytes for column in columns) + (0 if self._entries is None else self._entries.nbytes)
+
+    def _player_entries(self, player_id):
+        entries = self.entries[self.indptr[player_id]:self.indptr[player_id + 1]]
+        return entries >> 1, entries & 1
+
+    def opponents(self, player_id):
+        games, side = self._player_entries(player_id)
+        return self.sides[games, 1 - side]
+
+    def results(self, player_id):
+        games, side = self._player_entries(player_id)
+        half_points = self.result[games]
+        return np.where(side, 2 - half_points, half_points) / 2
+
+    def opponent_ratings(self, player_id):
+        games, side = self._player_entries(player_id)
+        return self.elos[games, 1 - side]
+
+    def opponent_average(self):
+        """Average opponent rating of every player."""
+        return self._player_sums(lambda games: self.elos[games, ::-1]) / self.counts
+
+    def pairings(self):
+        """The pairing arrays of `build_pairings`, straight from the columns."""
+        entries = self.entries
+        return {
+            'rows': np.repeat(np.arange(len(self.names), dtype=np.int64), self.counts),
+            'cols': self.sides[entries >> 1, 1 - (entries & 1)].astype(np.int64),
+            'indptr': self.indptr,
+            'scores': self.points,
+            'counts': self.counts,
+            'ratings': self.ratings.astype(np.float64),
+        }
+
+    @staticmethod
+    def rating_or_none(values, player_id):
+        if values is None or np.isnan(values[player_id]):
+            return None
+        return float(values[player_id])
@@ -1,5 +1,22 @@
 import math
-from scipy.optimize import minimize_scalar
+
+# The score probability kernels and w* optimizers need NumPy and SciPy, whose
+# import takes far longer than any closed-form calculation below. They live
+# in score_kernels and are loaded on first use, so `from pr_calculator import
+# calculate_TPR` needs only the standard library while `from pr_calculator
+# import optimize_w` works as before.
+SCORE_KERNELS = ('W_STAR_TABLE_MAX_N', 'LOG_FACTORIAL_TABLE_MAX_N', 'KERNEL_CHUNK_SIZE', 'log_score_probability',
+                 'calculate_score_probability', 'calculate_score_plus_probability', 'optimize_w',
+                 'optimize_w_plus', 'optimize_w_batch', 'w_star_table', 'calculate_EPR_batch')
+
+def __getattr__(name):
+    if name in SCORE_KERNELS:
+        import score_kernels
+        return getattr(score_kernels, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | set(SCORE_KERNELS))
 
 def calculate_win_probability(A, B):
     return 1 / (1 + 10 ** ((B - A) / 400))
@@ -11,42 +28,6 @@ def adjust_mn(m, n):
         m, n = int(m), int(n)
     return m, n
 
-def calculate_score_probability(w, m, n):
-    # Ensure m and n are treated as integers for comb function
-    return math.comb(n, m) * w ** m * (1 - w) ** (n - m)
-
-def calculate_score_plus_probability(w, m, n):
-    if n < m:
-        raise ValueError("n must be greater than or equal to m")
-
-    total_probability = 0
-    for k in range(m, n + 1):
-        total_probability += math.comb(n, k) * w ** k * (1 - w) ** (n - k)
-    return total_probability
-
-def optimize_w(m, n, t):
-    def objective(w):
-        score_prob = calculate_score_probability(w, m, n)
-        if score_prob <= t:
-            return -score_prob
-        else:
-            return float('inf')  # Return a large value if constraint is not met
-    
-    result = minimize_scalar(objective, bounds=(0, 1), method='bounded')
-    return result.x
-
-def optimize_w_plus(m, n, t):
-    def objective(w):
-        score_plus_prob = calculate_score_plus_probability(w, m, n)
-        if score_plus_prob <= t:
-            return -score_plus_prob
-        else:
-            return float('inf')  # Return a large value if constraint is not met
-
-    result = minimize_scalar(objective, bounds=(0, 1), method='bounded')
-    return result.x
-
-
 # def calculate_EPR_old(w_star, B):
 #    return 400 * math.log10(-w_star * math.exp((B * math.log(10)) / 400) / (w_star - 1))
 
@@ -60,34 +41,26 @@ def calculate_TPR(m, n, B):
         return "TPR cannot be calculated: Player won all games."
     return B - 400 * math.log10((n - m) / m)
 
-def calculate_FPR(m, n, B):
+# FIDE dp by performance score p = 0.00, 0.01, ..., 1.00, indexed by 100 p
+FPR_DP_TABLE = (
+    -800, -677, -589, -538, -501, -470, -444, -422, -401, -383, -366, -351, -336, -322, -309, -296, -284,
+    -273, -262, -251, -240, -230, -220, -211, -202, -193, -184, -175, -166, -158, -149, -141, -133, -125,
+    -117, -110, -102, -95, -87, -80, -72, -65, -57, -50, -43, -36, -29, -21, -14, -7, 0, 7, 14, 21, 29, 36,
+    43, 50, 57, 65, 72, 80, 87, 95, 102, 110, 117, 125, 133, 141, 149, 158, 166, 175, 184, 193, 202, 211, 220,
+    230, 240, 251, 262, 273, 284, 296, 309, 322, 336, 351, 366, 383, 401, 422, 444, 470, 501, 538, 589, 677,
+    800
+)
+
+def fpr_dp(m, n):
+    """dp of the FIDE table for scoring m in n games."""
     # Performance score (p) as a percentage, rounded to 2 decimal places
+    # (NumPy scalars round half to even after scaling by 100, so 3 / 40
+    # gives 0.08 where a float gives 0.07); scores outside [0, 1] get the
+    # closest entry
     p = round(m / n, 2)
+    return FPR_DP_TABLE[min(max(round(p * 100), 0), 100)]
 
-    # Table for dp values
-    dp_table = {
-        1.0: 800, 0.99: 677, 0.98: 589, 0.97: 538, 0.96: 501, 0.95: 470, 0.94: 444, 0.93: 422,
-        0.92: 401, 0.91: 383, 0.90: 366, 0.89: 351, 0.88: 336, 0.87: 322, 0.86: 309, 0.85: 296,
-        0.84: 284, 0.83: 273, 0.82: 262, 0.81: 251, 0.80: 240, 0.79: 230, 0.78: 220, 0.77: 211,
-        0.76: 202, 0.75: 193, 0.74: 184, 0.73: 175, 0.72: 166, 0.71: 158, 0.70: 149, 0.69: 141,
-        0.68: 133, 0.67: 125, 0.66: 117, 0.65: 110, 0.64: 102, 0.63: 95, 0.62: 87, 0.61: 80,
-        0.60: 72, 0.59: 65, 0.58: 57, 0.57: 50, 0.56: 43, 0.55: 36, 0.54: 29, 0.53: 21, 0.52: 14,
-        0.51: 7, 0.50: 0, 0.49: -7, 0.48: -14, 0.47: -21, 0.46: -29, 0.45: -36, 0.44: -43, 0.43: -50,
-        0.42: -57, 0.41: -65, 0.40: -72, 0.39: -80, 0.38: -87, 0.37: -95, 0.36: -102, 0.35: -110,
-        0.34: -117, 0.33: -125, 0.32: -133, 0.31: -141, 0.30: -149, 0.29: -158, 0.28: -166, 0.27: -175,
-        0.26: -184, 0.25: -193, 0.24: -202, 0.23: -211, 0.22: -220, 0.21: -230, 0.20: -240, 0.19: -251,
-        0.18: -262, 0.17: -273, 0.16: -284, 0.15: -296, 0.14: -309, 0.13: -322, 0.12: -336, 0.11: -351,
-        0.10: -366, 0.09: -383, 0.08: -401, 0.07: -422, 0.06: -444, 0.05: -470, 0.04: -501, 0.03: -538,
-        0.02: -589, 0.01: -677, 0.00: -800
-    }
-
-    # Find dp from the table, rounding p to nearest key in the table
-    dp = dp_table.get(p, "Not Found")
-    if dp == "Not Found":
-        # If p is not found exactly, find the closest key
-        closest_p = min(dp_table.keys(), key=lambda x: abs(x - p))
-        dp = dp_table[closest_p]
-
+def calculate_FPR(m, n, B):
     # Calculate FIDE Performance Rating
-    FPR = B + dp
+    FPR = B + fpr_dp(m, n)
     return FPR
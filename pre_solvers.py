@@ -0,0 +1,522 @@
+"""
+Solvers for the Performance Rating Equilibrium (PRE) fixed point x = F(x),
+where F is the ratings mapping `pr_step`:
+
+    plain         the original iteration x <- F(x), until every rounded PR
+                  stops changing (or, with tol, every PR moves less than tol)
+    gauss-seidel  sweeps over groups of players who never met each other,
+                  each group rated against the latest PRs of the rest
+    anderson      Anderson acceleration over the last few iterates
+    newton        Newton steps on F(x) - x with the sparse Jacobian of the
+                  mapping, solved with a sparse LU
+
+Every PR depends only on rating differences, so an equilibrium is only
+defined up to a common shift per connected component of the pairing graph.
+The plain iteration keeps the games-weighted average rating of each
+component for linear PRs. For standard PRs it keeps the variance-weighted
+one only once the PRs are close to their equilibrium shape; before that it
+moves the whole component, by hundreds of points in some Swisses, and
+where a PR reaches the edge of PR_BRACKET the edge decides the shift. So
+the accelerated solvers first run the plain iteration until no PR moves
+WARM_UP_CHANGE points in a step, and from there pin each component's
+average to that of the last plain iterate. They stop within tol of the
+fixed point that the plain iteration is approaching; the plain iteration
+itself stops as soon as every rounded PR repeats, which on slow Swisses
+can be a point or two short of it. Should an accelerated step take a PR
+out of PR_BRACKET, or not converge within ACCELERATED_ITERATIONS, the
+solver goes on with the plain iteration from the warm-up and returns its
+result instead (diagnostics.fallback).
+
+Every solver returns the first-iteration PRs (TPR), the PRE and a
+SolverDiagnostics; PRs that did not settle within max_iterations are NaN.
+
+Example:
+    names, pairings = build_pairings(player_data)
+    tpr, pre, diagnostics = solve(pairings, 'standard', 'anderson', max_iterations=200)
+    print(diagnostics.status, diagnostics.iterations, diagnostics.unconverged_players(names))
+
+Every solver accepts pairings with per-game 'weights' (see build_pairings).
+"""
+
+import time
+import numpy as np
+import instrumentation
+from scipy.sparse import csr_matrix, bmat, identity
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import spsolve
+from performance_rating_equilibrium import (pr_step, performance_ratings, linear_performance_ratings,
+                                            LOG10_OVER_400, DEFAULT_MAX_ITERATIONS)
+
+# Largest change of any PR at which the accelerated solvers stop
+DEFAULT_TOL = 0.001
+# Standard PRs of the plain iteration are rounded to this step (pr_step).
+# Once no PR moves more than a step, a large event keeps flipping some PR
+# across a rounding boundary and never repeats; the plain iteration stops
+# after this many such rounds
+ROUNDING_STEP = 0.1
+SETTLED_ROUNDS = 20
+# The accelerated solvers take over once no PR of the plain iteration moves
+# this much; before that the plain iteration still shifts the equilibrium
+WARM_UP_CHANGE = 1.0
+# Mapping evaluations an accelerated solver gets before it falls back
+ACCELERATED_ITERATIONS = 100
+# Iterates kept by Anderson acceleration
+ANDERSON_MEMORY = 5
+# Largest Newton step of any PR, in rating points
+NEWTON_MAX_STEP = 400.0
+
+
+class SolverDiagnostics:
+    """
+    How a solver reached (or failed to reach) the PRE:
+
+    solver       the solver name
+    status       'converged', 'cycle' (plain only: PRs flipping across a
+                 rounding boundary, kept as they are) or 'max_iterations'
+    iterations   evaluations of the ratings mapping (sweeps for
+                 gauss-seidel, steps for newton)
+    residuals    the largest change of any PR after each iteration
+    wall_time    seconds spent in the solver
+    unconverged  ids of the players whose PR had not settled (their PRE is NaN)
+    fallback     True if an accelerated solver gave up and the plain
+                 iteration finished the solve
+    """
+
+    def __init__(self, solver):
+        self.solver = solver
+        self.status = 'max_iterations'
+        self.iterations = 0
+        self.residuals = []
+        self.wall_time = 0.0
+        self.unconverged = np.zeros(0, dtype=np.int64)
+        self.fallback = False
+        self._started = self._last = time.perf_counter()
+
+    def start_iterations(self):
+        # Everything so far was setup
+        if instrumentation.ENABLED:
+            self._last = time.perf_counter()
+            instrumentation.record_time('solver/%s/setup' % self.solver, self._last - self._started)
+
+    def record(self, residual):
+        """Count one iteration that left the given largest change."""
+        self.iterations += 1
+        self.residuals.append(residual)
+        if instrumentation.ENABLED:
+            now = time.perf_counter()
+            instrumentation.record_time('solver/%s/iteration' % self.solver, now - self._last)
+            self._last = now
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self._started
+        instrumentation.record_time('solver/%s' % self.solver, self.wall_time)
+
+    @property
+    def converged(self):
+        return self.status != 'max_iterations'
+
+    def unconverged_players(self, names):
+        return [names[i] for i in self.unconverged]
+
+    def as_dict(self):
+        return {
+            'solver': self.solver,
+            'status': self.status,
+            'iterations': self.iterations,
+            'residuals': [float(r) for r in self.residuals],
+            'wall_time': self.wall_time,
+            'unconverged': [int(i) for i in self.unconverged],
+            'fallback': self.fallback,
+        }
+
+    def __repr__(self):
+        return ('SolverDiagnostics(solver=%r, status=%r, iterations=%d, residual=%.3g, wall_time=%.3fs, '
+                'unconverged=%d%s)' % (self.solver, self.status, self.iterations,
+                                       self.residuals[-1] if self.residuals else np.nan, self.wall_time,
+                                       len(self.unconverged), ', fallback' if self.fallback else ''))
+
+
+def _max_change(new, old):
+    change = np.abs(new - old)
+    return float(np.nanmax(change)) if not np.isnan(change).all() else np.nan
+
+
+class _PlainIteration:
+    """
+    The plain iteration one step at a time, see `plain_iteration`. The
+    accelerated solvers warm up on it and, when they fail, finish with it,
+    so that whatever they return the plain iteration could have returned.
+    """
+
+    def __init__(self, pairings, performance_rating_type, diagnostics, tol=None, max_iterations=None, start=None,
+                 history=None):
+        self.pairings = pairings
+        self.performance_rating_type = performance_rating_type
+        self.diagnostics = diagnostics
+        self.tol, self.max_iterations, self.history = tol, max_iterations, history
+        self.ratings = pairings['ratings']
+        # First iteration uses initial ratings
+        self.current = self.ratings if start is None else start
+        self.first_pr = self.previous_pr = self.before_previous_pr = self.new_pr = None
+        self.change = np.inf
+        self.settled_rounds = 0
+        self.stopped = False
+
+    def step(self):
+        """One iteration; True once the iteration has stopped (see diagnostics.status)."""
+        diagnostics, ratings, tol = self.diagnostics, self.ratings, self.tol
+        new_pr = self.new_pr = pr_step(self.pairings, self.performance_rating_type, self.current)
+        diagnostics.record(_max_change(new_pr, self.current))
+        if self.history is not None:
+            self.history.append(new_pr)
+        previous_pr, before_previous_pr = self.previous_pr, self.before_previous_pr
+        if previous_pr is not None and np.array_equal(np.isnan(new_pr), np.isnan(previous_pr)):
+            self.change = _max_change(new_pr, previous_pr)
+        else:
+            self.change = np.inf
+        if tol is None and self.performance_rating_type != 'linear' and self.change < 1.5 * ROUNDING_STEP:
+            self.settled_rounds += 1
+        else:
+            self.settled_rounds = 0
+
+        if previous_pr is None:
+            # No previous PR to compare, need at least two iterations
+            self.first_pr = new_pr
+        elif not np.isnan(new_pr).any() and not np.isnan(previous_pr).any() and (
+                np.array_equal(np.round(new_pr), np.round(previous_pr)) if tol is None
+                else np.abs(new_pr - previous_pr).max() < tol):
+            diagnostics.status = 'converged'
+            self.stopped = True
+            return True
+        elif self.settled_rounds >= SETTLED_ROUNDS:
+            # Rounded PRs within a step of settling, for SETTLED_ROUNDS rounds
+            diagnostics.status = 'converged'
+            self.stopped = True
+            return True
+        elif before_previous_pr is not None and np.array_equal(new_pr, before_previous_pr, equal_nan=True):
+            # The mapping is deterministic, so a repeated state is a cycle
+            # (typically a PR flipping across a .5 rounding boundary) that
+            # would never settle
+            diagnostics.status = 'cycle'
+            self.stopped = True
+            return True
+        elif diagnostics.iterations >= (self.max_iterations or np.inf):
+            if tol is None:
+                unsettled = np.isnan(new_pr) | (np.round(new_pr) != np.round(previous_pr))
+            else:
+                unsettled = np.isnan(new_pr) | ~(np.abs(new_pr - previous_pr) < tol)
+            # Players without any PR are not iteration failures
+            diagnostics.unconverged = np.flatnonzero(unsettled & ~np.isnan(self.first_pr))
+            self.new_pr = np.where(unsettled, np.nan, new_pr)
+            self.stopped = True
+            return True
+
+        # Subsequent iterations use the previous iteration's PRs
+        self.before_previous_pr, self.previous_pr = previous_pr, new_pr
+        self.current = np.where(np.isnan(new_pr), ratings, new_pr)
+        return False
+
+    def warm_up(self, change=WARM_UP_CHANGE):
+        """
+        Iterate until no PR moves by `change` or more (True) or the
+        iteration stops on its own (False).
+        """
+        while not self.step():
+            if self.change < change:
+                return True
+        return False
+
+    def finish(self):
+        """Iterate until the iteration stops; returns (TPR, PRE, diagnostics)."""
+        while not self.stopped:
+            self.step()
+        self.diagnostics.finish()
+        return self.first_pr, self.new_pr, self.diagnostics
+
+    def fall_back(self):
+        """Finish with the plain iteration from where the warm-up left off."""
+        self.diagnostics.fallback = True
+        return self.finish()
+
+
+def plain_iteration(pairings, performance_rating_type, tol=None, max_iterations=None, start=None, history=None):
+    """
+    The original PRE iteration, see `solve_pre`. With tol, iteration stops
+    once every PR moves less than tol instead of when every rounded PR
+    stops changing. max_iterations=None iterates until then.
+    """
+    plain = _PlainIteration(pairings, performance_rating_type, SolverDiagnostics('plain'), tol, max_iterations,
+                            start, history)
+    plain.diagnostics.start_iterations()
+    return plain.finish()
+
+
+class _Anchor:
+    """
+    Pins the common shift of every connected component: `apply` moves each
+    component so that its weighted average rating equals the one of the
+    `target` ratings, with the weights the plain iteration keeps.
+    """
+
+    def __init__(self, pairings, performance_rating_type, target=None):
+        rows, cols = pairings['rows'], pairings['cols']
+        num_players = len(pairings['counts'])
+        graph = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_players, num_players))
+        self.num_components, self.component = connected_components(graph, directed=False)
+        self.rows, self.cols = rows, cols
+        self.linear = performance_rating_type == 'linear'
+        self.counts = pairings['counts'].astype(np.float64)
+        self.game_weights = pairings.get('weights')
+        self.target = target
+
+    def weights(self, values):
+        if self.linear:
+            return self.counts
+        p = 1 / (1 + np.exp((values[self.cols] - values[self.rows]) * LOG10_OVER_400))
+        q = p * (1 - p) if self.game_weights is None else self.game_weights * p * (1 - p)
+        return np.bincount(self.rows, q, len(values))
+
+    def apply(self, values):
+        weights = self.weights(values)
+        shift = np.bincount(self.component, weights * (self.target - values), self.num_components)
+        return values + (shift / np.bincount(self.component, weights, self.num_components))[self.component]
+
+
+def _mapping(pairings, performance_rating_type, warm_pr):
+    # Unrounded ratings mapping; players without a PR after the warm-up
+    # keep their initial rating, as opponents in the plain iteration, and
+    # NaN marks any other PR, which left PR_BRACKET
+    ratings = pairings['ratings']
+    no_pr = np.isnan(warm_pr)
+
+    def mapping(current):
+        new_pr = pr_step(pairings, performance_rating_type, current, decimals=None)
+        return np.where(no_pr, ratings, new_pr)
+    return mapping
+
+
+def _accelerate(plain, max_iterations):
+    # Mapping evaluations left for an accelerated solver after the warm-up,
+    # keeping one for a plain step should it fall back
+    left = (max_iterations or DEFAULT_MAX_ITERATIONS) - plain.diagnostics.iterations - 1
+    return range(max(0, min(ACCELERATED_ITERATIONS, left)))
+
+
+def _finish(pairings, performance_rating_type, plain, x):
+    # PRE from the converged iterate, rounded as by the plain iteration
+    final_pr = pr_step(pairings, performance_rating_type, x)
+    plain.diagnostics.status = 'converged'
+    plain.diagnostics.finish()
+    return plain.first_pr, final_pr, plain.diagnostics
+
+
+def anderson_iteration(pairings, performance_rating_type, tol=DEFAULT_TOL, max_iterations=DEFAULT_MAX_ITERATIONS,
+                       start=None, history=None, memory=ANDERSON_MEMORY):
+    """
+    Anderson acceleration of the plain iteration: every step mixes the last
+    `memory` evaluations of the mapping with the weights that best cancel
+    their residuals F(x) - x. The history is dropped whenever the residual
+    grows, which falls back to a plain step.
+    """
+    plain = _PlainIteration(pairings, performance_rating_type, SolverDiagnostics('anderson'),
+                            max_iterations=max_iterations, start=start, history=history)
+    anchor = _Anchor(pairings, performance_rating_type)
+    plain.diagnostics.start_iterations()
+    if not plain.warm_up():
+        return plain.finish()
+    mapping = _mapping(pairings, performance_rating_type, plain.new_pr)
+    x = plain.current
+    anchor.target = mapping(x)
+
+    residuals, values = [], []
+    for _ in _accelerate(plain, max_iterations):
+        f = mapping(x)
+        residual = f - x
+        change = np.abs(residual)
+        plain.diagnostics.record(float(np.nanmax(change)))
+        if history is not None:
+            history.append(f)
+        if np.isnan(f).any():
+            break
+        if change.max() < tol:
+            return _finish(pairings, performance_rating_type, plain, x)
+        if len(residuals) and plain.diagnostics.residuals[-1] > plain.diagnostics.residuals[-2]:
+            residuals, values = [], []
+        residuals.append(residual)
+        values.append(f)
+        residuals, values = residuals[-(memory + 1):], values[-(memory + 1):]
+        if len(residuals) > 1:
+            # Least-squares mix of the differences of the kept iterates
+            residual_steps = np.diff(residuals, axis=0).T
+            value_steps = np.diff(values, axis=0).T
+            gamma = np.linalg.lstsq(residual_steps, residual, rcond=None)[0]
+            f = f - value_steps @ gamma
+        x = anchor.apply(f)
+    return plain.fall_back()
+
+
+def _color_groups(pairings):
+    # Greedy coloring of the pairing graph: players of a group never met
+    indptr, cols = pairings['indptr'], pairings['cols']
+    colors = np.full(len(pairings['counts']), -1)
+    for player in range(len(colors)):
+        taken = set(colors[cols[indptr[player]:indptr[player + 1]]].tolist())
+        color = 0
+        while color in taken:
+            color += 1
+        colors[player] = color
+    groups = []
+    for color in range(colors.max() + 1):
+        players = np.flatnonzero(colors == color)
+        # Games per player; counts are weighted sums with game weights
+        sizes = np.diff(indptr)[players]
+        entries = np.repeat(indptr[players] - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        group = {
+            'players': players,
+            'indptr': np.concatenate(([0], np.cumsum(sizes))),
+            'rows': np.repeat(np.arange(len(players)), sizes),
+            'cols': cols[entries],
+            'scores': pairings['scores'][players],
+            'counts': pairings['counts'][players],
+        }
+        if 'weights' in pairings:
+            group['weights'] = pairings['weights'][entries]
+        groups.append(group)
+    return groups
+
+
+def gauss_seidel_iteration(pairings, performance_rating_type, tol=DEFAULT_TOL, max_iterations=DEFAULT_MAX_ITERATIONS,
+                           start=None, history=None):
+    """
+    Gauss-Seidel iteration: each sweep rates the players group by group,
+    where the players of a group never met each other, so every group sees
+    the PRs the earlier groups got in the same sweep.
+    """
+    plain = _PlainIteration(pairings, performance_rating_type, SolverDiagnostics('gauss-seidel'),
+                            max_iterations=max_iterations, start=start, history=history)
+    anchor = _Anchor(pairings, performance_rating_type)
+    groups = _color_groups(pairings)
+    plain.diagnostics.start_iterations()
+    if not plain.warm_up():
+        return plain.finish()
+    mapping = _mapping(pairings, performance_rating_type, plain.new_pr)
+    x = plain.current.astype(np.float64)
+    anchor.target = mapping(x)
+    no_pr = np.isnan(plain.new_pr)
+
+    for _ in _accelerate(plain, max_iterations):
+        previous = x.copy()
+        for group in groups:
+            players, indptr = group['players'], group['indptr']
+            opponent_ratings = x[group['cols']]
+            if performance_rating_type == 'linear':
+                new_pr = linear_performance_ratings(indptr, opponent_ratings, group['scores'], group['counts'],
+                                                    group.get('weights'))
+            else:
+                new_pr = performance_ratings(indptr, group['rows'], opponent_ratings, group['scores'],
+                                             group['counts'], start=x[players], decimals=None,
+                                             weights=group.get('weights'))
+            x[players] = np.where(no_pr[players], x[players], new_pr)
+        change = np.abs(x - previous)
+        plain.diagnostics.record(float(np.nanmax(change)))
+        if history is not None:
+            history.append(x.copy())
+        if np.isnan(x).any():
+            break
+        x = anchor.apply(x)
+        if change.max() < tol:
+            # Small sweeps can hide slow modes; confirm with the mapping itself
+            change = np.abs(mapping(x) - x)
+            if change.max() < tol:
+                return _finish(pairings, performance_rating_type, plain, x)
+    return plain.fall_back()
+
+
+def newton_iteration(pairings, performance_rating_type, tol=DEFAULT_TOL, max_iterations=DEFAULT_MAX_ITERATIONS,
+                     start=None, history=None):
+    """
+    Newton's method on F(x) - x = 0. Every PR is an average of its
+    opponents' ratings plus a constant, or for standard PRs the root of
+    expected score == score, so the Jacobian of F is row-stochastic on the
+    pairing graph with weights p(1 - p) at the PR. I - dF is singular
+    along a common shift of each component; the system is bordered with
+    one average constraint per component (the anchor) and solved with a
+    sparse LU. Players without a PR keep their initial rating, as in the
+    plain iteration, and have a zero Jacobian row.
+    """
+    rows, cols = pairings['rows'], pairings['cols']
+    scores, counts = pairings['scores'], pairings['counts']
+    num_players = len(counts)
+    plain = _PlainIteration(pairings, performance_rating_type, SolverDiagnostics('newton'),
+                            max_iterations=max_iterations, start=start, history=history)
+    anchor = _Anchor(pairings, performance_rating_type)
+    components = csr_matrix((np.ones(num_players), (np.arange(num_players), anchor.component)),
+                            shape=(num_players, anchor.num_components))
+    # Linear and CPR rows weight every opponent alike
+    even = (scores == 0) | (scores == counts) | (performance_rating_type == 'linear')
+    plain.diagnostics.start_iterations()
+    if not plain.warm_up():
+        return plain.finish()
+    mapping = _mapping(pairings, performance_rating_type, plain.new_pr)
+    x = plain.current.astype(np.float64)
+    anchor.target = mapping(x)
+    no_pr = np.isnan(plain.new_pr)
+
+    for _ in _accelerate(plain, max_iterations):
+        f = mapping(x)
+        residual = f - x
+        change = np.abs(residual)
+        plain.diagnostics.record(float(np.nanmax(change)))
+        if history is not None:
+            history.append(f)
+        if np.isnan(f).any():
+            break
+        if change.max() < tol:
+            return _finish(pairings, performance_rating_type, plain, x)
+        if plain.diagnostics.residuals[-1] > plain.diagnostics.residuals[-2]:
+            # The last step overshot; take a plain step instead
+            x = anchor.apply(f)
+            continue
+
+        p = 1 / (1 + np.exp((x[cols] - f[rows]) * LOG10_OVER_400))
+        q = np.where(even[rows], 1.0, p * (1 - p))
+        if 'weights' in pairings:
+            q *= pairings['weights']
+        q[no_pr[rows]] = 0
+        row_sums = np.bincount(rows, q, num_players)
+        derivative = csr_matrix((q / np.maximum(row_sums, 1e-300)[rows], (rows, cols)),
+                                shape=(num_players, num_players))
+        # Bordered system [[I - dF, C], [C^T W, 0]] keeps every component's average
+        weights = anchor.weights(x)
+        system = bmat([[identity(num_players, format='csr') - derivative, components],
+                       [components.T.multiply(weights).tocsr(), None]], format='csc')
+        step = spsolve(system, np.concatenate((residual, np.zeros(anchor.num_components))))[:num_players]
+        x = anchor.apply(x + np.clip(step, -NEWTON_MAX_STEP, NEWTON_MAX_STEP))
+    return plain.fall_back()
+
+
+SOLVERS = {
+    'plain': plain_iteration,
+    'gauss-seidel': gauss_seidel_iteration,
+    'anderson': anderson_iteration,
+    'newton': newton_iteration,
+}
+
+
+def solve(pairings, performance_rating_type, solver='plain', tol=None, max_iterations=None, start=None,
+          history=None):
+    """
+    Solve the PRE on `pairings` (see `build_pairings`) with one of SOLVERS.
+    Returns (first-iteration PRs, PRE, SolverDiagnostics). tol=None uses the
+    rounding rule for 'plain' and DEFAULT_TOL otherwise; max_iterations=None
+    caps every solver at DEFAULT_MAX_ITERATIONS. If `history` is a list,
+    every iterate is appended to it.
+    """
+    if solver not in SOLVERS:
+        raise ValueError("Unknown PRE solver %r, expected one of %s" % (solver, ', '.join(SOLVERS)))
+    if solver != 'plain' and tol is None:
+        tol = DEFAULT_TOL
+    if max_iterations is None:
+        max_iterations = DEFAULT_MAX_ITERATIONS
+    return SOLVERS[solver](pairings, performance_rating_type, tol=tol, max_iterations=max_iterations,
+                           start=start, history=history)
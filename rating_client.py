@@ -0,0 +1,142 @@
+"""
+Client of rating_service:
+RatingClient sends queries to a running rating service over TCP or a Unix
+socket, reusing one keep-alive connection. It needs only the standard
+library, so shell loops and short-lived functions start instantly.
+
+Example:
+    with RatingClient(port=8765) as client:
+        client.epr(5.5, 9, 2700)
+        client.query('cpr', [{'m': 5.5, 'n': 9, 'B': 2700}, {'m': 9, 'n': 9, 'B': 2650}])
+        client.pre(open('event.pgn').read())['players']
+        client.stats()['cache']['hit_rate']
+
+Usage:
+    python rating_client.py epr '{"m": 5.5, "n": 9, "B": 2700}'
+    python rating_client.py pre --pgn event.pgn
+    python rating_client.py stats
+"""
+
+import argparse
+import http.client
+import json
+import socket
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_TIMEOUT = 300
+
+
+class RatingServiceError(Exception):
+    """An error answer of the service, with its HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__('%d: %s' % (status, message))
+        self.status = status
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, unix_path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = unix_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RatingClient:
+    """Blocking client of one rating service; not safe to share across threads."""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None, timeout=DEFAULT_TIMEOUT):
+        if unix_path:
+            self.connection = _UnixHTTPConnection(unix_path, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload).encode()
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        # A kept-alive connection the server has since closed is retried once
+        for retry in (False, True):
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                answer = json.loads(response.read())
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.connection.close()
+                if retry:
+                    raise
+        if response.status >= 400:
+            raise RatingServiceError(response.status, answer.get('error'))
+        return answer
+
+    def query(self, kind, query):
+        """Raw answer of one query dict, or of a list of them, to /kind."""
+        return self._request('POST', '/' + kind, query)
+
+    def epr(self, m, n, B, t=0.75):
+        return self.query('epr', {'m': m, 'n': n, 'B': B, 't': t})['value']
+
+    def cpr(self, m, n, B):
+        return self.query('cpr', {'m': m, 'n': n, 'B': B})['value']
+
+    def tpr(self, m, n, B):
+        """The TPR, or None when the player won or lost every game."""
+        return self.query('tpr', {'m': m, 'n': n, 'B': B})['value']
+
+    def fpr(self, m, n, B):
+        return self.query('fpr', {'m': m, 'n': n, 'B': B})['value']
+
+    def pspr(self, ratings):
+        return self.query('pspr', {'ratings': list(ratings)})['value']
+
+    def win_probability(self, A, B):
+        return self.query('win_probability', {'A': A, 'B': B})['value']
+
+    def pre(self, pgn, performance_rating_type='standard', solver='plain', max_iterations=None):
+        """
+        TPR and PRE of every player of the PGN text: a dict with 'players'
+        (sorted by points), 'average_rating', 'diagnostics' and 'fingerprint'.
+        """
+        query = {'pgn': pgn, 'performance_rating_type': performance_rating_type, 'solver': solver}
+        if max_iterations is not None:
+            query['max_iterations'] = max_iterations
+        return self.query('pre', query)
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query a running rating service.")
+    parser.add_argument('kind', help="epr, cpr, tpr, fpr, pspr, win_probability, pre or stats")
+    parser.add_argument('query', nargs='?', help="JSON query, or list of queries")
+    parser.add_argument('--pgn', help="PGN file to rate (pre)")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', help="Unix socket path of the service")
+    args = parser.parse_args()
+
+    with RatingClient(args.host, args.port, args.unix) as client:
+        if args.kind == 'stats':
+            answer = client.stats()
+        else:
+            query = json.loads(args.query) if args.query else {}
+            if args.pgn:
+                with open(args.pgn, encoding='utf-8') as f:
+                    query['pgn'] = f.read()
+            answer = client.query(args.kind, query)
+    print(json.dumps(answer, indent=2))
@@ -0,0 +1,480 @@
+"""
+Rating service:
+A long-running local HTTP/JSON server (TCP or Unix socket) that answers
+rating queries without paying the NumPy, SciPy and PGN imports on every
+lookup. POST a JSON query, or a list of queries, to
+
+    /epr              {"m": 5.5, "n": 9, "B": 2700, "t": 0.75}
+    /cpr              {"m": 5.5, "n": 9, "B": 2700}
+    /tpr              {"m": 5.5, "n": 9, "B": 2700}
+    /fpr              {"m": 5.5, "n": 9, "B": 2700}
+    /pspr             {"ratings": [2718, 2657, 2684]}
+    /win_probability  {"A": 2800, "B": 2700}
+    /pre              {"pgn": "<PGN text>", "performance_rating_type": "standard", "solver": "plain"}
+
+and GET /stats for request counts, latency percentiles, cache hit rates and
+batch sizes. Single queries answer {"value": ...} (TPR adds a "message"
+when it is undefined), lists answer a list of those or of {"error": ...}.
+
+Concurrent EPR, CPR and PSPR queries are collected for up to batch_delay
+seconds (or batch_size queries) into one call of the vectorized kernels
+(calculate_EPR_batch, calculate_cpr_batch, perfect_score_prs); TPR, FPR
+and the win probability are closed-form and computed inline. Answers are
+kept in a bounded LRU cache keyed by the query, (m, n, t, B) for the EPR,
+and PRE results in a second one keyed by a fingerprint of the PGN text and
+solver settings. Identical queries in flight are solved once. PRE solves
+run on a process pool so they never block the event loop.
+
+rating_client.RatingClient is the matching client.
+
+Usage:
+    python rating_service.py --port 8765 --workers 2
+    python rating_service.py --unix /tmp/ratings.sock
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import signal
+import tempfile
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from pr_calculator import calculate_EPR_batch, calculate_TPR, calculate_FPR, calculate_win_probability
+from calculate_cpr import calculate_cpr_batch, perfect_score_prs
+from performance_rating_equilibrium import process_pgn_files, process_player_data
+from pre_solvers import SOLVERS, DEFAULT_MAX_ITERATIONS
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_PRE_CACHE_SIZE = 256
+DEFAULT_BATCH_SIZE = 4096
+DEFAULT_BATCH_DELAY = 0.002
+# Latencies kept per endpoint for the percentiles
+LATENCY_WINDOW = 10000
+LATENCY_PERCENTILES = (50, 90, 99)
+MAX_BODY_BYTES = 64 * 1024 * 1024
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None}
+
+
+class MicroBatcher:
+    """
+    Collects queries submitted from concurrent requests and answers them
+    with one call of function (a list of queries to a list of answers),
+    once batch_size queries are waiting or batch_delay seconds after the
+    first. The call runs on the event loop, so function must be fast.
+    """
+
+    def __init__(self, function, batch_size=DEFAULT_BATCH_SIZE, batch_delay=DEFAULT_BATCH_DELAY):
+        self.function = function
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.pending = []
+        self.timer = None
+        self.batches = self.queries = self.largest = 0
+
+    def submit(self, query):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((query, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.batch_delay, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        self.batches += 1
+        self.queries += len(batch)
+        self.largest = max(self.largest, len(batch))
+        try:
+            answers = self.function([query for query, _ in batch])
+        except Exception as error:
+            answers = [error] * len(batch)
+        for (_, future), answer in zip(batch, answers):
+            if future.done():
+                continue
+            if isinstance(answer, Exception):
+                future.set_exception(answer)
+            else:
+                future.set_result(answer)
+
+    def as_dict(self):
+        return {'batches': self.batches, 'queries': self.queries, 'largest': self.largest,
+                'mean_size': self.queries / self.batches if self.batches else None}
+
+
+class ServiceStats:
+    """Request counts, errors and recent latencies per endpoint."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.started = time.time()
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+
+    def record(self, endpoint, seconds, error):
+        self.counts[endpoint] += 1
+        self.errors[endpoint] += bool(error)
+        self.latencies[endpoint].append(seconds)
+
+    def as_dict(self):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            # Nearest-rank percentiles of the last `window` requests, in ms
+            latency = {'p%d' % q: 1000 * ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+                       for q in LATENCY_PERCENTILES}
+            latency['max'] = 1000 * ordered[-1]
+            endpoints[endpoint] = {'requests': self.counts[endpoint], 'errors': self.errors[endpoint],
+                                   'latency_ms': latency}
+        return {'uptime_seconds': time.time() - self.started, 'endpoints': endpoints}
+
+
+def _number(query, field, default=None):
+    value = query.get(field, default)
+    if value is None:
+        raise ValueError("missing field %r" % field)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError("field %r must be a finite number" % field)
+    return float(value)
+
+
+def _score(query):
+    m, n = _number(query, 'm'), _number(query, 'n')
+    if n <= 0:
+        raise ValueError("Number of games n must be positive.")
+    if m < 0 or m > n:
+        raise ValueError("Score m must be between 0 and n.")
+    return m, n
+
+
+def _epr_key(query):
+    m, n = _score(query)
+    t = _number(query, 't', 0.75)
+    # Half points are doubled as in adjust_mn, so 2m and n must be integers
+    if not (2 * m).is_integer() or not n.is_integer():
+        raise ValueError("m must be a multiple of 0.5 and n an integer")
+    if not 0 < t <= 1:
+        raise ValueError("threshold t must be in (0, 1]")
+    return ('epr', m, n, t, _number(query, 'B'))
+
+
+def _score_key(kind):
+    return lambda query: (kind,) + _score(query) + (_number(query, 'B'),)
+
+
+def _pspr_key(query):
+    ratings = query.get('ratings')
+    if not isinstance(ratings, list) or not ratings:
+        raise ValueError("field 'ratings' must be a non-empty list")
+    return ('pspr', tuple(_number({'rating': rating}, 'rating') for rating in ratings))
+
+
+def _win_probability_key(query):
+    return ('win_probability', _number(query, 'A'), _number(query, 'B'))
+
+
+def _epr_batch(keys):
+    # The w* table is per threshold, so call the kernel once per t
+    answers = [None] * len(keys)
+    by_threshold = defaultdict(list)
+    for i, key in enumerate(keys):
+        by_threshold[key[3]].append(i)
+    for t, indices in by_threshold.items():
+        m, n, B = (np.array([keys[i][field] for i in indices]) for field in (1, 2, 4))
+        for i, value in zip(indices, calculate_EPR_batch(m, n, B, t)):
+            answers[i] = float(value)
+    return answers
+
+
+def _cpr_batch(keys):
+    m, n, B = np.array([key[1:] for key in keys]).T
+    return [float(value) for value in calculate_cpr_batch(m, n, B)]
+
+
+def _pspr_batch(keys):
+    return [float(value) for value in perfect_score_prs([key[1] for key in keys])]
+
+
+# Query kind -> (key of a JSON query, batch function or None, inline function)
+QUERY_KINDS = {
+    'epr': (_epr_key, _epr_batch, None),
+    'cpr': (_score_key('cpr'), _cpr_batch, None),
+    'pspr': (_pspr_key, _pspr_batch, None),
+    'tpr': (_score_key('tpr'), None, calculate_TPR),
+    'fpr': (_score_key('fpr'), None, calculate_FPR),
+    'win_probability': (_win_probability_key, None, calculate_win_probability),
+}
+ENDPOINTS = set(QUERY_KINDS) | {'pre', 'stats', 'health'}
+
+
+def _answer(value):
+    # calculate_TPR explains an undefined TPR with a message string
+    if isinstance(value, str):
+        return {'value': None, 'message': value}
+    return {'value': value if math.isfinite(value) else None}
+
+
+def tournament_fingerprint(pgn, performance_rating_type, solver, max_iterations):
+    """Key of a PRE result: SHA-256 of the PGN text and the solver settings."""
+    digest = hashlib.sha256(pgn.encode('utf-8'))
+    digest.update(('\0%s\0%s\0%d' % (performance_rating_type, solver, max_iterations)).encode())
+    return digest.hexdigest()
+
+
+def rate_tournament(pgn, performance_rating_type='standard', solver='plain', max_iterations=DEFAULT_MAX_ITERATIONS):
+    """
+    TPR and PRE of every player of the PGN text, as main_pre computes them,
+    sorted by points. Runs on the service's process pool.
+    """
+    with tempfile.TemporaryDirectory() as pgn_dir:
+        with open(os.path.join(pgn_dir, 'tournament.pgn'), 'w', encoding='utf-8') as f:
+            f.write(pgn)
+        store, average_rating = process_pgn_files(pgn_dir, compact=True)
+    if not len(store):
+        raise ValueError("the PGN has no finished games")
+
+    store, diagnostics = process_player_data(store, average_rating, performance_rating_type,
+                                             max_iterations=max_iterations, solver=solver, return_diagnostics=True)
+    players = [{'rank': player.rank, 'name': player.name, 'rating': player.rating, 'points': player.points,
+                'games': player.games, 'tpr': player.tpr, 'pre': player.pre} for player in store]
+    players.sort(key=lambda player: -player['points'])
+    return {'average_rating': average_rating, 'players': players, 'diagnostics': diagnostics.as_dict()}
+
+
+class RatingService:
+    """The server; see the module docstring for the endpoints."""
+
+    def __init__(self, workers=1, cache_size=DEFAULT_CACHE_SIZE, pre_cache_size=DEFAULT_PRE_CACHE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, batch_delay=DEFAULT_BATCH_DELAY):
+        self.workers = workers
+        self.cache = LRUCache(cache_size)
+        self.pre_cache = LRUCache(pre_cache_size)
+        self.batchers = {kind: MicroBatcher(batch, batch_size, batch_delay)
+                         for kind, (_, batch, _) in QUERY_KINDS.items() if batch is not None}
+        self.stats = ServiceStats()
+        self.in_flight = {}
+        self.coalesced = 0
+        self.pool = None
+
+    def warm_up(self):
+        # Build the default w* table and start every PRE worker up front,
+        # so the first queries do not pay for them
+        _epr_batch([('epr', 1.0, 2.0, 0.75, 2700.0)])
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers)
+            for future in [self.pool.submit(int) for _ in range(self.workers)]:
+                future.result()
+
+    async def _cached(self, cache, key, compute):
+        # Answer from the cache, from an identical query in flight, or by
+        # awaiting compute(), whose answer is then cached
+        value = cache.get(key)
+        if value is not None:
+            return value
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(compute())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self._settle(cache, key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def _settle(self, cache, key, future):
+        del self.in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            cache.put(key, future.result())
+
+    async def _compute(self, kind, key):
+        if kind in self.batchers:
+            return await self.batchers[kind].submit(key)
+        return QUERY_KINDS[kind][2](*key[1:])
+
+    async def answer(self, kind, query):
+        """Answer one JSON query of an endpoint; ValueError if it is invalid."""
+        if not isinstance(query, dict):
+            raise ValueError("a query must be a JSON object")
+        if kind == 'pre':
+            return await self._answer_pre(query)
+        key = QUERY_KINDS[kind][0](query)
+        return _answer(await self._cached(self.cache, key, lambda: self._compute(kind, key)))
+
+    async def _answer_pre(self, query):
+        pgn = query.get('pgn')
+        if not isinstance(pgn, str) or not pgn.strip():
+            raise ValueError("field 'pgn' must be the PGN text")
+        performance_rating_type = query.get('performance_rating_type', 'standard')
+        if performance_rating_type not in ('standard', 'linear'):
+            raise ValueError("performance_rating_type must be 'standard' or 'linear'")
+        solver = query.get('solver', 'plain')
+        if solver not in SOLVERS:
+            raise ValueError("solver must be one of %s" % ', '.join(SOLVERS))
+        max_iterations = query.get('max_iterations', DEFAULT_MAX_ITERATIONS)
+        if isinstance(max_iterations, bool) or not isinstance(max_iterations, int) or max_iterations < 1:
+            raise ValueError("max_iterations must be a positive integer")
+
+        fingerprint = tournament_fingerprint(pgn, performance_rating_type, solver, max_iterations)
+        loop = asyncio.get_running_loop()
+        result = await self._cached(self.pre_cache, fingerprint, lambda: loop.run_in_executor(
+            self.pool, rate_tournament, pgn, performance_rating_type, solver, max_iterations))
+        return dict(result, fingerprint=fingerprint)
+
+    def stats_dict(self):
+        stats = self.stats.as_dict()
+        stats.update(cache=self.cache.as_dict(), pre_cache=self.pre_cache.as_dict(), coalesced=self.coalesced,
+                     in_flight=len(self.in_flight), workers=self.workers,
+                     batches={kind: batcher.as_dict() for kind, batcher in self.batchers.items()})
+        return stats
+
+    async def dispatch(self, method, path, body):
+        """(status, JSON payload) of one HTTP request."""
+        endpoint = path.split('?', 1)[0].strip('/')
+        if endpoint in ('stats', 'health'):
+            if method != 'GET':
+                return 405, {'error': "use GET"}
+            return 200, self.stats_dict() if endpoint == 'stats' else {'status': 'ok'}
+        if endpoint not in QUERY_KINDS and endpoint != 'pre':
+            return 404, {'error': "unknown endpoint /%s" % endpoint}
+        if method != 'POST':
+            return 405, {'error': "use POST"}
+        try:
+            query = json.loads(body)
+        except ValueError as error:
+            return 400, {'error': "invalid JSON: %s" % error}
+
+        try:
+            if not isinstance(query, list):
+                return 200, await self.answer(endpoint, query)
+            answers = await asyncio.gather(*(self.answer(endpoint, q) for q in query), return_exceptions=True)
+            return 200, [{'error': str(a)} if isinstance(a, Exception) else a for a in answers]
+        except ValueError as error:
+            return 400, {'error': str(error)}
+        except Exception as error:
+            return 500, {'error': '%s: %s' % (type(error).__name__, error)}
+
+    async def _handle_connection(self, reader, writer):
+        # Minimal HTTP/1.1 with keep-alive: one JSON request after another
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' if version == 'HTTP/1.1' else \
+                    headers.get('connection', '').lower() == 'keep-alive'
+
+                started = time.perf_counter()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    status, payload, keep_alive = 413, {'error': "body over %d bytes" % MAX_BODY_BYTES}, False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.dispatch(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(b'%s %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                             b'Connection: %s\r\n\r\n' % (version.encode(), status, STATUS_TEXT[status].encode(),
+                                                          len(data), b'keep-alive' if keep_alive else b'close'))
+                writer.write(data)
+                await writer.drain()
+                endpoint = path.split('?', 1)[0].strip('/')
+                self.stats.record(endpoint if endpoint in ENDPOINTS else 'other', time.perf_counter() - started,
+                                  status >= 400)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None):
+        """Warm up and start listening; returns the asyncio server."""
+        self.warm_up()
+        if unix_path:
+            return await asyncio.start_unix_server(self._handle_connection, unix_path)
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, unix_path=None):
+        """Serve until SIGINT or SIGTERM, then shut the PRE workers down."""
+        server = await self.start(host, port, unix_path)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, server.close)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve TPR, PRE, EPR, CPR, FPR and PSPR queries over HTTP/JSON.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', help="listen on this Unix socket path instead of TCP")
+    parser.add_argument('--workers', type=int, default=1, help="processes solving PREs")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help="cached EPR, CPR, ... answers")
+    parser.add_argument('--pre-cache-size', type=int, default=DEFAULT_PRE_CACHE_SIZE, help="cached PRE results")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="largest micro-batch")
+    parser.add_argument('--batch-delay-ms', type=float, default=DEFAULT_BATCH_DELAY * 1000,
+                        help="longest wait for a micro-batch to fill")
+    args = parser.parse_args()
+
+    service = RatingService(args.workers, args.cache_size, args.pre_cache_size, args.batch_size,
+                            args.batch_delay_ms / 1000)
+    print("Serving on %s" % (args.unix or '%s:%d' % (args.host, args.port)))
+    asyncio.run(service.serve(args.host, args.port, args.unix))
@@ -0,0 +1,174 @@
+"""
+Exact-score rating tables:
+Tournament scores are half-integers and game counts are small integers, so
+the rating offsets that EPR, CPR and FPR add to the average opponent rating
+take few distinct values. This module tabulates them indexed [2m, n] for
+every score 0 <= m <= n (in half points) and 1 <= n <= TABLE_MAX_N:
+
+    EPR = B + epr_offset_table(t)[2m, n]   (w* of w_star_table, adjusted as in adjust_mn)
+    CPR = B + cpr_offset_table()[2m, n]
+    FPR = B + fpr_dp_table()[2m, n]
+
+Tables are built on first use (tens of milliseconds each) and cached. The
+lookups epr_lookup, cpr_lookup and fpr_lookup rate whole arrays by indexing
+and fall back to calculate_EPR_batch, calculate_cpr_batch and
+calculate_FPR for entries the tables do not cover, so their results equal
+those functions bit for bit.
+
+Usage:
+    python rating_tables.py validate
+    python rating_tables.py build -o rating_tables.npz --thresholds 0.5 0.75 0.9
+"""
+
+import argparse
+import time
+from functools import lru_cache
+import numpy as np
+from score_kernels import W_STAR_TABLE_MAX_N, optimize_w, w_star_table, calculate_EPR_batch
+from pr_calculator import calculate_EPR, calculate_FPR, fpr_dp
+from calculate_cpr import calculate_cpr, calculate_cpr_batch
+
+# Largest number of games covered; half-point scores double it in w_star_table
+TABLE_MAX_N = W_STAR_TABLE_MAX_N // 2
+# Thresholds built and validated by default
+STANDARD_THRESHOLDS = (0.5, 0.75, 0.9, 0.95)
+# Largest difference to the scalar solvers accepted by validate, in rating points
+VALIDATE_TOLERANCE = 1e-6
+
+
+def _score_grid(max_n):
+    # Half points h = 2m and games n of every table entry, h <= 2n
+    h, n = np.indices((2 * max_n + 1, max_n + 1))
+    valid = (n > 0) & (h <= 2 * n)
+    return h[valid], n[valid]
+
+def _read_only(values, max_n):
+    h, n = _score_grid(max_n)
+    table = np.full((2 * max_n + 1, max_n + 1), np.nan)
+    table[h, n] = values(h, n)
+    table.flags.writeable = False
+    return table
+
+@lru_cache(maxsize=8)
+def epr_offset_table(t=0.75, max_n=TABLE_MAX_N):
+    """EPR - B for every score, indexed [2m, n]. Built once per (t, max_n)."""
+    def offsets(h, n):
+        # adjust_mn: half-point scores count as 2m of 2n
+        half = h % 2 == 1
+        m, n = np.where(half, h, h // 2), np.where(half, 2 * n, n)
+        w_star = w_star_table(float(t), max(2 * max_n, W_STAR_TABLE_MAX_N))[m, n]
+        with np.errstate(divide='ignore'):
+            return -(400 * np.log10((1 - w_star) / w_star))
+    return _read_only(offsets, max_n)
+
+@lru_cache(maxsize=None)
+def cpr_offset_table(max_n=TABLE_MAX_N):
+    """CPR - B for every score, indexed [2m, n]."""
+    def offsets(h, n):
+        m, n = h / 2, n.astype(np.float64)
+        return -(((n + 1) / n) * 400 * np.log10((n + 0.5 - m) / (m + 0.5)))
+    return _read_only(offsets, max_n)
+
+@lru_cache(maxsize=None)
+def fpr_dp_table(max_n=TABLE_MAX_N):
+    """
+    FIDE dp (FPR - B) for every score, indexed [2m, n]. The percentage
+    m / n is rounded as calculate_FPR rounds NumPy scalars, half to even
+    after scaling by 100, as in the batch ratings.
+    """
+    def dps(h, n):
+        return [fpr_dp(m, games) for m, games in zip(h / 2, n.astype(np.float64))]
+    return _read_only(dps, max_n)
+
+
+def _table_entries(m, n, B, max_n):
+    # Broadcast m, n and B, and find the entries the tables cover with
+    # their [2m, n] indices (0 elsewhere)
+    m, n, B = np.broadcast_arrays(np.asarray(m, dtype=np.float64), np.asarray(n, dtype=np.float64),
+                                  np.asarray(B, dtype=np.float64))
+    h = 2 * m
+    with np.errstate(invalid='ignore'):
+        covered = (h == np.floor(h)) & (n == np.floor(n)) & (n >= 1) & (n <= max_n) & (h >= 0) & (h <= 2 * n)
+    rows = np.where(covered, h, 0).astype(np.intp)
+    cols = np.where(covered, n, 0).astype(np.intp)
+    return m, n, B, covered, rows, cols
+
+def _lookup(table, m, n, B, fallback):
+    m, n, B, covered, rows, cols = _table_entries(m, n, B, table.shape[1] - 1)
+    ratings = np.empty(m.shape)
+    ratings[covered] = B[covered] + table[rows[covered], cols[covered]]
+    if not covered.all():
+        ratings[~covered] = fallback(m[~covered], n[~covered], B[~covered])
+    return ratings
+
+def epr_lookup(m, n, B, t=0.75):
+    """calculate_EPR_batch(m, n, B, t) from epr_offset_table where it covers (m, n)."""
+    if np.ndim(t) != 0:
+        return calculate_EPR_batch(m, n, B, t)
+    return _lookup(epr_offset_table(float(t)), m, n, B, lambda m, n, B: calculate_EPR_batch(m, n, B, t))
+
+def cpr_lookup(m, n, B):
+    """calculate_cpr_batch(m, n, B) from cpr_offset_table where it covers (m, n)."""
+    return _lookup(cpr_offset_table(), m, n, B, calculate_cpr_batch)
+
+def fpr_lookup(m, n, B):
+    """calculate_FPR of every (m, n, B) from fpr_dp_table where it covers (m, n)."""
+    return _lookup(fpr_dp_table(), m, n, B,
+                   lambda m, n, B: [calculate_FPR(*entry) for entry in zip(m, n, B)])
+
+
+def validate(thresholds=STANDARD_THRESHOLDS, max_n=TABLE_MAX_N):
+    """
+    Rebuild the tables and compare every entry with the scalar solvers
+    (optimize_w with calculate_EPR, calculate_cpr, calculate_FPR). Returns
+    a dict of the largest absolute difference per table.
+    """
+    h, n = _score_grid(max_n)
+    scores = list(zip((h / 2).tolist(), n.tolist()))
+    differences = {}
+    for t in thresholds:
+        table = epr_offset_table(t, max_n)
+        scalar = []
+        for m, games in scores:
+            if not m.is_integer():
+                m, games = 2 * m, 2 * games
+            scalar.append(calculate_EPR(optimize_w(int(m), int(games), t), 0.0))
+        differences['epr_%g' % t] = _max_difference(table[h, n], scalar)
+    differences['cpr'] = _max_difference(cpr_offset_table(max_n)[h, n], [calculate_cpr(m, games, 0.0)
+                                                                        for m, games in scores])
+    differences['fpr'] = _max_difference(fpr_dp_table(max_n)[h, n], [calculate_FPR(m, games, 0)
+                                                                      for m, games in zip(h / 2, n.astype(np.float64))])
+    return differences
+
+def _max_difference(table, scalar):
+    scalar = np.asarray(scalar, dtype=np.float64)
+    # Perfect and zero scores are infinite in both
+    same = (table == scalar) | (np.isnan(table) & np.isnan(scalar))
+    return float(np.max(np.where(same, 0.0, np.abs(table - scalar)), initial=0.0))
+
+def save_tables(path, thresholds=STANDARD_THRESHOLDS, max_n=TABLE_MAX_N):
+    """Write every table to an .npz file, EPR tables as epr_<t>."""
+    tables = {'epr_%g' % t: epr_offset_table(t, max_n) for t in thresholds}
+    np.savez_compressed(path, cpr=cpr_offset_table(max_n), fpr=fpr_dp_table(max_n),
+                        thresholds=np.asarray(thresholds, dtype=np.float64), **tables)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or validate the exact-score rating tables.")
+    parser.add_argument('command', choices=('build', 'validate'))
+    parser.add_argument('-o', '--output', default='rating_tables.npz', help="Output .npz file (build)")
+    parser.add_argument('--thresholds', type=float, nargs='+', default=STANDARD_THRESHOLDS)
+    parser.add_argument('--max-n', type=int, default=TABLE_MAX_N)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == 'build':
+        save_tables(args.output, args.thresholds, args.max_n)
+        print("Wrote %s in %.3f s" % (args.output, time.perf_counter() - started))
+    else:
+        failed = False
+        for name, difference in validate(args.thresholds, args.max_n).items():
+            failed |= difference > VALIDATE_TOLERANCE
+            print("%-10s max difference %.3g%s" % (name, difference, '' if difference <= VALIDATE_TOLERANCE else '  FAILED'))
+        print("Validated in %.3f s" % (time.perf_counter() - started))
+        raise SystemExit(1 if failed else 0)
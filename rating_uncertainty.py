@@ -0,0 +1,442 @@
+"""
+Uncertainty of the PRE and EPR:
+Resamples the results of an event K times and recomputes every player's PRE
+and EPR for all replicates at once, as (K x players) arrays. Results are
+resampled either parametrically, drawing every game from the expected score
+of the fitted PREs (with the event's draw rate), or nonparametrically,
+reweighting the games with Poisson(1) counts (a bootstrap that keeps the
+pairings fixed).
+
+Iterating the ratings mapping takes a hundred or more rounds per replicate,
+so the replicates' equilibria are solved directly with Newton's method (see
+_solve_batch). PRE only fixes ratings up to a common shift; every replicate
+keeps the games-weighted average PRE of the event, so intervals describe
+the ratings relative to the field.
+
+A replicate where part of the event wins (or loses) every game against the
+rest has no equilibrium. Every player's Failure_rate is the share of
+replicates without a PRE, and past --max-failure-rate the run fails rather
+than report intervals of the replicates that happened to settle.
+
+Replicates are solved in chunks of chunk_size, so memory stays bounded by
+the chunk plus one float32 value per replicate and player. Each chunk has
+its own seed spawned from `seed`, so results are the same for any number of
+jobs.
+
+Functions:
+    - game_table(player_data):
+        Pairings (see build_pairings) plus every game once, for resampling.
+    - solve_replicates(pairings, fitted_ratings, draw_rate, ...):
+        PRE and EPR of one chunk of replicates.
+    - bootstrap_ratings(player_data, average_rating, ...):
+        Per-player intervals and rank-stability probabilities.
+
+Usage:
+    python rating_uncertainty.py PGN_DIR -o intervals.csv --replicates 10000 --jobs 4
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import instrumentation
+from scipy.sparse import csr_matrix
+from performance_rating_equilibrium import (build_pairings, process_pgn_files, process_player_data,
+                                            PR_BRACKET, LOG10_OVER_400)
+from pr_calculator import calculate_EPR_batch
+
+DEFAULT_CHUNK_SIZE = 128
+DEFAULT_MAX_ITERATIONS = 1000
+# Newton steps before a replicate counts as having no equilibrium
+DEFAULT_MAX_STEPS = 15
+# Largest share of replicates without a PRE for a player with one
+DEFAULT_MAX_FAILURE_RATE = 0.5
+
+
+def game_table(player_data):
+    """
+    Pairings of `player_data` as from build_pairings, plus the games behind
+    them: 'game' maps every CSR entry to a game id, 'first' marks the entry
+    of the game's first player (lower id) and 'results' holds each game's
+    result for that player.
+    """
+    names, pairings = build_pairings(player_data)
+    rows, cols = pairings['rows'], pairings['cols']
+    results = np.fromiter((result for data in player_data.values() for result in data['results']),
+                          dtype=np.float64, count=len(rows))
+
+    # Both entries of a game share (lower id, higher id, occurrence), the
+    # k-th game of a pair being the k-th entry on either side
+    low, high = np.minimum(rows, cols), np.maximum(rows, cols)
+    first = rows < cols
+    order = np.lexsort((first, high, low))
+    key = np.stack((low[order], high[order], first[order]))
+    new_group = np.concatenate(([True], np.any(key[:, 1:] != key[:, :-1], axis=0)))
+    group_start = np.maximum.accumulate(np.where(new_group, np.arange(len(order)), 0))
+    occurrence = np.empty(len(order), dtype=np.int64)
+    occurrence[order] = np.arange(len(order)) - group_start
+
+    game = np.empty(len(rows), dtype=np.int64)
+    for side in (first, ~first):
+        entries = np.flatnonzero(side)
+        entries = entries[np.lexsort((occurrence[entries], high[entries], low[entries]))]
+        game[entries] = np.arange(len(entries))
+    game_results = np.empty(len(rows) // 2)
+    game_results[game[first]] = results[first]
+
+    pairings.update({'game': game, 'first': first, 'results': game_results})
+    return names, pairings
+
+
+def _weighted_sum(values, indptr):
+    # Per player sums along the last axis; segments are never empty
+    return np.add.reduceat(values, indptr[:-1], axis=-1)
+
+
+def _divide(a, b):
+    # a / b, 0 where b is 0 (systems that are already solved)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b != 0)
+
+
+def _row_dot(a, b):
+    # Dot products of matching rows, without the temporary of np.sum(a * b)
+    return np.einsum('ij,ij->i', a, b)
+
+
+def _bicgstab(matvec, b, tol=0.1, max_steps=25):
+    # BiCGSTAB for a batch of systems, one per row of b
+    x = np.zeros(b.shape)
+    r = b.copy()
+    r_hat = b.copy()
+    p = np.zeros(b.shape)
+    v = np.zeros(b.shape)
+    rho = alpha = omega = np.ones(len(b))
+    stop = tol ** 2 * _row_dot(b, b)
+    for _ in range(max_steps):
+        if np.all(_row_dot(r, r) <= stop):
+            break
+        rho_new = _row_dot(r_hat, r)
+        beta = _divide(rho_new, rho) * _divide(alpha, omega)
+        p = r + beta[:, None] * (p - omega[:, None] * v)
+        v = matvec(p)
+        alpha = _divide(rho_new, _row_dot(r_hat, v))
+        s = r - alpha[:, None] * v
+        t = matvec(s)
+        omega = _divide(_row_dot(t, s), _row_dot(t, t))
+        x += alpha[:, None] * p + omega[:, None] * s
+        r = s - omega[:, None] * t
+        rho = rho_new
+    return x
+
+
+def _block_layout(indptr, cols, replicates):
+    # CSR indices and indptr of one (players x players) matrix per replicate
+    # as a single block diagonal matrix, replicate after replicate; the
+    # first k blocks are the layout for k replicates
+    players = len(indptr) - 1
+    index_type = np.int32 if max(players, len(cols)) * replicates < 2 ** 31 else np.int64
+    indices = (cols[None, :] + players * np.arange(replicates)[:, None]).astype(index_type).ravel()
+    block_indptr = (indptr[None, :-1] + len(cols) * np.arange(replicates)[:, None]).ravel()
+    block_indptr = np.append(block_indptr, len(cols) * replicates).astype(index_type)
+    return indices, block_indptr
+
+
+def _solve_batch(pairings, performance_rating_type, weights, scores, counts, start, tol=0.01,
+                 max_steps=DEFAULT_MAX_STEPS):
+    """
+    PRE fixed points of a (replicates x players) batch, solved with Newton's
+    method instead of iterating the ratings mapping.
+
+    Every player's equation is written as x_i - sum_j A_ij x_j = c_i, with A
+    averaging over the player's games: weighted by p(1 - p) of the expected
+    scores for a standard PR, evenly for a linear PR or a CPR (zero or
+    perfect score). Each Newton step solves (I - A) dx = -r with BiCGSTAB,
+    r being each player's residual in rating points. The equations fix the
+    ratings up to a common shift, so every replicate keeps the games-weighted
+    mean of `start` (the rank one term makes the system nonsingular). The
+    averaging matrices of all replicates form one block sparse matrix, so
+    every BiCGSTAB product is a single sparse product.
+
+    When every PR would only drift by the same amount each round (e.g. a
+    perfect score that is balanced nowhere), the ratings relative to each
+    other still settle and are returned. Replicates where part of the event
+    runs away from the rest, or that do not settle in max_steps, are NaN.
+    PRs are not limited to PR_BRACKET: the shift is pinned to that of
+    `start`, not found by the plain iteration, so near the edge the bracket
+    would cut off replicates by where the shift fell rather than by the
+    results.
+    """
+    # Players along the first axis, replicates along the second, so the
+    # per-player sums run over contiguous rows
+    indptr, rows, cols = pairings['indptr'], pairings['rows'], pairings['cols']
+    scores, counts = np.ascontiguousarray(scores.T), np.ascontiguousarray(counts.T)
+    edge_weights = np.ones((len(cols), 1)) if weights is None else np.ascontiguousarray(weights.T)
+    rated = rated_all = counts > 0
+    safe_counts = np.where(rated, counts, 1)
+    extreme = (scores == 0) | (scores == counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if performance_rating_type == 'linear':
+            constant = 800 * (scores / safe_counts) - 400
+        else:
+            # CPR offset from the average opponent rating
+            constant = -((safe_counts + 1) / safe_counts) * 400 * np.log10(
+                (safe_counts + 0.5 - scores) / (scores + 0.5))
+    linear_rows = extreme | (performance_rating_type == 'linear')
+    mean_weights = counts / np.sum(counts, axis=0)
+
+    x = np.repeat(np.asarray(start, dtype=np.float64)[:, None], scores.shape[1], axis=1)
+    target = np.sum(mean_weights * x, axis=0)
+    final = np.full(x.shape, np.nan)
+    active = np.arange(x.shape[1])
+
+    # Sums over each player's games as a sparse product, several times
+    # faster than reduceat over a 2-D array
+    player_games = csr_matrix((np.ones(len(cols)), np.arange(len(cols)), indptr), shape=(len(indptr) - 1, len(cols)))
+    indices, block_indptr = _block_layout(indptr, cols, x.shape[1])
+    players, entries = len(indptr) - 1, len(cols)
+
+    def segment_sum(values):
+        return player_games @ values
+
+    for _ in range(max_steps):
+        opponent_ratings = x[cols]
+        residual = x - segment_sum(edge_weights * opponent_ratings) / safe_counts - constant
+        if performance_rating_type == 'linear':
+            q = np.broadcast_to(edge_weights, opponent_ratings.shape)
+        else:
+            with np.errstate(over='ignore'):
+                p = 1 / (1 + np.exp((opponent_ratings - x[rows]) * LOG10_OVER_400))
+            q = np.where(linear_rows[rows], edge_weights, edge_weights * p * (1 - p))
+        diagonal = segment_sum(q)
+        diagonal[~rated] = 1
+        if performance_rating_type != 'linear':
+            # One Newton step of the player's own equation, in rating points
+            expected = segment_sum(edge_weights * p)
+            residual = np.where(linear_rows, residual, (expected - scores) / (LOG10_OVER_400 * diagonal))
+        residual[~rated] = 0
+
+        # BiCGSTAB runs one system per row: the first k blocks of the layout
+        # hold the k replicates still being solved
+        replicates = x.shape[1]
+        averaging = csr_matrix((np.ascontiguousarray((q / diagonal[rows]).T).ravel(), indices[:replicates * entries],
+                                block_indptr[:replicates * players + 1]),
+                               shape=(replicates * players, replicates * players))
+        system_weights = np.ascontiguousarray(mean_weights.T)
+
+        def matvec(v):
+            return v - (averaging @ v.ravel()).reshape(v.shape) + _row_dot(system_weights, v)[:, None]
+
+        step = np.clip(_bicgstab(matvec, np.ascontiguousarray(-residual.T)).T, -400, 400)
+        step += target - np.sum(mean_weights * (x + step), axis=0)
+        x += step
+
+        done = np.max(np.abs(np.where(rated, step, 0)), axis=0) < tol
+        final[:, active[done]] = x[:, done]
+        # A PR a full bracket width past PR_BRACKET is running away: part
+        # of the event won (or lost) every game against the rest
+        width = PR_BRACKET[1] - PR_BRACKET[0]
+        diverged = np.any(rated & ((x < PR_BRACKET[0] - width) | (x > PR_BRACKET[1] + width)), axis=0)
+        keep = ~(done | diverged)
+        if not keep.any():
+            break
+        active, x, target = active[keep], x[:, keep], target[keep]
+        scores, rated, safe_counts = scores[:, keep], rated[:, keep], safe_counts[:, keep]
+        constant, linear_rows, mean_weights = constant[:, keep], linear_rows[:, keep], mean_weights[:, keep]
+        if weights is not None:
+            edge_weights = edge_weights[:, keep]
+
+    return np.where(rated_all, np.round(final, 1), np.nan).T
+
+
+def solve_replicates(pairings, fitted_ratings, draw_rate, performance_rating_type='standard', method='parametric',
+                     replicates=DEFAULT_CHUNK_SIZE, seed=None, threshold=0.75, max_steps=DEFAULT_MAX_STEPS):
+    """
+    Resample `replicates` versions of the event in `pairings` (from
+    game_table) and solve them together. The parametric method draws every
+    game from `fitted_ratings`, with draws at `draw_rate` where the expected
+    score allows. Returns (pre, epr) arrays of shape (replicates, players).
+    """
+    rng = np.random.default_rng(seed)
+    rows, cols = pairings['rows'], pairings['cols']
+    game, first = pairings['game'], pairings['first']
+    num_games = len(pairings['results'])
+
+    if method == 'parametric':
+        # Expected score of each game's first player
+        player, opponent = np.empty(num_games, dtype=np.int64), np.empty(num_games, dtype=np.int64)
+        player[game[first]], opponent[game[first]] = rows[first], cols[first]
+        p = 1 / (1 + 10 ** ((fitted_ratings[opponent] - fitted_ratings[player]) / 400))
+        draw = np.minimum(draw_rate, 2 * np.minimum(p, 1 - p))
+        u = rng.random((replicates, num_games))
+        game_results = np.where(u < p - draw / 2, 1.0, np.where(u < p + draw / 2, 0.5, 0.0))
+        weights = None
+        counts = np.broadcast_to(pairings['counts'].astype(np.float64), (replicates, len(pairings['counts'])))
+        entry_scores = np.where(first, game_results[:, game], 1 - game_results[:, game])
+        scores = _weighted_sum(entry_scores, pairings['indptr'])
+    else:
+        # Poisson bootstrap: every game counts a Poisson(1) number of times
+        game_weights = rng.poisson(1.0, (replicates, num_games)).astype(np.float64)
+        weights = game_weights[:, game]
+        entry_scores = np.where(first, pairings['results'][game], 1 - pairings['results'][game])
+        counts = _weighted_sum(weights, pairings['indptr'])
+        scores = _weighted_sum(weights * entry_scores, pairings['indptr'])
+
+    pre = _solve_batch(pairings, performance_rating_type, weights, scores, counts, fitted_ratings,
+                      max_steps=max_steps)
+
+    # EPR from the replicate's score against the initial opponent ratings
+    opponent_ratings = pairings['ratings'][cols]
+    epr = np.full(scores.shape, np.nan)
+    played = counts > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if weights is None:
+            average_opponent_rating = _weighted_sum(np.broadcast_to(opponent_ratings, (1, len(cols))),
+                                                    pairings['indptr']) / counts
+        else:
+            average_opponent_rating = _weighted_sum(opponent_ratings * weights, pairings['indptr']) / counts
+    epr[played] = calculate_EPR_batch(scores[played], counts[played], average_opponent_rating[played], threshold)
+    return pre, epr
+
+
+def _solve_chunk(task):
+    # One chunk of replicates, in a worker process or inline
+    pairings, fitted_ratings, draw_rate, options, replicates, seed = task
+    with instrumentation.timer('uncertainty/chunk'):
+        pre, epr = solve_replicates(pairings, fitted_ratings, draw_rate, replicates=replicates, seed=seed, **options)
+    instrumentation.count('uncertainty/replicates', replicates)
+    return pre.astype(np.float32), epr.astype(np.float32)
+
+
+def _ranks(values):
+    # Rank 1 for the highest value, NaN last; ties keep player order
+    order = np.argsort(-np.nan_to_num(values, nan=-np.inf), axis=1, kind='stable')
+    ranks = np.empty(values.shape, dtype=np.int32)
+    np.put_along_axis(ranks, order, np.arange(1, values.shape[1] + 1, dtype=np.int32)[None, :], axis=1)
+    return ranks
+
+
+def _intervals(samples, quantiles):
+    # Quantiles of every column over its non-NaN values, NaN for none
+    intervals = np.full((len(quantiles), samples.shape[1]), np.nan)
+    rated = ~np.isnan(samples).all(axis=0)
+    if rated.any():
+        intervals[:, rated] = np.nanquantile(samples[:, rated], quantiles, axis=0)
+    return intervals
+
+
+def bootstrap_ratings(player_data, average_rating, performance_rating_type='standard', replicates=1000,
+                      method='parametric', seed=0, chunk_size=DEFAULT_CHUNK_SIZE, jobs=1, confidence=0.95,
+                      threshold=0.75, max_iterations=DEFAULT_MAX_ITERATIONS, max_steps=DEFAULT_MAX_STEPS,
+                      max_failure_rate=DEFAULT_MAX_FAILURE_RATE):
+    """
+    PRE and EPR intervals from `replicates` resamples of the event, solved in
+    chunks of chunk_size replicates on `jobs` processes (None for one per
+    CPU). method is 'parametric' or 'nonparametric' (see module docstring).
+
+    Returns player_data, solved as by process_player_data, with for every
+    player 'EPR', central `confidence` intervals 'PRE_interval' and
+    'EPR_interval', 'PRE_rank' (rank by PRE), 'Rank_interval', 'P_same_rank'
+    (share of replicates ranking the player the same) and 'P_first' (share
+    ranking the player first), 'Replicates', the number of replicates with a
+    PRE for the player, and 'Failure_rate', the share without one. Ranks
+    only count replicates with an equilibrium (0 when there are none).
+
+    Intervals only describe the replicates with an equilibrium, so a
+    ValueError is raised when a player with a PRE has none in more than
+    max_failure_rate of the replicates.
+    """
+    player_data = process_player_data(player_data, average_rating, performance_rating_type,
+                                      max_iterations=max_iterations)
+    if not player_data:
+        return player_data
+    names, pairings = game_table(player_data)
+    pre = np.array([np.nan if player_data[name]['PRE'] is None else player_data[name]['PRE'] for name in names])
+    fitted_ratings = np.where(np.isnan(pre), pairings['ratings'], pre)
+    draw_rate = float(np.mean(pairings['results'] == 0.5))
+
+    options = {'performance_rating_type': performance_rating_type, 'method': method,
+               'threshold': threshold, 'max_steps': max_steps}
+    sizes = [min(chunk_size, replicates - start) for start in range(0, replicates, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(pairings, fitted_ratings, draw_rate, options, size, chunk_seed)
+             for size, chunk_seed in zip(sizes, seeds)]
+
+    pre_samples = np.empty((replicates, len(names)), dtype=np.float32)
+    epr_samples = np.empty((replicates, len(names)), dtype=np.float32)
+    start = 0
+    for pre_chunk, epr_chunk in instrumentation.pool_map(_solve_chunk, tasks, jobs):
+        pre_samples[start:start + len(pre_chunk)] = pre_chunk
+        epr_samples[start:start + len(epr_chunk)] = epr_chunk
+        start += len(pre_chunk)
+
+    rated_replicates = np.sum(~np.isnan(pre_samples), axis=0)
+    failure_rate = 1 - rated_replicates / replicates
+    failing = ~np.isnan(pre) & (failure_rate > max_failure_rate)
+    if failing.any():
+        worst = np.argsort(-np.where(failing, failure_rate, -1))[:min(5, np.count_nonzero(failing))]
+        raise ValueError("%d players have no PRE in more than %g of the replicates (%s); the event may be too "
+                         "sparse for %s resampling" % (np.count_nonzero(failing), max_failure_rate,
+                                                       ', '.join('%s: %.2f' % (names[i], failure_rate[i])
+                                                                 for i in worst), method))
+
+    # Point estimates and their ranks, then the spread over replicates
+    quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+    pre_interval = _intervals(pre_samples, quantiles)
+    epr_interval = _intervals(epr_samples, quantiles)
+    point_ranks = _ranks(pre[None, :])[0]
+    sample_ranks = _ranks(pre_samples[~np.isnan(pre_samples).all(axis=1)])
+    if len(sample_ranks):
+        rank_interval = np.quantile(sample_ranks, quantiles, axis=0, method='inverted_cdf')
+        same_rank = np.mean(sample_ranks == point_ranks, axis=0)
+        first = np.mean(sample_ranks == 1, axis=0)
+    else:
+        rank_interval = np.zeros((2, len(names)), dtype=np.int32)
+        same_rank = first = np.full(len(names), np.nan)
+    average_opponent_rating = _weighted_sum(pairings['ratings'][pairings['cols']], pairings['indptr']) \
+        / pairings['counts']
+    epr = calculate_EPR_batch(pairings['scores'], pairings['counts'], average_opponent_rating, threshold)
+
+    for i, name in enumerate(names):
+        data = player_data[name]
+        data['EPR'] = float(epr[i])
+        data['PRE_interval'] = (float(pre_interval[0, i]), float(pre_interval[1, i]))
+        data['EPR_interval'] = (float(epr_interval[0, i]), float(epr_interval[1, i]))
+        data['PRE_rank'] = int(point_ranks[i])
+        data['Rank_interval'] = (int(rank_interval[0, i]), int(rank_interval[1, i]))
+        data['P_same_rank'] = float(same_rank[i])
+        data['P_first'] = float(first[i])
+        data['Replicates'] = int(rated_replicates[i])
+        data['Failure_rate'] = float(failure_rate[i])
+    return player_data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PRE and EPR confidence intervals for the games in a directory.")
+    parser.add_argument('pgn_input_dir')
+    parser.add_argument('-o', '--output', default='rating_uncertainty.csv')
+    parser.add_argument('--performance-rating-type', choices=['standard', 'linear'], default='standard')
+    parser.add_argument('--method', choices=['parametric', 'nonparametric'], default='parametric')
+    parser.add_argument('--replicates', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--jobs', type=int, default=1, help="worker processes; 0 for one per CPU")
+    parser.add_argument('--max-failure-rate', type=float, default=DEFAULT_MAX_FAILURE_RATE,
+                        help="fail when a player has no PRE in more than this share of the replicates")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumentation.profile_from_args(args):
+        player_data, average_rating = process_pgn_files(args.pgn_input_dir)
+        player_data = bootstrap_ratings(player_data, average_rating, args.performance_rating_type, args.replicates,
+                                        args.method, args.seed, args.chunk_size, args.jobs or None, args.confidence,
+                                        max_failure_rate=args.max_failure_rate)
+    export_df = pd.DataFrame([{
+        'Rank': data['Rank'], 'Name': data['Name'], 'Rating': data['Rating'], 'Points': data['Points'],
+        'PRE': data['PRE'], 'PRE_low': data['PRE_interval'][0], 'PRE_high': data['PRE_interval'][1],
+        'EPR': data['EPR'], 'EPR_low': data['EPR_interval'][0], 'EPR_high': data['EPR_interval'][1],
+        'PRE_rank': data['PRE_rank'], 'Rank_low': data['Rank_interval'][0], 'Rank_high': data['Rank_interval'][1],
+        'P_same_rank': data['P_same_rank'], 'P_first': data['P_first'], 'Replicates': data['Replicates'],
+        'Failure_rate': data['Failure_rate'],
+    } for data in player_data.values()]).sort_values(by='PRE_rank')
+    export_df.to_csv(args.output, index=False)
+    print(export_df)
@@ -0,0 +1,251 @@
+"""
+Result export:
+ResultWriter appends DataFrames of results to a CSV, Parquet or JSON Lines
+file as they are produced, so only the rows of one chunk (or one event) are
+held at a time. RankedWriter puts the rows in order of a column on their way
+to a ResultWriter: in memory up to max_rows rows, beyond that as sorted runs
+spilled to a temporary directory and merged at the end, so memory stays
+bounded by max_rows whatever the output size. With top, only the best top
+rows are kept at all.
+
+Small outputs are sorted exactly as DataFrame.sort_values sorts them, so
+they match the CSVs written before. Ties keep no particular order.
+
+Example:
+    with open_writer('ratings.jsonl', sort_by='PRE', top=100) as writer:
+        for frame in frames:
+            writer.write(frame)
+"""
+
+import heapq
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import pandas as pd
+import instrumentation
+
+FORMATS = ('csv', 'parquet', 'jsonl')
+EXTENSIONS = {'.parquet': 'parquet', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+# Rows a RankedWriter sorts in memory before spilling sorted runs to disk
+DEFAULT_SORT_ROWS = 1000000
+# Rows per DataFrame handed to the ResultWriter when writing ranked rows
+DEFAULT_CHUNK_ROWS = 100000
+
+
+def output_format_of(output_path):
+    """Output format from the file extension; CSV unless .parquet, .jsonl or .ndjson."""
+    return EXTENSIONS.get(os.path.splitext(output_path)[1].lower(), 'csv')
+
+
+class ResultWriter:
+    """
+    Appends DataFrames to a CSV, Parquet or JSON Lines file (format from the
+    extension unless given), keeping `columns` (those of the first frame
+    unless given). Parquet needs pyarrow. With preview_rows, the first rows
+    written are kept in `preview`.
+    """
+
+    def __init__(self, output_path, output_format=None, columns=None, preview_rows=0):
+        self.output_path = output_path
+        self.output_format = output_format or output_format_of(output_path)
+        if self.output_format not in FORMATS:
+            raise ValueError("Unknown output format %r, expected one of %s" % (self.output_format, FORMATS))
+        self.columns = list(columns) if columns is not None else None
+        self.preview_rows = preview_rows
+        self.preview = None
+        self.rows = 0
+        self._parquet_writer = None
+
+    def write(self, frame):
+        if self.columns is None:
+            self.columns = list(frame.columns)
+        frame = frame[self.columns]
+        with instrumentation.timer('export/' + self.output_format):
+            self._write(frame)
+        if self.rows < self.preview_rows:
+            head = frame.head(self.preview_rows - self.rows)
+            self.preview = head if self.preview is None else pd.concat([self.preview, head])
+        self.rows += len(frame)
+
+    def _write(self, frame):
+        if self.output_format == 'csv':
+            frame.to_csv(self.output_path, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        elif self.output_format == 'jsonl':
+            with open(self.output_path, 'a' if self.rows else 'w', encoding='utf-8') as f:
+                if len(frame):
+                    f.write(frame.to_json(orient='records', lines=True).rstrip('\n') + '\n')
+        else:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.output_path, table.schema)
+            self._parquet_writer.write_table(table.cast(self._parquet_writer.schema))
+
+    def close(self):
+        if not self.rows and self._parquet_writer is None:
+            # Still leave a file, with the header where the format has one
+            self._write(pd.DataFrame(columns=self.columns or []))
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _Descending:
+    # Orders any comparable value in reverse, strings included
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _read_run(run_path):
+    # The sorted chunks of a spilled run, one at a time
+    with open(run_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class RankedWriter:
+    """
+    Writes the rows it is given to `writer` (a ResultWriter) in order of
+    column `by`, descending unless ascending, NaN last; with top, only the
+    first top rows. Nothing reaches the writer before close.
+    """
+
+    def __init__(self, writer, by, ascending=False, top=None, max_rows=DEFAULT_SORT_ROWS,
+                 chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.writer = writer
+        self.by, self.ascending, self.top = by, ascending, top
+        self.max_rows, self.chunk_rows = max_rows, chunk_rows
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+        self._spill_dir = None
+        self._dtypes = None
+
+    @property
+    def rows(self):
+        """Rows written to the file so far, which is none before close."""
+        return self.writer.rows
+
+    @property
+    def preview(self):
+        return self.writer.preview
+
+    def _sorted(self, frames):
+        return pd.concat(frames).sort_values(by=self.by, ascending=self.ascending)
+
+    def write(self, frame):
+        if self._dtypes is None:
+            self._dtypes = frame.dtypes
+        self._buffer.append(frame)
+        self._buffered += len(frame)
+        if self._buffered >= self.max_rows:
+            ranked = self._sorted(self._buffer)
+            if self.top is not None and self.top < self.max_rows:
+                # The rows past top can never be written
+                ranked = ranked.head(self.top)
+                self._buffer, self._buffered = [ranked], len(ranked)
+            else:
+                self._spill(ranked)
+                self._buffer, self._buffered = [], 0
+
+    def _spill(self, ranked):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix='ranked_export_')
+        run_path = os.path.join(self._spill_dir, '%d.pkl' % len(self._runs))
+        with open(run_path, 'wb') as f:
+            for start in range(0, len(ranked), self.chunk_rows):
+                pickle.dump(ranked.iloc[start:start + self.chunk_rows], f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._runs.append(run_path)
+
+    def _run_rows(self, run, run_path):
+        # (key, run, position, row) of every row of a run, in order; keys
+        # compare like the sort, with NaN last either way
+        column = None
+        position = 0
+        for chunk in _read_run(run_path):
+            if column is None:
+                column = list(chunk.columns).index(self.by)
+            for row in chunk.itertuples(index=False, name=None):
+                value = row[column]
+                missing = value is None or value is pd.NA or (isinstance(value, float) and math.isnan(value))
+                key = (True, 0) if missing else (False, value if self.ascending else _Descending(value))
+                yield key, run, position, row
+                position += 1
+
+    def _write_chunks(self, ranked):
+        for start in range(0, len(ranked), self.chunk_rows):
+            self.writer.write(ranked.iloc[start:start + self.chunk_rows])
+
+    def close(self):
+        try:
+            if not self._runs:
+                if self._buffer:
+                    ranked = self._sorted(self._buffer)
+                    self._write_chunks(ranked if self.top is None else ranked.head(self.top))
+            else:
+                if self._buffer:
+                    self._spill(self._sorted(self._buffer))
+                self._buffer, self._buffered = [], 0
+                self._merge_runs()
+        finally:
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+            self.writer.close()
+
+    def _merge_runs(self):
+        columns = list(self._dtypes.index)
+        merged = heapq.merge(*(self._run_rows(run, run_path) for run, run_path in enumerate(self._runs)))
+        rows = []
+        written = 0
+        for _, _, _, row in merged:
+            if self.top is not None and written == self.top:
+                break
+            rows.append(row)
+            written += 1
+            if len(rows) == self.chunk_rows:
+                self.writer.write(pd.DataFrame.from_records(rows, columns=columns).astype(self._dtypes))
+                rows = []
+        if rows:
+            self.writer.write(pd.DataFrame.from_records(rows, columns=columns).astype(self._dtypes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_writer(output_path, output_format=None, columns=None, sort_by=None, ascending=False, top=None,
+                preview_rows=0, max_rows=DEFAULT_SORT_ROWS):
+    """
+    A ResultWriter for output_path, wrapped in a RankedWriter when sort_by
+    names a column to rank the rows by.
+    """
+    writer = ResultWriter(output_path, output_format, columns, preview_rows)
+    if sort_by is None:
+        return writer
+    return RankedWriter(writer, sort_by, ascending, top, max_rows)
@@ -0,0 +1,175 @@
+"""
+Score probability kernels and w* optimizers behind the EPR:
+S(w, m, n) and P(score >= m) in log space, optimize_w and its vectorized
+and tabulated forms, and calculate_EPR_batch. They need NumPy and SciPy, so
+pr_calculator, which keeps the closed-form calculators importable with the
+standard library alone, loads this module on first use of any of them.
+"""
+
+from functools import lru_cache
+import numpy as np
+from scipy.special import betainc, betaincinv, gammaln
+
+# Largest number of games (after adjust_mn) covered by the cached w* tables
+W_STAR_TABLE_MAX_N = 256
+# Largest n whose binomial coefficients come from a cached log-factorial table
+LOG_FACTORIAL_TABLE_MAX_N = 1 << 16
+# Elements per chunk of the vectorized score probability kernels
+KERNEL_CHUNK_SIZE = 1 << 14
+
+@lru_cache(maxsize=None)
+def _log_factorials(size):
+    # log(k!) for k < size, each from gammaln so large n stay exact
+    return gammaln(np.arange(size, dtype=np.float64) + 1)
+
+def _log_score_probability(w, m, n):
+    # log_score_probability on flat arrays of one chunk
+    losses = n - m
+    max_n = int(n.max(initial=0))
+    if max_n <= LOG_FACTORIAL_TABLE_MAX_N:
+        # Power of two sized tables, small enough to stay in cache
+        log_factorials = _log_factorials(max(256, 1 << max_n.bit_length()))
+        log_comb = log_factorials.take(n.astype(np.intp, copy=False))
+        log_comb -= log_factorials.take(m.astype(np.intp, copy=False))
+        log_comb -= log_factorials.take(losses.astype(np.intp, copy=False))
+    else:
+        log_comb = gammaln(n + 1.0) - gammaln(m + 1.0) - gammaln(losses + 1.0)
+
+    m, losses = m.astype(np.float64, copy=False), losses.astype(np.float64, copy=False)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_wins = np.log(w)
+        log_wins *= m
+        log_losses = np.subtract(1, w)
+        np.log(log_losses, out=log_losses)
+        log_losses *= losses
+        # 0 * log(0) is 0: no wins (or losses) are certain at w = 0 (or 1)
+        if np.isnan(log_wins).any() or np.isnan(log_losses).any():
+            log_wins = np.where(m == 0, 0, log_wins)
+            log_losses = np.where(losses == 0, 0, log_losses)
+    log_comb += log_wins
+    log_comb += log_losses
+    return log_comb
+
+def log_score_probability(w, m, n):
+    # log of the probability of scoring exactly m in n games, elementwise.
+    # Large batches go in chunks, as full-size temporaries cost more than
+    # the logarithms themselves.
+    m, n, w = np.broadcast_arrays(np.asarray(m), np.asarray(n), np.asarray(w, dtype=np.float64))
+    shape = w.shape
+    m, n, w = m.reshape(-1), n.reshape(-1), w.reshape(-1)
+    if len(w) <= KERNEL_CHUNK_SIZE:
+        return _log_score_probability(w, m, n).reshape(shape)
+    log_probability = np.empty(len(w))
+    for start in range(0, len(w), KERNEL_CHUNK_SIZE):
+        chunk = slice(start, start + KERNEL_CHUNK_SIZE)
+        log_probability[chunk] = _log_score_probability(w[chunk], m[chunk], n[chunk])
+    return log_probability.reshape(shape)
+
+def calculate_score_probability(w, m, n):
+    # Works on scalars and NumPy arrays alike
+    log_probability = log_score_probability(w, m, n)
+    return np.exp(log_probability, out=log_probability)[()]
+
+def calculate_score_plus_probability(w, m, n):
+    if np.any(np.asarray(n) < np.asarray(m)):
+        raise ValueError("n must be greater than or equal to m")
+
+    # P(score >= m) is the regularized incomplete beta I_w(m, n - m + 1)
+    m = np.asarray(m, dtype=np.float64)
+    return np.where(m == 0, 1.0, betainc(np.maximum(m, 1), n - m + 1, w))[()]
+
+def optimize_w(m, n, t):
+    # The constrained maximum lies at the mode or on the boundary S(w, m, n) = t
+    return float(optimize_w_batch(m, n, t))
+
+def optimize_w_plus(m, n, t):
+    # P(score >= m) increases with w, so the constrained maximum is on the
+    # boundary P(score >= m) = t. With m = 0 the probability is always 1 and
+    # no w meets the constraint (NaN). Works on arrays as well.
+    m = np.asarray(m, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return np.where(m == 0, np.nan, betaincinv(np.maximum(m, 1), n - m + 1, t))[()]
+
+
+def optimize_w_batch(m, n, t, tol=1e-12, max_steps=100):
+    """
+    Vectorized optimize_w over arrays of integer m, n (as from adjust_mn) and
+    thresholds t in (0, 1], broadcast together.
+
+    The score probability S(w, m, n) peaks at the mode w = m/n, so the
+    constrained maximum is the mode when S(m/n, m, n) <= t and otherwise lies
+    on the boundary S(w, m, n) = t, which is solved directly with a Newton
+    step safeguarded by bisection between the mode and 0 or 1. Both boundary
+    roots reach the same probability t; the one towards w = 1/2 is returned.
+    """
+    m, n, t = np.broadcast_arrays(np.asarray(m, dtype=np.float64), np.asarray(n, dtype=np.float64),
+                                  np.asarray(t, dtype=np.float64))
+    shape = m.shape
+    m, n, t = m.ravel(), n.ravel(), t.ravel()
+    mode = m / n
+    log_t = np.log(t)
+    w = mode.copy()
+    boundary = log_score_probability(mode, m, n) > log_t
+    if not boundary.any():
+        return w.reshape(shape)[()]
+
+    m, n, log_t = m[boundary], n[boundary], log_t[boundary]
+    # Root above the mode for scores up to half, below it otherwise
+    upper = 2 * m <= n
+    lo = np.where(upper, mode[boundary], 0.0)
+    hi = np.where(upper, 1.0, mode[boundary])
+    x = (lo + hi) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(max_steps):
+            g = log_score_probability(x, m, n) - log_t
+            # g falls away from the mode on either side
+            root_above = np.where(upper, g > 0, g < 0)
+            lo = np.where(root_above, x, lo)
+            hi = np.where(root_above, hi, x)
+            x_new = x - g / (m / x - (n - m) / (1 - x))
+            # Fall back to bisection when Newton leaves the bracket
+            outside = ~((x_new >= lo) & (x_new <= hi))
+            x_new[outside] = (lo[outside] + hi[outside]) / 2
+            done = np.all(np.abs(x_new - x) < tol)
+            x = x_new
+            if done:
+                break
+    w[boundary] = x
+    return w.reshape(shape)[()]
+
+@lru_cache(maxsize=8)
+def w_star_table(t=0.75, max_n=W_STAR_TABLE_MAX_N):
+    """
+    Read-only table of optimize_w_batch(m, n, t) indexed [m, n] for every
+    0 <= m <= n <= max_n, NaN elsewhere. Built once per (t, max_n).
+    """
+    m, n = np.triu_indices(max_n + 1)
+    m, n = m[n > 0], n[n > 0]
+    table = np.full((max_n + 1, max_n + 1), np.nan)
+    table[m, n] = optimize_w_batch(m, n, t)
+    table.flags.writeable = False
+    return table
+
+def calculate_EPR_batch(m, n, B, t=0.75):
+    """
+    Vectorized EPR for arrays of scores m, games n and average opponent
+    ratings B, broadcast together. Half-point scores are adjusted as in
+    adjust_mn. For a single threshold t, w* is looked up in w_star_table
+    where n fits and solved with optimize_w_batch elsewhere.
+    """
+    m, n = np.broadcast_arrays(np.asarray(m, dtype=np.float64), np.asarray(n, dtype=np.float64))
+    half = m != np.floor(m)
+    m = np.where(half, 2 * m, m)
+    n = np.where(half, 2 * n, n)
+
+    if np.ndim(t) == 0:
+        w_star = np.empty(m.shape)
+        in_table = n <= W_STAR_TABLE_MAX_N
+        w_star[in_table] = w_star_table(float(t))[m[in_table].astype(np.intp), n[in_table].astype(np.intp)]
+        if not in_table.all():
+            w_star[~in_table] = optimize_w_batch(m[~in_table], n[~in_table], t)
+    else:
+        w_star = optimize_w_batch(m, n, t)
+
+    with np.errstate(divide='ignore'):
+        return B - 400 * np.log10((1 - w_star) / w_star)
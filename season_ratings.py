@@ -0,0 +1,363 @@
+"""
+Season ratings:
+Joint PRE over many events at once. main_pre pools every game by player
+name and batch_ratings rates every event on its own; here the games of all
+events form one pairing graph, so a player's PRE reflects every event of
+the season and the strength of every opponent met anywhere in it.
+
+Players are keyed by the WhiteFideId/BlackFideId tags where present and by
+name elsewhere; a name that appears without an id is joined to the player
+with an id if it was seen with exactly one. Each player's initial rating is
+the Elo of their first finished game, missing ratings being the average.
+
+PRs only depend on rating differences within a connected component of the
+pairing graph, so every component is an independent fixed point. The
+components are solved separately, largest first, on a pool of --jobs
+processes; small components share a task to save pool overhead, but each
+is still its own solve with its own status. Wall time follows the largest
+component rather than the season. PREs of players in different
+components are on unrelated scales, so every row carries its Component
+(0 the largest).
+
+Time decay: with a half-life in days, every game is weighted by
+0.5 ** (age / half_life), the age being the days between its event's date
+(the earliest Date tag of the event's games; unknown month or day count as
+the first) and the latest event's date. Events without a date weigh 1.
+Scores, game counts and expected scores become weighted sums, so a game
+one half-life old counts as half a game.
+
+Usage:
+    python season_ratings.py SEASON_DIR -o season.csv --jobs 8
+    python season_ratings.py "season/**/*.pgn" -o season.parquet --half-life 180 --solver anderson
+"""
+
+import argparse
+import datetime
+import os
+import time
+import numpy as np
+import instrumentation
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from pgn_scanner import iter_season_records, shard_pgn_files, UNFINISHED
+from pgn_cache import RECORD_DTYPE
+from performance_rating_equilibrium import DEFAULT_CHUNK_SIZE
+from batch_ratings import find_input_files, DEFAULT_MAX_ITERATIONS
+from pre_solvers import SOLVERS, solve
+from result_export import FORMATS, open_writer
+
+SEASON_RECORD_DTYPE = np.dtype([('event', '<i4')] + RECORD_DTYPE.descr)
+OUTPUT_COLUMNS = ['Component', 'FideId', 'Name', 'Rating', 'Events', 'Games', 'Points', 'TPR', 'PRE']
+WEIGHTED_COLUMNS = ['Weighted_Games', 'Weighted_Points']
+# Game entries (two per game) per solver task; larger components get a task each
+TASK_ENTRIES = 1 << 16
+
+
+def event_day(date):
+    """
+    Day number (as date.toordinal) of a PGN Date tag such as 2017.11.16;
+    an unknown month or day counts as the first, no year gives None.
+    """
+    parts = (date.split('.') + ['??', '??'])[:3]
+    if not parts[0].isdigit():
+        return None
+    year, month, day = (int(part) if part.isdigit() else 1 for part in parts)
+    try:
+        return datetime.date(year, month, day).toordinal()
+    except ValueError:
+        return None
+
+
+def event_weights(days, half_life):
+    """Decay weight of every event from its day (NaN for unknown), see the module docstring."""
+    days = np.asarray(days, dtype=np.float64)
+    if np.isnan(days).all():
+        return np.ones(len(days))
+    age = np.nanmax(days) - days
+    return np.where(np.isnan(days), 1.0, 0.5 ** (age / half_life))
+
+
+def read_season_shard(shard):
+    """
+    The (player keys, event names, event days, games) of a (pgn_file_path,
+    byte_range, exact) shard, with ids local to the shard; keys are
+    (FIDE id, name) and event days the earliest of their games, or NaN.
+    """
+    pgn_file_path, byte_range, exact = shard
+    player_ids, event_ids, days = {}, {}, {}
+    records = []
+    for event, date, *record in iter_season_records(pgn_file_path, player_ids, event_ids, exact, byte_range):
+        day = event_day(date)
+        if day is not None:
+            days[event] = min(days.get(event, day), day)
+        records.append((event, *record))
+    games = np.array(records, dtype=SEASON_RECORD_DTYPE)
+    event_days = np.array([days.get(event, np.nan) for event in range(len(event_ids))], dtype=np.float64)
+    return list(player_ids), list(event_ids), event_days, games
+
+
+def read_season(pgn_files, exact=False, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read every game of pgn_files, sharded as in process_pgn_files, into
+    (player keys, event names, event days, games) with global ids.
+    """
+    shards = shard_pgn_files(pgn_files, exact, chunk_size)
+    player_ids, event_ids = {}, {}
+    days, parts = [], []
+    for keys, events, event_days, games in instrumentation.pool_map(read_season_shard, shards, jobs):
+        player_index = np.array([player_ids.setdefault(key, len(player_ids)) for key in keys], dtype=np.int32)
+        event_index = np.array([event_ids.setdefault(event, len(event_ids)) for event in events], dtype=np.int32)
+        days.extend([np.nan] * (len(event_ids) - len(days)))
+        for event, day in zip(event_index, event_days):
+            days[event] = np.fmin(days[event], day)
+        if len(games):
+            games['white'] = player_index[games['white']]
+            games['black'] = player_index[games['black']]
+            games['event'] = event_index[games['event']]
+            parts.append(games)
+    games = np.concatenate(parts) if parts else np.empty(0, dtype=SEASON_RECORD_DTYPE)
+    return list(player_ids), list(event_ids), np.array(days, dtype=np.float64), games
+
+
+def resolve_players(keys):
+    """
+    Player of every (FIDE id, name) key: keys with an id are one player per
+    id; a name without an id joins the id it was seen with if that is
+    unique, and is a player of its own otherwise. Returns the player index
+    of every key and the FIDE id ('' for none) and first name of every player.
+    """
+    linked = {}
+    for fide_id, name in keys:
+        if fide_id:
+            linked.setdefault(name, set()).add(fide_id)
+    players = {}
+    fide_ids, names = [], []
+    index = np.empty(len(keys), dtype=np.int32)
+    for key, (fide_id, name) in enumerate(keys):
+        if not fide_id and len(linked.get(name, ())) == 1:
+            fide_id = next(iter(linked[name]))
+        player = players.setdefault((fide_id, '' if fide_id else name), len(names))
+        if player == len(names):
+            fide_ids.append(fide_id)
+            names.append(name)
+        index[key] = player
+    return index, fide_ids, names
+
+
+class SeasonGraph:
+    """
+    The finished games of a season as a pairing graph. Players are
+    numbered by component, largest first, then by first finished game;
+    `component_bounds[c]` is where component c's players start. `pairings`
+    is in the form of build_pairings over every player, with 'weights'
+    under time decay, and `ratings`, `games`, `points` (unweighted) and
+    `events` are per player.
+    """
+
+    def __init__(self, keys, event_days, games, half_life=None):
+        key_players, fide_ids, names = resolve_players(keys)
+        average_rating = _average_rating(games)
+        games = games[games['result'] != UNFINISHED]
+        sides = key_players[np.stack((games['white'], games['black']), axis=1)]
+
+        # Players with a finished game, in order of their first one
+        _, first = np.unique(sides.ravel(), return_index=True)
+        order = sides.ravel()[np.sort(first)]
+        number = np.full(len(names), -1, dtype=np.int64)
+        number[order] = np.arange(len(order))
+        sides = number[sides]
+        elos = np.stack((games['white_elo'], games['black_elo']), axis=1).ravel()
+        ratings = elos[np.sort(first)].astype(np.float64)
+        ratings[ratings <= 0] = average_rating
+
+        # Renumber by component, largest first, keeping first-game order within
+        num_players = len(order)
+        graph = csr_matrix((np.ones(len(sides)), (sides[:, 0], sides[:, 1])), shape=(num_players, num_players))
+        num_components, labels = connected_components(graph, directed=False)
+        sizes = np.bincount(labels, minlength=num_components)
+        rank = np.empty(num_components, dtype=np.int64)
+        rank[np.argsort(-sizes, kind='stable')] = np.arange(num_components)
+        permutation = np.lexsort((np.arange(num_players), rank[labels]))
+        renumber = np.empty(num_players, dtype=np.int64)
+        renumber[permutation] = np.arange(num_players)
+        sides = renumber[sides]
+
+        self.fide_ids = [fide_ids[player] for player in order[permutation]]
+        self.names = [names[player] for player in order[permutation]]
+        self.ratings = ratings[permutation]
+        self.component = rank[labels][permutation]
+        self.component_bounds = np.searchsorted(self.component, np.arange(num_components + 1))
+        self.weights = None if half_life is None else event_weights(event_days, half_life)[games['event']]
+
+        # Entries 2 * game + side, grouped by player in game order, as in PlayerStore
+        entries = np.argsort(sides.ravel(), kind='stable')
+        rows = sides.ravel()[entries]
+        points = np.stack((games['result'] / 2, 1 - games['result'] / 2), axis=1).ravel()[entries]
+        self.games = np.bincount(rows, minlength=num_players)
+        self.points = np.bincount(rows, points, num_players)
+        self.pairings = {'rows': rows, 'cols': sides[:, ::-1].ravel()[entries],
+                         'indptr': np.concatenate(([0], np.cumsum(self.games))),
+                         'scores': self.points, 'counts': self.games, 'ratings': self.ratings}
+        if self.weights is not None:
+            weights = np.repeat(self.weights, 2)[entries]
+            self.pairings.update(weights=weights, scores=np.bincount(rows, weights * points, num_players),
+                                 counts=np.bincount(rows, weights, num_players))
+        events = np.unique(np.stack((sides.ravel(), np.repeat(games['event'], 2)), axis=1), axis=0)
+        self.events = np.bincount(events[:, 0], minlength=num_players)
+
+    @property
+    def num_components(self):
+        return len(self.component_bounds) - 1
+
+    def component_pairings(self, component):
+        """The pairings of one component's players alone, numbered from 0."""
+        start, stop = self.component_bounds[component], self.component_bounds[component + 1]
+        indptr = self.pairings['indptr']
+        entries = slice(indptr[start], indptr[stop])
+        pairings = {
+            'rows': self.pairings['rows'][entries] - start,
+            'cols': self.pairings['cols'][entries] - start,
+            'indptr': indptr[start:stop + 1] - indptr[start],
+        }
+        for name in ('scores', 'counts', 'ratings'):
+            pairings[name] = self.pairings[name][start:stop]
+        if 'weights' in self.pairings:
+            pairings['weights'] = self.pairings['weights'][entries]
+        return pairings
+
+    def tasks(self, task_entries=TASK_ENTRIES):
+        """Components grouped into solver tasks of about task_entries game entries, largest first."""
+        indptr = self.pairings['indptr']
+        tasks, task, size = [], [], 0
+        for component in range(self.num_components):
+            task.append(component)
+            size += indptr[self.component_bounds[component + 1]] - indptr[self.component_bounds[component]]
+            if size >= task_entries:
+                tasks.append(task)
+                task, size = [], 0
+        if task:
+            tasks.append(task)
+        return tasks
+
+
+def _average_rating(games):
+    # Average of every valid rating, unfinished games included, as in PlayerStore
+    elos = np.concatenate((games['white_elo'], games['black_elo']))
+    valid = elos[elos > 0]
+    return int(valid.sum(dtype=np.int64) / len(valid)) if len(valid) else 0
+
+
+def solve_components(task):
+    """
+    For one (component pairings list, performance_rating_type, solver,
+    max_iterations) task: (TPR, PRE, status) of every component.
+    """
+    components, performance_rating_type, solver, max_iterations = task
+    results = []
+    for pairings in components:
+        tpr, pre, diagnostics = solve(pairings, performance_rating_type, solver, max_iterations=max_iterations)
+        results.append((tpr, pre, diagnostics.status))
+    return results
+
+
+def solve_season(graph, performance_rating_type='standard', solver='plain', max_iterations=DEFAULT_MAX_ITERATIONS,
+                 jobs=1):
+    """
+    Solve the PRE of every component of a SeasonGraph, on jobs processes
+    (None for one per CPU). Returns the TPR and PRE of every player and the
+    solver status of every component.
+    """
+    jobs = jobs or os.cpu_count()
+    tpr = np.full(len(graph.names), np.nan)
+    pre = np.full(len(graph.names), np.nan)
+    statuses = [None] * graph.num_components
+    task_components = graph.tasks()
+    tasks = [([graph.component_pairings(component) for component in components],
+              performance_rating_type, solver, max_iterations) for components in task_components]
+    with instrumentation.timer('season/solve'):
+        for components, results in zip(task_components, instrumentation.pool_map(solve_components, tasks, jobs)):
+            for component, (component_tpr, component_pre, status) in zip(components, results):
+                players = slice(graph.component_bounds[component], graph.component_bounds[component + 1])
+                tpr[players], pre[players] = component_tpr, component_pre
+                statuses[component] = status
+    return tpr, pre, statuses
+
+
+def export_frames(graph, tpr, pre, chunk_rows=100000):
+    """The rows of every player of a solved SeasonGraph, as DataFrames of chunk_rows players."""
+    import pandas as pd
+
+    for start in range(0, len(graph.names), chunk_rows):
+        players = slice(start, min(start + chunk_rows, len(graph.names)))
+        frame = pd.DataFrame({
+            'Component': graph.component[players],
+            'FideId': graph.fide_ids[players],
+            'Name': graph.names[players],
+            'Rating': graph.ratings[players].astype(np.int64),
+            'Events': graph.events[players],
+            'Games': graph.games[players],
+            'Points': graph.points[players],
+            'TPR': np.round(tpr[players], 1),
+            'PRE': np.round(pre[players], 1),
+        })
+        if graph.weights is not None:
+            frame['Weighted_Games'] = np.round(graph.pairings['counts'][players], 3)
+            frame['Weighted_Points'] = np.round(graph.pairings['scores'][players], 3)
+        yield frame
+
+
+def rate_season(pgn_input, output_path, performance_rating_type='standard', half_life=None, solver='plain',
+                max_iterations=DEFAULT_MAX_ITERATIONS, jobs=1, exact=False, output_format=None, sort_by='PRE',
+                top=None):
+    """
+    Rate every player of the PGN files in a directory or glob pgn_input
+    jointly and write the results to output_path (see result_export),
+    ranked by sort_by. Returns the SeasonGraph, the status of every
+    component and the number of rows written.
+    """
+    jobs = jobs or os.cpu_count()
+    with instrumentation.timer('pgn/ingest'):
+        keys, events, event_days, games = read_season(find_input_files(pgn_input), exact, jobs)
+    graph = SeasonGraph(keys, event_days, games, half_life)
+    tpr, pre, statuses = solve_season(graph, performance_rating_type, solver, max_iterations, jobs)
+
+    columns = OUTPUT_COLUMNS + (WEIGHTED_COLUMNS if half_life is not None else [])
+    with open_writer(output_path, output_format, columns, sort_by, top=top) as writer:
+        for frame in export_frames(graph, tpr, pre):
+            writer.write(frame)
+    return graph, statuses, writer.rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Joint PRE of every player over a season of events.")
+    parser.add_argument('input', help="directory or glob of PGN files")
+    parser.add_argument('-o', '--output', default='season_ratings.csv', help="output .csv, .parquet or .jsonl file")
+    parser.add_argument('--format', choices=FORMATS, help="output format; default from the extension")
+    parser.add_argument('--performance-rating-type', choices=['standard', 'linear'], default='standard',
+                        help="PR used by the PRE; linear is much faster")
+    parser.add_argument('--half-life', type=float, help="weight games by 0.5 ** (age in days / HALF_LIFE)")
+    parser.add_argument('--solver', choices=list(SOLVERS), default='plain',
+                        help="PRE solver; on slowly converging components anderson and newton can save up to "
+                             "half of the plain iterations (two thirds for linear PRs)")
+    parser.add_argument('--max-iterations', type=int, default=DEFAULT_MAX_ITERATIONS,
+                        help="PRE iterations before giving up on a component without equilibrium")
+    parser.add_argument('--sort-by', choices=OUTPUT_COLUMNS + WEIGHTED_COLUMNS, default='PRE',
+                        help="column to rank the output by; the weighted ones need --half-life")
+    parser.add_argument('--top', type=int, help="write only this many rows")
+    parser.add_argument('--jobs', type=int, default=1, help="worker processes; 0 for one per CPU")
+    parser.add_argument('--exact', action='store_true', help="read headers with python-chess")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    if args.sort_by in WEIGHTED_COLUMNS and args.half_life is None:
+        parser.error("--sort-by %s needs --half-life" % args.sort_by)
+
+    started = time.perf_counter()
+    with instrumentation.profile_from_args(args):
+        graph, statuses, rows = rate_season(args.input, args.output, args.performance_rating_type, args.half_life,
+                                      args.solver, args.max_iterations, args.jobs or None, args.exact,
+                                      args.format, args.sort_by, args.top)
+    sizes = np.diff(graph.component_bounds)
+    print(f"Rated {len(graph.names)} players in {graph.num_components} components "
+          f"(largest {sizes.max(initial=0)}) in {time.perf_counter() - started:.1f} s; "
+          f"{sum(status != 'converged' for status in statuses)} components did not converge")
+    print(f"Wrote {rows} rows to {args.output}")
@@ -0,0 +1,40 @@
+import random
+import numpy as np
+import pytest
+from calculate_cpr import perfect_score_pr, perfect_score_pr_brute_force, perfect_score_prs
+
+
+def _random_ratings(rng, count):
+    return [[rng.randint(1000, 2900) for _ in range(rng.randint(1, 10))] for _ in range(count)]
+
+
+def test_perfect_score_pr_matches_brute_force():
+    rng = random.Random(0)
+    for ratings in _random_ratings(rng, 300) + [[2500], [2500] * 8, [2800, 1000, 1000, 1000]]:
+        assert perfect_score_pr(ratings) == perfect_score_pr_brute_force(ratings)
+
+
+def test_perfect_score_prs_matches_brute_force():
+    rng = random.Random(1)
+    ratings_lists = _random_ratings(rng, 300)
+    expected = [perfect_score_pr_brute_force(ratings) for ratings in ratings_lists]
+    assert np.array_equal(perfect_score_prs(ratings_lists), expected)
+    # A rectangle of ratings may come as a 2D array
+    rectangle = np.array([[rng.randint(1000, 2900) for _ in range(6)] for _ in range(50)])
+    assert np.array_equal(perfect_score_prs(rectangle),
+                          [perfect_score_pr_brute_force(list(row)) for row in rectangle])
+
+
+def test_fractional_ratings_match_to_rounding():
+    rng = random.Random(2)
+    for _ in range(100):
+        ratings = [rng.uniform(1000, 2900) for _ in range(rng.randint(1, 9))]
+        assert perfect_score_pr(ratings) == pytest.approx(perfect_score_pr_brute_force(ratings), abs=1e-9)
+
+
+def test_empty_ratings():
+    with pytest.raises(ValueError):
+        perfect_score_pr([])
+    with pytest.raises(ValueError):
+        perfect_score_prs([[2500], []])
+    assert len(perfect_score_prs([])) == 0
@@ -0,0 +1,48 @@
+import pytest
+from benchmark import swiss_records
+from performance_rating_equilibrium import build_player_data, process_player_data
+from incremental_pre import IncrementalPRE
+
+
+def _cold(names, records, performance_rating_type):
+    player_data, average_rating = build_player_data(records, {name: i for i, name in enumerate(names)})
+    return process_player_data(player_data, average_rating, performance_rating_type)
+
+
+def _assert_matches_cold(incremental, names, records, performance_rating_type):
+    results = incremental.results()
+    cold = _cold(names, records, performance_rating_type)
+    assert set(results) == set(cold)
+    for name, data in cold.items():
+        assert results[name]['TPR'] == data['TPR']
+        assert results[name]['PRE'] == data['PRE']
+
+
+def _add_rounds(incremental, names, records, rounds, games_per_round, performance_rating_type, earlier=()):
+    # Add the rounds in groups of the given sizes, comparing after each
+    end = 0
+    for size in rounds:
+        start, end = end, end + size * games_per_round
+        stats = incremental.add_records(records[start:end])
+        assert stats['games'] == end - start
+        _assert_matches_cold(incremental, names, list(earlier) + records[:end], performance_rating_type)
+
+
+@pytest.mark.parametrize('performance_rating_type', ['standard', 'linear'])
+def test_every_round_matches_cold_recompute(performance_rating_type):
+    # Rounds 2 and 3 alone leave perfect scores, which have no equilibrium
+    names, records = swiss_records(32, 6, seed=2)
+    incremental = IncrementalPRE(performance_rating_type)
+    incremental.player_ids.update((name, i) for i, name in enumerate(names))
+    _add_rounds(incremental, names, records, [1, 3, 1, 1], 16, performance_rating_type)
+
+
+def test_second_event_matches_cold_recompute():
+    # The finished event shares no players with the new one
+    first_names, first_records = swiss_records(32, 6, seed=2)
+    second_names, second_records = swiss_records(20, 5, seed=0, first_id=32)
+    names = first_names + second_names
+    incremental = IncrementalPRE('standard')
+    incremental.player_ids.update((name, i) for i, name in enumerate(names))
+    incremental.add_records(first_records)
+    _add_rounds(incremental, names, second_records, [1, 4], 10, 'standard', first_records)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from benchmark import random_records, swiss_records
+from performance_rating_equilibrium import (build_pairings, build_player_data, linear_performance_rating,
+                                            performance_rating, pr_step, solve_pre)
+
+
+def _player_data(names, records):
+    player_data, _ = build_player_data(records, {name: i for i, name in enumerate(names)})
+    return {name: data for name, data in player_data.items() if data['opponents']}
+
+
+def _scalar_pre(player_data, performance_rating_type):
+    # The per-player loop the CSR solver replaced, one PR call per player
+    # and round until every rounded PR repeats
+    rate = linear_performance_rating if performance_rating_type == 'linear' else performance_rating
+    current = {name: data['Rating'] for name, data in player_data.items()}
+    first = previous = None
+    while True:
+        prs = {name: rate([current[opponent] for opponent in data['opponents']], sum(data['results']))
+               for name, data in player_data.items()}
+        if first is None:
+            first = prs
+        elif all(pr is not None and previous[name] is not None and round(pr) == round(previous[name])
+                 for name, pr in prs.items()):
+            return first, prs
+        previous = prs
+        current = {name: player_data[name]['Rating'] if pr is None else pr for name, pr in prs.items()}
+
+
+def _array(prs, names):
+    return np.array([np.nan if prs[name] is None else prs[name] for name in names])
+
+
+@pytest.mark.parametrize('performance_rating_type', ['standard', 'linear'])
+def test_pr_step_matches_scalar_prs(performance_rating_type):
+    player_data = _player_data(*swiss_records(64, 7, seed=0))
+    names, pairings = build_pairings(player_data)
+    rate = linear_performance_rating if performance_rating_type == 'linear' else performance_rating
+    expected = [rate([player_data[opponent]['Rating'] for opponent in data['opponents']], sum(data['results']))
+                for data in player_data.values()]
+    new_pr = pr_step(pairings, performance_rating_type, pairings['ratings'])
+    assert np.allclose(new_pr, np.array(expected, dtype=np.float64), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('performance_rating_type', ['standard', 'linear'])
+@pytest.mark.parametrize('seed', [0, 2, 3])
+def test_solve_pre_matches_scalar_loop(performance_rating_type, seed):
+    player_data = _player_data(*swiss_records(32, 6, seed=seed))
+    names, pairings = build_pairings(player_data)
+    first, prs = _scalar_pre(player_data, performance_rating_type)
+    tpr, pre = solve_pre(pairings, performance_rating_type)
+    assert np.allclose(tpr, _array(first, names), rtol=0, atol=1e-9, equal_nan=True)
+    assert np.allclose(pre, _array(prs, names), rtol=0, atol=1e-9, equal_nan=True)
+
+
+def test_large_random_event_converges():
+    # Some PR of an event this size flips across a rounding boundary every
+    # round, so the rounded PRs alone never repeat
+    player_data = _player_data(*random_records(10000, 100000, seed=0))
+    names, pairings = build_pairings(player_data)
+    history = []
+    tpr, pre = solve_pre(pairings, 'standard', history=history)
+    assert len(history) < 100
+    assert not np.isnan(pre).any()
@@ -0,0 +1,35 @@
+import os
+import shutil
+import subprocess
+import sys
+import numpy as np
+from pgn_cache import RecordCache, records_to_array
+from pgn_scanner import iter_game_records
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PALMA = os.path.join(ROOT, 'GrandSwissPalma2017.pgn')
+
+
+def _cached_copy(tmp_path):
+    pgn_file_path = str(tmp_path / 'palma.pgn')
+    shutil.copy(PALMA, pgn_file_path)
+    player_ids = {}
+    games = records_to_array(iter_game_records(pgn_file_path, player_ids))
+    cache = RecordCache(str(tmp_path / 'cache'))
+    cache.store(pgn_file_path, list(player_ids), games)
+    cache.save()
+    return pgn_file_path, list(player_ids), games
+
+
+def test_store_and_load(tmp_path):
+    pgn_file_path, names, games = _cached_copy(tmp_path)
+    loaded_names, loaded_games = RecordCache(str(tmp_path / 'cache')).load(pgn_file_path)
+    assert loaded_names == names
+    assert np.array_equal(loaded_games, games)
+
+
+def test_invalidate_cli_takes_options_before_files(tmp_path):
+    pgn_file_path, _, _ = _cached_copy(tmp_path)
+    subprocess.run([sys.executable, os.path.join(ROOT, 'pgn_cache.py'), 'invalidate',
+                    '--cache-dir', str(tmp_path / 'cache'), pgn_file_path], check=True)
+    assert RecordCache(str(tmp_path / 'cache')).load(pgn_file_path) is None
@@ -0,0 +1,110 @@
+import random
+import pytest
+from pgn_scanner import (EVENT_TAGS, SEASON_TAGS, WANTED_TAGS, needs_exact_reader, read_game_headers,
+                         scan_game_headers, shard_pgn_files, split_pgn_file, iter_game_records)
+
+PALMA = 'GrandSwissPalma2017.pgn'
+
+GAME = '[Event "E"]\n[White "{white}"]\n[Black "{black}"]\n[Result "1-0"]\n[WhiteElo "2500"]\n\n1. e4 e5 1-0\n\n'
+
+REGULAR = {
+    'one blank line between tags': '[White "a"]\n\n[Black "b"]\n[Result "1-0"]\n\n1. e4 1-0\n\n',
+    'blank lines between games': GAME.format(white='a', black='b') + '\n\n' + GAME.format(white='c', black='d'),
+    'crlf': GAME.format(white='a', black='b').replace('\n', '\r\n') * 2,
+    'bom': '﻿' + GAME.format(white='a', black='b') * 2,
+    'clock comments': '[White "a"]\n[Black "b"]\n\n1. e4 { [%clk 0:03:00] } e5 { [%clk 0:03:00] } 1-0\n\n'
+                      + GAME.format(white='c', black='d'),
+    'multi-line comment': '[White "a"]\n\n1. e4 { a long\ncomment } e5 ; rest of line\n1-0\n\n'
+                          + GAME.format(white='c', black='d'),
+    'result only in move text': '[White "a"]\n[Result "*"]\n\n1. e4 ( 1. d4 1-0 ) 0-1\n\n[White "b"]\n\n1. e4 *\n\n',
+    'no move text': '[White "a"]\n[Black "b"]\n\n',
+    'no final newline': GAME.format(white='a', black='b') + '[White "c"]\n\n1. d4 0-1',
+    'malformed tag': '[White "a"]\n[Black b]\n[Black "b"]\n\n1. e4 1-0\n\n',
+}
+
+IRREGULAR = {
+    'percent line in headers': '[White "a"]\n% escaped\n[Black "b"]\n\n1. e4 1-0\n\n',
+    'semicolon line in headers': '[White "a"]\n; comment\n[Black "b"]\n\n1. e4 1-0\n\n',
+    'tag line inside a comment': '[White "a"]\n\n1. e4 { see\n\n[White "x"]\nfor this } e5 1-0\n\n'
+                                 + GAME.format(white='c', black='d'),
+    'clock comment on a line of its own': '[White "a"]\n\n1. e4 {\n[%clk 0:03:00] } e5 1-0\n\n'
+                                          + GAME.format(white='c', black='d'),
+    'brace in a line comment': '[White "a"]\n\n1. e4 ; {\n1-0\n\n' + GAME.format(white='c', black='d'),
+    'two blank lines between tags': '[White "a"]\n\n\n[Black "b"]\n\n1. e4 1-0\n\n',
+    'two blank lines before move text': '[White "a"]\n\n\n1. e4 1-0\n\n' + GAME.format(white='c', black='d'),
+    'blank line inside move text': '[White "a"]\n\n1. e4\n\ne5 1-0\n\n' + GAME.format(white='c', black='d'),
+    'tags straight after move text': '[White "a"]\n\n1. e4 1-0\n[White "b"]\n\n1. d4 0-1\n\n',
+    'text before the first tag': '1. e4 1-0\n\n' + GAME.format(white='c', black='d'),
+    'lone carriage return': GAME.format(white='a', black='b').replace('\n', '\r') * 2,
+}
+
+
+def _write(tmp_path, text, name='games.pgn'):
+    path = tmp_path / name
+    path.write_bytes(text.encode('utf-8'))
+    return str(path)
+
+
+@pytest.mark.parametrize('name', sorted(REGULAR))
+def test_scanner_matches_python_chess(tmp_path, name):
+    path = _write(tmp_path, REGULAR[name])
+    assert not needs_exact_reader(path)
+    for tags in (WANTED_TAGS, EVENT_TAGS, SEASON_TAGS):
+        assert list(scan_game_headers(path, wanted_tags=tags)) == list(read_game_headers(path, tags))
+
+
+@pytest.mark.parametrize('name', sorted(IRREGULAR))
+def test_irregular_layouts_use_python_chess(tmp_path, name):
+    path = _write(tmp_path, IRREGULAR[name])
+    assert needs_exact_reader(path)
+    assert shard_pgn_files([path], False, 16) == [(path, None, True)]
+    scanned = list(iter_game_records(path, {}))
+    assert scanned == list(iter_game_records(path, {}, exact=True))
+
+
+def test_palma_matches_python_chess():
+    assert not needs_exact_reader(PALMA)
+    assert list(scan_game_headers(PALMA, wanted_tags=SEASON_TAGS)) == list(read_game_headers(PALMA, SEASON_TAGS))
+
+
+def test_split_ranges_match_whole_file(tmp_path):
+    path = _write(tmp_path, ''.join(GAME.format(white='p%d' % i, black='q%d' % i) for i in range(50)))
+    ranges = split_pgn_file(path, 200)
+    assert len(ranges) > 1
+    whole = list(scan_game_headers(path))
+    assert [game for byte_range in ranges for game in scan_game_headers(path, byte_range)] == whole
+
+
+TAG_LINES = ['[White "a"]', '[Black "b"]', '[White "c"]', '[Result "1-0"]', '[Result "*"]', '[Event "e"]',
+             '[Black c]', '[WhiteElo "2400"]']
+MOVE_LINES = ['1. e4 e5', '2. Nf3 1-0', '{ comment\nmore } Nc6', '{ [%clk 0:01] }', 'e4 ; rest', '*', '0-1',
+              '( 1. d4 1/2-1/2 )']
+ODD_LINES = ['', '   ', '% escape', '; comment', ' [White "x"]', '[Black "y"]', '1. d4', '{ open']
+
+
+def _random_pgn(rng):
+    lines = []
+    for _ in range(rng.randrange(1, 6)):
+        lines += rng.choices(TAG_LINES, k=rng.randrange(1, 6))
+        if rng.random() < 0.2:
+            lines += [''] + rng.choices(TAG_LINES, k=rng.randrange(1, 3))
+        if rng.random() < 0.9:
+            lines += [''] * (rng.random() < 0.8) + rng.choices(MOVE_LINES, k=rng.randrange(1, 4))
+        lines += [''] * rng.randrange(1, 3)
+    for _ in range(rng.randrange(3)):
+        lines.insert(rng.randrange(len(lines) + 1), rng.choice(ODD_LINES))
+    return '\n'.join(lines)
+
+
+def test_random_layouts_match_python_chess(tmp_path):
+    # Whatever the layout, the scanner finds the games python-chess finds
+    # unless the file needs the exact reader, which most layouts do not
+    rng = random.Random(7)
+    scanned = 0
+    for index in range(300):
+        text = _random_pgn(rng)
+        path = _write(tmp_path, text, '%d.pgn' % index)
+        if not needs_exact_reader(path):
+            scanned += 1
+            assert list(scan_game_headers(path, wanted_tags=EVENT_TAGS)) == list(read_game_headers(path, EVENT_TAGS)), text
+    assert scanned > 100
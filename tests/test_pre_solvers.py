@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from benchmark import swiss_records, build_player_data
+from performance_rating_equilibrium import build_pairings, pr_step
+from pre_solvers import solve, SOLVERS
+
+ACCELERATED = [solver for solver in SOLVERS if solver != 'plain']
+# PREs are rounded to a tenth of a point
+PARITY_TOLERANCE = 0.1
+
+
+def _swiss_pairings(players, rounds, seed):
+    names, records = swiss_records(players, rounds, seed)
+    player_data, _ = build_player_data(records, {name: i for i, name in enumerate(names)})
+    return build_pairings({name: data for name, data in player_data.items() if data['opponents']})[1]
+
+
+def _fixed_point(pairings, performance_rating_type, pre):
+    # The plain iteration from its own result, unrounded, until it settles
+    x = np.where(np.isnan(pre), pairings['ratings'], pre)
+    for _ in range(20000):
+        new_pr = pr_step(pairings, performance_rating_type, x, decimals=None)
+        new_pr = np.where(np.isnan(new_pr), pairings['ratings'], new_pr)
+        if np.abs(new_pr - x).max() < 1e-7:
+            break
+        x = new_pr
+    return new_pr
+
+
+@pytest.mark.parametrize('performance_rating_type', ['standard', 'linear'])
+@pytest.mark.parametrize('solver', ACCELERATED)
+def test_matches_plain_fixed_point(solver, performance_rating_type):
+    pairings = _swiss_pairings(64, 7, 0)
+    plain_tpr, plain_pre, plain_diagnostics = solve(pairings, performance_rating_type, 'plain')
+    assert plain_diagnostics.status == 'converged'
+    tpr, pre, diagnostics = solve(pairings, performance_rating_type, solver)
+    assert diagnostics.status == 'converged' and not diagnostics.fallback
+    assert np.array_equal(tpr, plain_tpr, equal_nan=True)
+    fixed_point = _fixed_point(pairings, performance_rating_type, plain_pre)
+    assert np.abs(pre - fixed_point).max() <= PARITY_TOLERANCE
+
+
+@pytest.mark.parametrize('solver', ACCELERATED)
+def test_falls_back_to_plain_at_bracket_edge(solver):
+    # The plain iteration settles with the weakest PRs at the bottom of
+    # PR_BRACKET; accelerated steps push them out of it
+    pairings = _swiss_pairings(128, 9, 2)
+    plain_tpr, plain_pre, plain_diagnostics = solve(pairings, 'standard', 'plain')
+    tpr, pre, diagnostics = solve(pairings, 'standard', solver)
+    assert diagnostics.fallback
+    assert diagnostics.status == plain_diagnostics.status == 'converged'
+    assert np.array_equal(pre, plain_pre, equal_nan=True)
+    assert np.array_equal(tpr, plain_tpr, equal_nan=True)
+
+
+def test_max_iterations_caps_by_default():
+    pairings = _swiss_pairings(64, 7, 1)
+    _, pre, diagnostics = solve(pairings, 'standard', 'plain')
+    assert diagnostics.status == 'max_iterations'
+    assert diagnostics.iterations <= 1001
+    assert np.isnan(pre).any()
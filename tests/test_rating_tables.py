@@ -0,0 +1,23 @@
+import numpy as np
+from rating_tables import validate, VALIDATE_TOLERANCE, epr_lookup, cpr_lookup, fpr_lookup, TABLE_MAX_N
+from score_kernels import calculate_EPR_batch
+from calculate_cpr import calculate_cpr_batch
+from pr_calculator import calculate_FPR
+
+
+def test_validate_small_tables():
+    differences = validate(thresholds=(0.5, 0.75), max_n=12)
+    assert set(differences) == {'epr_0.5', 'epr_0.75', 'cpr', 'fpr'}
+    for name, difference in differences.items():
+        assert difference <= VALIDATE_TOLERANCE, name
+
+
+def test_lookups_match_fallbacks():
+    rng = np.random.default_rng(0)
+    # Some games counts past the tables, which take the fallbacks
+    n = rng.integers(1, TABLE_MAX_N + 4, 200).astype(np.float64)
+    m = np.floor(rng.uniform(0, 1, 200) * (2 * n + 1)) / 2
+    B = rng.uniform(1800, 2800, 200)
+    assert np.array_equal(epr_lookup(m, n, B), calculate_EPR_batch(m, n, B, 0.75), equal_nan=True)
+    assert np.array_equal(cpr_lookup(m, n, B), calculate_cpr_batch(m, n, B), equal_nan=True)
+    assert np.array_equal(fpr_lookup(m, n, B), [calculate_FPR(*entry) for entry in zip(m, n, B)], equal_nan=True)
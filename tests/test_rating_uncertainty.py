@@ -0,0 +1,30 @@
+import pytest
+from benchmark import swiss_records
+from performance_rating_equilibrium import build_player_data
+from rating_uncertainty import bootstrap_ratings
+
+
+def _swiss(players, rounds, seed):
+    names, records = swiss_records(players, rounds, seed)
+    return build_player_data(records, {name: i for i, name in enumerate(names)})
+
+
+@pytest.mark.parametrize('method', ['parametric', 'nonparametric'])
+def test_failure_rate_counts_replicates_without_pre(method):
+    player_data, average_rating = _swiss(48, 7, 2)
+    results = bootstrap_ratings(player_data, average_rating, replicates=64, method=method, max_failure_rate=1)
+    for data in results.values():
+        assert data['Failure_rate'] == pytest.approx(1 - data['Replicates'] / 64)
+    assert any(data['Failure_rate'] > 0 for data in results.values())
+
+
+def test_too_many_failures_raise():
+    player_data, average_rating = _swiss(48, 7, 2)
+    results = bootstrap_ratings(player_data, average_rating, replicates=64, max_failure_rate=1)
+    worst = max(data['Failure_rate'] for data in results.values() if data['PRE'] is not None)
+    player_data, average_rating = _swiss(48, 7, 2)
+    with pytest.raises(ValueError, match='no PRE in more than'):
+        bootstrap_ratings(player_data, average_rating, replicates=64, max_failure_rate=worst / 2)
+    # At the worst rate itself nothing fails
+    player_data, average_rating = _swiss(48, 7, 2)
+    bootstrap_ratings(player_data, average_rating, replicates=64, max_failure_rate=worst)
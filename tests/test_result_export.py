@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from result_export import RankedWriter, ResultWriter
+
+
+def _frames(count, size, seed):
+    # Unique names and ratings, so every order is fully determined, and
+    # some missing values, which go last
+    rng = np.random.default_rng(seed)
+    names = ['Player %04d' % i for i in rng.permutation(count * size)]
+    pre = rng.uniform(1800, 2800, count * size)
+    pre[rng.choice(count * size, count, replace=False)] = np.nan
+    frame = pd.DataFrame({'Name': names, 'Games': rng.integers(1, 12, count * size), 'PRE': pre})
+    frame.loc[::9, 'Name'] = None
+    return [frame.iloc[start:start + size] for start in range(0, count * size, size)]
+
+
+def _write(path, frames, by, ascending, top, max_rows):
+    with RankedWriter(ResultWriter(str(path)), by, ascending, top, max_rows=max_rows, chunk_rows=5) as writer:
+        for frame in frames:
+            writer.write(frame)
+    return path.read_bytes()
+
+
+@pytest.mark.parametrize('by', ['Name', 'PRE'])
+@pytest.mark.parametrize('ascending', [False, True])
+@pytest.mark.parametrize('top', [None, 23])
+def test_spilled_runs_match_in_memory_sort(tmp_path, by, ascending, top):
+    frames = _frames(20, 4, 0)
+    in_memory = _write(tmp_path / 'memory.csv', frames, by, ascending, top, max_rows=1000)
+    # max_rows below top too, so top does not keep it from spilling
+    spilled = _write(tmp_path / 'spilled.csv', frames, by, ascending, top, max_rows=7)
+    assert spilled == in_memory